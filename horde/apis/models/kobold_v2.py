@@ -67,6 +67,13 @@ class Models(v2.Models):
             'max_content_length': fields.Integer(default=2048,description="The max amount of context to submit to this AI for sampling."), 
             'softprompts': fields.List(fields.String(description="The available softprompt files on this worker for the currently running model")),
         })
+        self.input_model_job_submit_pop = api.inherit('SubmitPopInput', self.input_model_job_pop, {
+            'generations': fields.List(fields.Nested(self.input_model_job_submit_generation), required=True, min_items=1, max_items=20, description="The finished generations to submit before popping the next jobs"),
+        })
+        self.response_model_job_submit_pop = api.inherit('GenerationSubmittedPayload', self.response_model_job_pop, {
+            'reward': fields.Float(example=10.0,description="The total amount of kudos gained for the submitted generations"),
+            'generations': fields.List(fields.Nested(self.response_model_job_submit_batch_entry)),
+        })
         self.input_model_request_generation = api.model('GenerationInput', {
             'prompt': fields.String(description="The prompt which will be sent to KoboldAI to generate an image"),
             'params': fields.Nested(self.input_model_generation_payload,skip_none=True),
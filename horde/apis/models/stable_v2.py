@@ -17,6 +17,7 @@ class Parsers(v2.Parsers):
         self.job_pop_parser.add_argument("allow_painting", type=bool, required=False, default=True, help="If True, this worker will pick up inpainting/outpaining requests", location="json")
         self.job_pop_parser.add_argument("allow_unsafe_ipaddr", type=bool, required=False, default=True, help="If True, this worker will pick up img2img requests coming from clients with an unsafe IP.", location="json")
         self.job_pop_parser.add_argument("allow_post_processing", type=bool, required=False, default=True, help="If True, this worker will pick up requests requesting post-processing.", location="json")
+        self.job_pop_parser.add_argument("max_batch", type=int, required=False, default=1, help="How many images of the same request this worker can generate in a single job", location="json")
         self.job_submit_parser.add_argument("seed", type=str, required=True, default='', help="The seed of the generation", location="json")
         self.job_submit_parser.add_argument("censored", type=bool, required=False, default=False, help="If true, this image has been censored by the safety filter.", location="json")
 
@@ -50,6 +51,8 @@ class Models(v2.Models):
             'prompt': fields.String(description="The prompt which will be sent to Stable Diffusion to generate an image"),
             'ddim_steps': fields.Integer(default=30), 
             'n_iter': fields.Integer(default=1, description="The amount of images to generate"), 
+            'batch_size': fields.Integer(default=1, description="How many images to generate in this job"),
+            'seeds': fields.List(fields.String(description="The seed of each image in this job, when it covers more than 1 image")),
             'use_nsfw_censor': fields.Boolean(description="When true will apply NSFW censoring model on the generation"),
             'use_embeds': fields.Boolean(default=False, description="When true will use embeddings from the concepts library when doing the generation"),
         })
@@ -65,15 +68,27 @@ class Models(v2.Models):
             'post-processing': fields.Integer(description="How many waiting requests were skipped because they requested post-processing"),
             'kudos': fields.Integer(description="How many waiting requests were skipped because the user didn't have enough kudos when this worker requires upfront kudos"),
         })
-        self.response_model_job_pop = api.model('GenerationPayload', {
+        self.response_model_job_pop_job = api.model('GenerationJob', {
             'payload': fields.Nested(self.response_model_generation_payload,skip_none=True),
             'id': fields.String(description="The UUID for this image generation"),
-            'skipped': fields.Nested(self.response_model_generations_skipped, skip_none=True),
             'model': fields.String(description="Which of the available models to use for this request"),
             'source_image': fields.String(description="The Base64-encoded webp to use for img2img"),
             'source_processing': fields.String(required=False, default='img2img',enum=["img2img", "inpainting", "outpainting"], description="If source_image is provided, specifies how to process it."), 
             'source_mask': fields.String(description="If img_processing is set to 'inpainting' or 'outpainting', this parameter can be optionally provided as the mask of the areas to inpaint. If this arg is not passed, the inpainting/outpainting mask has to be embedded as alpha channel"),
             'r2_upload': fields.String(description="The r2 upload link to use to upload this image"),
+            'ids': fields.List(fields.String(description="When this job covers more than 1 image, the UUID of each image, in the same order as the payload seeds. Each image has to be submitted against its own UUID")),
+            'r2_uploads': fields.List(fields.String(description="When this job covers more than 1 image, the r2 upload link of each image, in the same order as the ids")),
+        })
+        self.response_model_job_pop = api.inherit('GenerationPayload', self.response_model_job_pop_job, {
+            'skipped': fields.Nested(self.response_model_generations_skipped, skip_none=True),
+            'jobs': fields.List(fields.Nested(self.response_model_job_pop_job, skip_none=True), description="When more than 1 job amount was requested, all the popped jobs are provided here instead"),
+        })
+        self.input_model_job_submit_generation = api.inherit('SubmitInputGenerationStable', self.input_model_job_submit_generation, {
+            'seed': fields.String(required=True, description="The seed of the generation"),
+            'censored': fields.Boolean(default=False, description="If true, this image has been censored by the safety filter."),
+        })
+        self.input_model_job_submit_batch = api.model('SubmitBatchInput', {
+            'generations': fields.List(fields.Nested(self.input_model_job_submit_generation), required=True, min_items=1, max_items=20),
         })
         self.input_model_job_pop = api.inherit('PopInputStable', self.input_model_job_pop, {
             'max_pixels': fields.Integer(default=512*512,description="The maximum amount of pixels this worker can generate"), 
@@ -81,8 +96,16 @@ class Models(v2.Models):
             'allow_painting': fields.Boolean(default=True,description="If True, this worker will pick up inpainting/outpainting requests"),
             'allow_unsafe_ipaddr': fields.Boolean(default=True,description="If True, this worker will pick up img2img requests coming from clients with an unsafe IP."),
             'allow_post_processing': fields.Boolean(default=True,description="If True, this worker will pick up requests requesting post-processing."),
+            'max_batch': fields.Integer(default=1,description="How many images of the same request this worker can generate in a single job. Each image is still submitted on its own.",min=1, max=8),
             'require_upfront_kudos': fields.Boolean(description="If True, then will only pick up requests where the users has the required kudos for them already."),
         })
+        self.input_model_job_submit_pop = api.inherit('SubmitPopInput', self.input_model_job_pop, {
+            'generations': fields.List(fields.Nested(self.input_model_job_submit_generation), required=True, min_items=1, max_items=20, description="The finished generations to submit before popping the next jobs"),
+        })
+        self.response_model_job_submit_pop = api.inherit('GenerationSubmittedPayload', self.response_model_job_pop, {
+            'reward': fields.Float(example=10.0,description="The total amount of kudos gained for the submitted generations"),
+            'generations': fields.List(fields.Nested(self.response_model_job_submit_batch_entry)),
+        })
 
         self.input_model_request_generation = api.model('GenerationInput', {
             'prompt': fields.String(required=True,description="The prompt which will be sent to Stable Diffusion to generate an image", min_length = 1),
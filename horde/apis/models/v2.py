@@ -22,12 +22,18 @@ class Parsers:
     job_pop_parser.add_argument("models", type=list, required=False, help="The models currently available on this worker", location="json")
     job_pop_parser.add_argument("bridge_version", type=int, required=False, default=1, help="Specify the version of the worker bridge, as that can modify the way the arguments are being sent", location="json")
     job_pop_parser.add_argument("threads", type=int, required=False, default=1, help="How many threads this worker is running. This is used to accurately the current power available in the horde", location="json")
+    job_pop_parser.add_argument("amount", type=int, required=False, default=1, help="How many jobs to pop at the same time", location="json")
+    job_pop_parser.add_argument("wait", type=int, required=False, default=0, help="How many seconds to keep the request open while waiting for a job to be queued", location="json")
 
     job_submit_parser = reqparse.RequestParser()
     job_submit_parser.add_argument("apikey", type=str, required=True, help="The worker's owner API key", location='headers')
     job_submit_parser.add_argument("id", type=str, required=True, help="The processing generation uuid", location="json")
     job_submit_parser.add_argument("generation", type=str, required=True, help="The generated output", location="json")
 
+    job_submit_batch_parser = reqparse.RequestParser()
+    job_submit_batch_parser.add_argument("apikey", type=str, required=True, help="The worker's owner API key", location='headers')
+    job_submit_batch_parser.add_argument("generations", type=list, required=True, help="The generated outputs", location="json")
+
 
 class Models:
     def __init__(self,api):
@@ -83,15 +89,33 @@ class Models:
             'bridge_version': fields.Integer(example=0,description="How many waiting requests were skipped because they require a higher version of the bridge than this worker is running (upgrade if you see this in your skipped list).", min=0),
         })
 
-        self.response_model_job_pop = api.model('GenerationPayload', {
+        self.response_model_job_pop_job = api.model('GenerationJob', {
             'payload': fields.Nested(self.response_model_generation_payload, skip_none=True),
             'id': fields.String(description="The UUID for this image generation"),
-            'skipped': fields.Nested(self.response_model_generations_skipped, skip_none=True)
+        })
+        self.response_model_job_pop = api.inherit('GenerationPayload', self.response_model_job_pop_job, {
+            'skipped': fields.Nested(self.response_model_generations_skipped, skip_none=True),
+            'jobs': fields.List(fields.Nested(self.response_model_job_pop_job, skip_none=True), description="When more than 1 job amount was requested, all the popped jobs are provided here instead"),
         })
 
         self.response_model_job_submit = api.model('GenerationSubmitted', {
             'reward': fields.Float(example=10.0,description="The amount of kudos gained for submitting this request"),
         })
+        self.input_model_job_submit_generation = api.model('SubmitInputGeneration', {
+            'id': fields.String(required=True, description="The processing generation uuid"),
+            'generation': fields.String(required=True, description="The generated output"),
+        })
+        self.input_model_job_submit_batch = api.model('SubmitBatchInput', {
+            'generations': fields.List(fields.Nested(self.input_model_job_submit_generation), required=True, min_items=1, max_items=20),
+        })
+        self.response_model_job_submit_batch_entry = api.model('GenerationSubmittedEntry', {
+            'id': fields.String(description="The processing generation uuid"),
+            'reward': fields.Float(example=10.0,description="The amount of kudos gained for submitting this generation"),
+        })
+        self.response_model_job_submit_batch = api.model('GenerationBatchSubmitted', {
+            'reward': fields.Float(example=10.0,description="The total amount of kudos gained for submitting these generations"),
+            'generations': fields.List(fields.Nested(self.response_model_job_submit_batch_entry)),
+        })
 
         self.response_model_kudos_transfer = api.model('KudosTransferred', {
             'transferred': fields.Integer(example=100,description="The amount of Kudos tranferred"),
@@ -116,6 +140,15 @@ class Models:
             'models': fields.List(fields.String(description="Which models this worker is serving",min_length=3,max_length=50)),
             'bridge_version': fields.Integer(default=1,description="The version of the bridge used by this worker"),
             'threads': fields.Integer(default=1,description="How many threads this worker is running. This is used to accurately the current power available in the horde",min=1, max=10),
+            'amount': fields.Integer(default=1,description="How many jobs to pop at the same time. This cannot be more than the threads of this worker",min=1, max=10),
+            'wait': fields.Integer(default=0,description="When there are no jobs available, keep the request open for up to this many seconds, until a job for this worker's models is queued. When too many workers are already waiting, the request returns immediately",min=0, max=30),
+        })
+        self.input_model_job_submit_pop = api.inherit('SubmitPopInput', self.input_model_job_pop, {
+            'generations': fields.List(fields.Nested(self.input_model_job_submit_generation), required=True, min_items=1, max_items=20, description="The finished generations to submit before popping the next jobs"),
+        })
+        self.response_model_job_submit_pop = api.inherit('GenerationSubmittedPayload', self.response_model_job_pop, {
+            'reward': fields.Float(example=10.0,description="The total amount of kudos gained for the submitted generations"),
+            'generations': fields.List(fields.Nested(self.response_model_job_submit_batch_entry)),
         })
         self.response_model_worker_details = api.inherit('WorkerDetails', self.response_model_worker_details_lite, {
             "requests_fulfilled": fields.Integer(description="How many images this worker has generated."),
@@ -251,6 +284,16 @@ class Models:
             'queued': fields.Float(description="The amount waiting to be generated by this model"),
             'eta': fields.Integer(description="Estimated time in seconds for this model's queue to be cleared"),
         })
+        self.response_model_model_demand = api.model('ModelDemand', {
+            'name': fields.String(description="The Name of a model requested in this horde."),
+            'queued': fields.Float(description="The amount waiting to be generated by this model"),
+            'count': fields.Integer(description="How many of workers in this horde are running this model."),
+            'queued_per_worker': fields.Float(description="The amount waiting to be generated by this model, for each worker running it"),
+        })
+        self.response_model_demand = api.model('DemandSummary', {
+            'models': fields.List(fields.Nested(self.response_model_model_demand), description="The requested models, ordered by how backlogged they are"),
+            'suggested_models': fields.List(fields.String(description="A model name"), description="The most backlogged models which the specified worker is not running"),
+        })
         self.response_model_deleted_worker = api.model('DeletedWorker', {
             'deleted_id': fields.String(description="The ID of the deleted worker"),
             'deleted_name': fields.String(description="The Name of the deleted worker"),
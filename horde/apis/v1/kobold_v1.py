@@ -118,7 +118,7 @@ class SyncGenerate(Resource):
         if args['prompt'] == '':
             return(f"{get_error(ServerErrors.EMPTY_PROMPT, username = username)}",400)
         wp_count = database.count_waiting_requests(user)
-        if wp_count >= user.get_concurrency(args["models"],database.retrieve_available_models()):
+        if wp_count >= user.get_concurrency(args["models"],database.retrieve_model_workers()):
             return(f"{get_error(ServerErrors.TOO_MANY_PROMPTS, username = username, wp_count = wp_count)}",503)
         # logger.debug(args["models"])
         wp = WaitingPrompt(
@@ -220,7 +220,7 @@ class AsyncGenerate(Resource):
         if args['prompt'] == '':
             return(f"{get_error(ServerErrors.EMPTY_PROMPT, username = username)}",400)
         wp_count = database.count_waiting_requests(user)
-        if wp_count >= user.get_concurrency(args["models"],database.retrieve_available_models()):
+        if wp_count >= user.get_concurrency(args["models"],database.retrieve_model_workers()):
             return(f"{get_error(ServerErrors.TOO_MANY_PROMPTS, username = username, wp_count = wp_count)}",503)
         wp = WaitingPrompt(
             _db,
@@ -83,6 +83,11 @@ class JobPop(JobPop):
         return(ret)
 
 
+class JobSubmitPop(JobSubmitPop, JobPop):
+    '''Uses the kobold check-in and job selection of the JobPop above'''
+    pass
+
+
 class HordeLoad(HordeLoad):
     # When we extend the actual method, we need to re-apply the decorators
     @logger.catch(reraise=True)
@@ -101,6 +106,9 @@ api.add_resource(AsyncStatus, "/generate/status/<string:id>")
 api.add_resource(AsyncCheck, "/generate/check/<string:id>")
 api.add_resource(JobPop, "/generate/pop")
 api.add_resource(JobSubmit, "/generate/submit")
+api.add_resource(JobSubmitBatch, "/generate/submit/batch")
+api.add_resource(JobSubmitPop, "/generate/submit/pop")
+api.add_resource(ModelDemand, "/generate/demand")
 api.add_resource(Users, "/users")
 api.add_resource(UserSingle, "/users/<string:user_id>")
 api.add_resource(FindUser, "/find_user")
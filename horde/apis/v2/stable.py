@@ -13,6 +13,8 @@ from horde.r2 import upload_source_image, generate_img_download_url
 from horde.logger import logger
 from ..exceptions import ImageValidationFailed
 
+# The most images of the same WP a worker can receive in a single job
+MAX_JOB_BATCH = 8
 
 def convert_source_image_to_pil(source_image_b64):
     base64_bytes = source_image_b64.encode('utf-8')
@@ -245,17 +247,32 @@ class JobPop(JobPop):
             allow_unsafe_ipaddr = self.args.allow_unsafe_ipaddr,
             allow_post_processing = self.args.allow_post_processing,
             priority_usernames = self.priority_usernames,
+            check_in_digest = self.check_in_digest,
         )
 
+    def get_batch_size(self, wp):
+        '''Workers which declared a max_batch receive that many images of the same WP in a single job
+        as long as they can fit all of them in their max_pixels at once
+        '''
+        max_batch = max(1, min(self.args.max_batch, MAX_JOB_BATCH))
+        return max(1, min(max_batch, wp.n, self.worker.max_pixels // (wp.width * wp.height)))
+
     def get_sorted_wp(self):
         '''We're sending the lists directly, to avoid having to join tables'''
         return database.get_sorted_wp_filtered_to_worker(
             self.worker,
             self.models,
             self.blacklist,
+            priority_user_ids = self.priority_user_ids,
+            use_profile_cache = self.use_profile_cache,
         )
 
 
+class JobSubmitPop(JobSubmitPop, JobPop):
+    '''Uses the stable check-in and job selection of the JobPop above'''
+    pass
+
+
 class Aesthetics(Resource):
 
     post_parser = reqparse.RequestParser()
@@ -669,6 +686,9 @@ api.add_resource(AsyncCheck, "/generate/check/<string:id>")
 api.add_resource(Aesthetics, "/generate/rate/<string:id>")
 api.add_resource(JobPop, "/generate/pop")
 api.add_resource(JobSubmit, "/generate/submit")
+api.add_resource(ModelDemand, "/generate/demand")
+api.add_resource(JobSubmitBatch, "/generate/submit/batch")
+api.add_resource(JobSubmitPop, "/generate/submit/pop")
 api.add_resource(Users, "/users")
 api.add_resource(UserSingle, "/users/<string:user_id>")
 api.add_resource(FindUser, "/find_user")
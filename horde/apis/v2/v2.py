@@ -1,5 +1,6 @@
 import json
 import os
+import hashlib
 import regex as re
 import time
 import random
@@ -20,6 +21,8 @@ from horde.utils import is_profane, sanitize_string
 from horde.countermeasures import CounterMeasures
 from horde.horde_redis import horde_r
 from horde.patreon import patrons
+from horde.matchmaking import wait_for_queued_models
+from horde.worker_index import update_worker_capabilities
 
 # Not used yet
 authorizations = {
@@ -133,7 +136,7 @@ class GenerateTemplate(Resource):
             #logger.warning(datetime.utcnow())
             if self.args['prompt'] == '':
                 raise e.MissingPrompt(self.username)
-            if self.user.is_anon():
+            if self.user.is_anon() or self.user.is_pseudonymous():
                 wp_count = database.count_waiting_requests(self.user,self.args["models"])
                 #logger.warning(datetime.utcnow())
             else:
@@ -147,7 +150,7 @@ class GenerateTemplate(Resource):
             n = 1
             if self.args.params:
                 n = self.args.params.get('n',1)
-            user_limit = self.user.get_concurrency(self.args["models"],database.retrieve_available_models)
+            user_limit = self.user.get_concurrency(self.args["models"],database.retrieve_model_workers())
             #logger.warning(datetime.utcnow())
             if wp_count + n > user_limit:
                 raise e.TooManyPrompts(self.username, wp_count + n, user_limit)
@@ -393,6 +396,18 @@ class JobPopTemplate(Resource):
             self.worker.create()
         if self.user != self.worker.user:
             raise e.WrongCredentials(self.user.get_unique_alias(), self.worker_name)
+
+    def get_check_in_digest(self):
+        '''A digest of the configuration this worker is checking in with
+        The worker can skip re-applying its configuration when this has not changed
+        '''
+        # These change per request, but are not part of the worker configuration
+        request_args = ["apikey", "amount", "wait", "max_batch"]
+        check_in_config = {arg: value for arg, value in self.args.items() if arg not in request_args}
+        check_in_config["safe_ip"] = self.safe_ip
+        check_in_config["worker_ip"] = self.worker_ip
+        check_in_config["trusted"] = self.user.trusted
+        return hashlib.sha256(json.dumps(check_in_config, sort_keys=True, default=str).encode()).hexdigest()
             
 
 class JobPop(JobPopTemplate):
@@ -409,6 +424,11 @@ class JobPop(JobPopTemplate):
         '''
         # logger.warning(datetime.utcnow())
         self.args = parsers.job_pop_parser.parse_args()
+        self.prepare()
+        return self.pop()
+
+    def prepare(self):
+        '''Reads the worker configuration from the arguments and validates the worker'''
         # I have to extract and store them this way, because if I use the defaults
         # It causes them to be a shared object from the parsers class
         self.blacklist = []
@@ -422,9 +442,14 @@ class JobPop(JobPopTemplate):
             self.models = self.args.models
         self.worker_ip = request.remote_addr
         self.validate()
+
+    def pop(self):
+        '''Checks in the worker and claims its next jobs'''
         self.check_in()
-        # This ensures that the priority requested by the bridge is respected
-        self.prioritized_wp = []
+        update_worker_capabilities(self.worker)
+        # We never hand out more jobs than the worker has threads to run them
+        self.amount = max(1, min(self.args.amount, self.worker.threads))
+        self.wait = max(0, min(self.args.wait, 30))
         # self.priority_users = [self.user]
         ## Start prioritize by bridge request ##
 
@@ -439,21 +464,41 @@ class JobPop(JobPopTemplate):
         #     priority_user = database.find_user_by_username(priority_username)
         #     if priority_user:
         #        self.priority_users.append(priority_user)
+        ## End prioritize by bridge request ##
 
-        wp_list = db.session.query(WaitingPrompt).filter(WaitingPrompt.user_id.in_(self.priority_user_ids), WaitingPrompt.n > 0).all()
-        for wp in wp_list:
-            self.prioritized_wp.append(wp)
-        # for priority_user in self.priority_users:
-        #     wp_list = database.get_all_wps()
-        #     for wp in wp_list:
-        #         if wp.user == priority_user and wp.needs_gen():
-        #             self.prioritized_wp.append(wp)
+        self.use_profile_cache = True
+        self.popped_jobs = self.pop_jobs()
+        # When the worker asked to wait, we keep the request open until a WP for its models is queued
+        wait_until = time.time() + self.wait
+        while len(self.popped_jobs) == 0:
+            remaining_wait = wait_until - time.time()
+            if remaining_wait <= 0:
+                break
+            # We don't want to keep a transaction open while waiting
+            db.session.commit()
+            if not wait_for_queued_models(self.worker.get_model_names(), remaining_wait):
+                break
+            # The candidates cached for our profile might have been stored just before the WP which woke us up
+            self.use_profile_cache = False
+            self.popped_jobs = self.pop_jobs()
+        if len(self.popped_jobs) >= 1:
+            # Workers asking for a single job keep receiving it in the original format
+            if self.amount == 1:
+                return(self.popped_jobs[0], 200)
+            return({"id": None, "jobs": self.popped_jobs, "skipped": self.skipped}, 200)
+        # We report maintenance exception only if we couldn't find any jobs
+        if self.worker.maintenance:
+            raise e.WorkerMaintenance(self.worker.maintenance_msg)
         # logger.warning(datetime.utcnow())
-        ## End prioritize by bridge request ##
-        for wp in self.get_sorted_wp():
-            if wp not in self.prioritized_wp:
-                self.prioritized_wp.append(wp)
+        return({"id": None, "skipped": self.skipped}, 200)
+
+    def pop_jobs(self):
+        '''Scans the queue once and claims up to self.amount jobs for this worker'''
+        self.skipped = {}
+        # The WPs of the users prioritized by the bridge are sorted first
+        self.prioritized_wp = self.get_sorted_wp()
         # logger.warning(datetime.utcnow())
+        popped_jobs = []
         for wp in self.prioritized_wp:
             check_gen = self.worker.can_generate(wp)
             if not check_gen[0]:
@@ -465,26 +510,28 @@ class JobPop(JobPopTemplate):
                 #logger.warning(datetime.utcnow())
                 continue
             # There is a chance that by the time we finished all the checks, another worker picked up the WP. 
-            # So we do another final check here before picking it up to avoid sending the same WP to two workers by mistake.
-            # time.sleep(random.uniform(0, 1))
-            wp.refresh()
-            if not wp.needs_gen():  # this says if < 1
-                continue
-            worker_ret = self.start_worker(wp)
-            # logger.debug(worker_ret)
-            if worker_ret is None:
-                continue
-            # logger.debug(worker_ret)
-            return(worker_ret, 200)
-        # We report maintenance exception only if we couldn't find any jobs
-        if self.worker.maintenance:
-            raise e.WorkerMaintenance(self.worker.maintenance_msg)
-        # logger.warning(datetime.utcnow())
-        return({"id": None, "skipped": self.skipped}, 200)
+            # The claim in start_generation() will skip it in that case, and we move on to the next one.
+            # A WP which still needs more gens can give us more than one job
+            while wp.needs_gen() and len(popped_jobs) < self.amount:  # needs_gen says if < 1
+                worker_ret = self.start_worker(wp)
+                # logger.debug(worker_ret)
+                if worker_ret is None:
+                    break
+                popped_jobs.append(worker_ret)
+                # A paused worker only gets a single fake job per WP
+                if self.worker.paused:
+                    break
+            if len(popped_jobs) >= self.amount:
+                break
+        return popped_jobs
 
     def get_sorted_wp(self):
         '''Extendable class to retrieve the sorted WP list for this worker'''
-        return database.get_sorted_wp_filtered_to_worker(self.worker)
+        return database.get_sorted_wp_filtered_to_worker(
+            self.worker,
+            priority_user_ids = self.priority_user_ids,
+            use_profile_cache = self.use_profile_cache,
+        )
 
     # Making it into its own function to allow extension
     def start_worker(self, wp):
@@ -494,9 +541,13 @@ class JobPop(JobPopTemplate):
         if self.worker.paused and wp.user != self.worker.user:
             ret = wp.fake_generation(self.worker)
         else:
-            ret = wp.start_generation(self.worker)
+            ret = wp.start_generation(self.worker, amount = self.get_batch_size(wp))
         return(ret)
 
+    def get_batch_size(self, wp):
+        '''Extendable function to decide how many images of this WP to give to the worker in a single job'''
+        return 1
+
     # We split this to its own function so that it can be extended with the specific vars needed to check in
     # You typically never want to use this template's function without extending it
     def check_in(self):
@@ -504,16 +555,82 @@ class JobPop(JobPopTemplate):
             nsfw = self.args['nsfw'], 
             blacklist = self.args['blacklist'], 
             safe_ip = self.safe_ip, 
-            ipaddr = self.worker_ip)
+            ipaddr = self.worker_ip,
+            check_in_digest = self.check_in_digest)
 
     # We split this into its own function, so that it may be overriden and extended
     def validate(self, worker_class = Worker):
         super().validate(worker_class = worker_class)
+        self.check_in_digest = self.get_check_in_digest()
+        # We have already checked these models the last time this configuration was sent
+        if self.worker.is_check_in_unchanged(self.check_in_digest):
+            return
         for model in self.models:
             if is_profane(model) and not "Hentai" in model:
                 raise e.Profanity(self.user.get_unique_alias(), model, 'model name')
 
 
+class JobSubmitPop(JobPop):
+
+    decorators = [limiter.limit("60/second")]
+    @api.expect(parsers.job_pop_parser, models.input_model_job_submit_pop, validate=True)
+    @api.marshal_with(models.response_model_job_submit_pop, code=200, description='Generations Submitted and Popped')
+    @api.response(400, 'Validation Error', models.response_model_error)
+    @api.response(401, 'Invalid API Key', models.response_model_error)
+    @api.response(403, 'Access Denied', models.response_model_error)
+    @api.response(404, 'Request Not Found', models.response_model_error)
+    def post(self):
+        '''Submit generated images and check for the next generation requests, in a single request.
+        This endpoint is used by registered workers only
+        It takes the same arguments as the pop, along with the generations to submit.
+        Generations which have already been submitted or aborted receive 0 kudos.
+        '''
+        self.args = parsers.job_pop_parser.parse_args()
+        self.submit_args = parsers.job_submit_batch_parser.parse_args()
+        self.prepare()
+        self.submit()
+        pop_ret, code = self.pop()
+        pop_ret["reward"] = sum([r["reward"] for r in self.rewards])
+        pop_ret["generations"] = self.rewards
+        return(pop_ret, code)
+
+    def submit(self):
+        '''We validate all the generations before recording any of them. They all have to belong to this worker'''
+        procgen_ids = [generation["id"] for generation in self.submit_args.generations]
+        procgens = {str(procgen.id): procgen for procgen in database.get_progens_by_ids(procgen_ids)}
+        for procgen_id in procgen_ids:
+            procgen = procgens.get(procgen_id)
+            if not procgen:
+                raise e.InvalidJobID(procgen_id)
+            if procgen.worker_id != self.worker.id:
+                raise e.WrongCredentials(self.user.get_unique_alias(), procgen.worker.name)
+        self.rewards = record_generations(procgens, self.submit_args.generations)
+
+
+def record_generations(procgens, generations):
+    '''Records each submitted generation against its procgen and returns the reward for each
+    All the generations are recorded in a single transaction, so either all of them are rewarded or none
+    '''
+    rewards = []
+    try:
+        for generation in generations:
+            procgen = procgens[generation["id"]]
+            things_per_sec = stats.record_fulfilment(procgen, commit = False)
+            kudos = procgen.set_generation(
+                generation=generation['generation'], 
+                things_per_sec=things_per_sec, 
+                seed=generation.get('seed'),
+                censored=generation.get('censored', False),
+                commit=False,
+            )
+            rewards.append({"id": generation["id"], "reward": kudos})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return rewards
+
+
 class JobSubmit(Resource):
     decorators = [limiter.limit("60/second")]
     @api.expect(parsers.job_submit_parser)
@@ -546,10 +663,44 @@ class JobSubmit(Resource):
             seed=self.args.seed,
             censored=self.args.censored,
         )
-        if self.kudos == 0 and not self.procgen.worker.maintenance:
+        # A worker which was outrun by a hedged duplicate did nothing wrong, so it just receives no kudos
+        if self.kudos == 0 and not self.procgen.worker.maintenance and not self.procgen.is_outrun_duplicate():
             raise e.DuplicateGen(self.procgen.worker.name, self.args['id'])
 
 
+class JobSubmitBatch(Resource):
+    decorators = [limiter.limit("60/second")]
+    @api.expect(parsers.job_submit_batch_parser, models.input_model_job_submit_batch, validate=True)
+    @api.marshal_with(models.response_model_job_submit_batch, code=200, description='Generations Submitted')
+    @api.response(400, 'Validation Error', models.response_model_error)
+    @api.response(401, 'Invalid API Key', models.response_model_error)
+    @api.response(403, 'Access Denied', models.response_model_error)
+    @api.response(404, 'Request Not Found', models.response_model_error)
+    def post(self):
+        '''Submit multiple generated images at once.
+        This endpoint is used by registered workers only
+        Generations which have already been submitted or aborted receive 0 kudos.
+        '''
+        self.args = parsers.job_submit_batch_parser.parse_args()
+        self.validate()
+        self.rewards = record_generations(self.procgens, self.args.generations)
+        return({"reward": sum([r["reward"] for r in self.rewards]), "generations": self.rewards}, 200)
+
+    def validate(self):
+        '''We validate all the generations before recording any of them, so that a bad entry doesn't leave the batch half-submitted'''
+        self.user = database.find_user_by_api_key(self.args['apikey'])
+        if not self.user:
+            raise e.InvalidAPIKey('worker batch submit')
+        procgen_ids = [generation["id"] for generation in self.args.generations]
+        self.procgens = {str(procgen.id): procgen for procgen in database.get_progens_by_ids(procgen_ids)}
+        for procgen_id in procgen_ids:
+            procgen = self.procgens.get(procgen_id)
+            if not procgen:
+                raise e.InvalidJobID(procgen_id)
+            if self.user != procgen.worker.user:
+                raise e.WrongCredentials(self.user.get_unique_alias(), procgen.worker.name)
+
+
 class TransferKudos(Resource):
     parser = reqparse.RequestParser()
     parser.add_argument("apikey", type=str, required=True, help="The sending user's API key", location='headers')
@@ -975,6 +1126,35 @@ class Models(Resource):
         return(database.retrieve_available_models(),200)
 
 
+class ModelDemand(Resource):
+    get_parser = reqparse.RequestParser()
+    get_parser.add_argument("Client-Agent", default="unknown:0:unknown", type=str, required=False, help="The client name and version", location="headers")
+    get_parser.add_argument("worker_id", type=str, required=False, help="If specified, will suggest models which this worker could add", location="args")
+
+    # How many models we suggest to each worker
+    SUGGESTED_MODELS = 5
+
+    @logger.catch(reraise=True)
+    @cache.cached(timeout=2, query_string=True)
+    @api.expect(get_parser)
+    @api.marshal_with(models.response_model_demand, code=200, description='Model Demand')
+    @api.response(404, 'Worker Not Found', models.response_model_error)
+    def get(self):
+        '''Returns the models waiting to be generated, ordered by how backlogged they are
+        Workers can use this to decide which models to load
+        '''
+        self.args = self.get_parser.parse_args()
+        model_demand = database.retrieve_model_demand()
+        suggested_models = []
+        if self.args.worker_id:
+            worker = database.find_worker_by_id(self.args.worker_id)
+            if not worker:
+                raise e.WorkerNotFound(self.args.worker_id)
+            worker_models = set(worker.get_model_names())
+            suggested_models = [m["name"] for m in model_demand if m["name"] not in worker_models][:self.SUGGESTED_MODELS]
+        return({"models": model_demand, "suggested_models": suggested_models},200)
+
+
 class HordeLoad(Resource):
     get_parser = reqparse.RequestParser()
     get_parser.add_argument("Client-Agent", default="unknown:0:unknown", type=str, required=False, help="The client name and version", location="headers")
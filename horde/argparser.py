@@ -13,6 +13,9 @@ arg_parser.add_argument('--worker_invite', action="store_true", help="If set, Wi
 arg_parser.add_argument('--raid', action="store_true", help="If set, Will start the horde in raid prevention mode")
 arg_parser.add_argument('--allow_all_ips', action="store_true", help="If set, will consider all IPs safe")
 arg_parser.add_argument('--quorum', action="store_true", help="If set, will forcefully grab the quorum")
+arg_parser.add_argument('--hedge_jobs', action="store_true", help="If set, the last straggling job of a multi-job request will also be offered to a faster worker, and the first result wins")
+arg_parser.add_argument('--assignment_policy', action='store', default='priority', required=False, type=str, choices=['priority', 'fit'], help="How the queue is ordered for each worker. 'priority' strictly follows the queue order. 'fit' also takes into account the job size and the worker speed and max_pixels.")
+arg_parser.add_argument('--queue_order', action='store', default='priority', required=False, type=str, choices=['priority', 'sjf'], help="How the queue is ordered. 'priority' serves WPs of equal priority in the order they arrived. 'sjf' groups the WPs into priority bands, and within each band serves first the WPs with the least work remaining.")
 args = arg_parser.parse_args()
 
 maintenance = Switch()
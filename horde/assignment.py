@@ -0,0 +1,100 @@
+from bisect import bisect_left
+
+# This module is kept free of any horde imports, so that the policy can be simulated on its own
+# with tools/benchmark_assignment.py
+
+# priority: The worker always takes the first WP it can generate, in queue order
+# fit: The queue order is adjusted to the size of the WPs and the speed and max_pixels of the worker
+ASSIGNMENT_POLICIES = ["priority", "fit"]
+# A WP can only be moved this many positions forwards or backwards from its place in the queue
+# So no WP can be overtaken by a WP queued more than twice as many positions behind it
+MAX_POSITION_SHIFT = 10
+# Jobs which are expected to take longer than this fraction of their TTL on a worker, are pushed back for it
+SLOW_JOB_TTL_FRACTION = 0.5
+# How much weight each new job outcome has on the rolling reliability of a worker
+RELIABILITY_ALPHA = 0.1
+# Workers with a reliability score under this are moved away from time-sensitive WPs
+RELIABILITY_THRESHOLD = 0.8
+# priority: WPs are served in priority order, and the ones of equal priority in the order they arrived
+# sjf: WPs are grouped into bands of similar priority, and within each band the smallest remaining work is served first
+QUEUE_ORDERS = ["priority", "sjf"]
+# As WPs gain 5 priority per second they wait, each band covers WPs of equal kudos which arrived within 100 seconds of each other
+# This is what prevents large WPs from starving, as the WPs arriving after them eventually fall into a lower band
+PRIORITY_BAND_SIZE = 500
+
+
+def get_capacity_share(worker_capacities, max_pixels):
+    '''Returns the fraction of the active workers which can generate at least max_pixels
+    worker_capacities has to be the sorted list of the max_pixels of all active workers
+    '''
+    if len(worker_capacities) == 0:
+        return 1
+    return (len(worker_capacities) - bisect_left(worker_capacities, max_pixels)) / len(worker_capacities)
+
+
+def get_assignment_shift(
+        job_pixels,
+        job_things,
+        job_ttl,
+        worker_max_pixels,
+        worker_speed,
+        capacity_share,
+        average_speed,
+    ):
+    '''Returns how many positions a WP should be moved forwards (positive) or backwards (negative)
+    in the queue of this worker.
+    worker_speed and average_speed are in things per second. worker_speed is None when we have not measured it yet.
+    '''
+    size_fit = min(job_pixels / worker_max_pixels, 1)
+    # The fewer the workers which can do what this worker can do,
+    # the more it should keep its capacity for the jobs which need it
+    preference = size_fit * (1 - capacity_share)
+    if worker_speed is None:
+        return min(preference, 1) * MAX_POSITION_SHIFT
+    # Faster than average workers should take on the larger jobs
+    if average_speed:
+        preference += size_fit * min(max(worker_speed / average_speed - 1, 0), 1)
+    # Jobs which are likely to time out on this worker should be left to faster ones
+    if job_things / worker_speed > job_ttl * SLOW_JOB_TTL_FRACTION:
+        return -MAX_POSITION_SHIFT
+    return min(preference, 1) * MAX_POSITION_SHIFT
+
+
+def get_priority_band(queue_priority):
+    '''This truncates like the integer division in the DB, so that both agree on the bands'''
+    return int(queue_priority / PRIORITY_BAND_SIZE)
+
+
+def get_queue_order_key(queue_order, queue_priority, things, n, created):
+    '''Returns the key by which to sort the WPs in ascending order, for this queue order'''
+    if queue_order == "sjf":
+        return (-get_priority_band(queue_priority), things * n, created)
+    return (-queue_priority, created)
+
+
+def update_ewma(current, value, alpha = RELIABILITY_ALPHA):
+    return current + alpha * (value - current)
+
+
+def get_reliability_score(completion_rate, ttl_usage):
+    '''Combines the rolling completion rate of a worker with how much of the job TTL it tends to use
+    Returns a score between 0 and 1
+    '''
+    # Workers which deliver within half the TTL are not penalized for their speed
+    if ttl_usage <= SLOW_JOB_TTL_FRACTION:
+        return completion_rate
+    return completion_rate * max(1 - ttl_usage, 0) / (1 - SLOW_JOB_TTL_FRACTION)
+
+
+def get_reliability_shift(reliability_score, time_sensitive):
+    '''Returns how many positions a WP should be moved backwards for an unreliable worker'''
+    if not time_sensitive or reliability_score >= RELIABILITY_THRESHOLD:
+        return 0
+    return -MAX_POSITION_SHIFT * (RELIABILITY_THRESHOLD - reliability_score) / RELIABILITY_THRESHOLD
+
+
+def order_by_shift(candidates, shifts):
+    '''Reorders the candidates according to their shifts, keeping their queue order otherwise'''
+    shifts = [min(max(shift, -MAX_POSITION_SHIFT), MAX_POSITION_SHIFT) for shift in shifts]
+    order = sorted(range(len(candidates)), key=lambda i: (i - shifts[i], i))
+    return [candidates[i] for i in order]
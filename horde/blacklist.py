@@ -0,0 +1,88 @@
+from collections import deque
+
+# The compiled blacklist matcher of each worker in this process, along with the words it was compiled from
+# and the check-in digest of the worker configuration those words came from
+worker_matchers = {}
+
+
+class BlacklistMatcher:
+    '''Aho-Corasick automaton which finds if any of the blacklisted words appears in a text
+    This allows us to check a prompt against all of a worker's blacklisted words in one pass
+    '''
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.matches = [False]
+        for word in words:
+            word = word.lower()
+            # An empty word would match every prompt
+            if word == '':
+                continue
+            self.add_word(word)
+        self.build_fail_links()
+
+    def add_word(self, word):
+        state = 0
+        for char in word:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.matches.append(False)
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.matches[state] = True
+
+    def build_fail_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                # A state also matches if any of its suffixes is a complete word
+                if self.matches[self.fail[next_state]]:
+                    self.matches[next_state] = True
+
+    def is_empty(self):
+        return len(self.goto) == 1
+
+    def search(self, text):
+        '''Returns True if any of the words appear in the text. The text is expected to be lowercase already'''
+        if self.is_empty():
+            return False
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.matches[state]:
+                return True
+        return False
+
+
+def get_worker_matcher(worker_id, words, check_in_digest = None):
+    '''Returns the compiled matcher for this worker's blacklist
+    We only recompile it when the words are different from the ones we have cached
+    '''
+    words = frozenset(words)
+    cached = worker_matchers.get(worker_id)
+    if cached is not None and cached[0] == words:
+        if check_in_digest is not None and cached[1] != check_in_digest:
+            worker_matchers[worker_id] = (words, check_in_digest, cached[2])
+        return cached[2]
+    matcher = BlacklistMatcher(words)
+    worker_matchers[worker_id] = (words, check_in_digest, matcher)
+    return matcher
+
+
+def get_digest_matcher(worker_id, check_in_digest):
+    '''Returns the matcher we compiled for the worker configuration with this check-in digest
+    Returns None when this process hasn't compiled it yet
+    '''
+    cached = worker_matchers.get(worker_id)
+    if cached is None or check_in_digest is None or cached[1] != check_in_digest:
+        return None
+    return cached[2]
@@ -52,6 +52,10 @@ with HORDE.app_context():
     if args.convert_flag == "SQL":
         from horde.conversions import convert_json_db
         convert_json_db()
+    # Existing deployments need to run this once, after upgrading to the model registry
+    if args.convert_flag == "model_registry":
+        from horde.conversions import convert_model_registry
+        convert_model_registry()
 
     anon = db.session.query(User).filter_by(oauth_id="anon").first()
     if not anon:
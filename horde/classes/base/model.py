@@ -0,0 +1,117 @@
+import hashlib
+
+from sqlalchemy.exc import IntegrityError
+
+from horde.logger import logger
+from horde.flask import db
+
+# Model ids and model sets never change once created, so we can cache them for the life of the process
+model_ids_by_name = {}
+model_names_by_id = {}
+model_set_ids_by_digest = {}
+model_set_members = {}
+
+
+class RegisteredModel(db.Model):
+    '''Every model name ever requested or served is stored only once here'''
+    __tablename__ = "models"
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), unique=True, nullable=False, index=True)
+
+
+class ModelSet(db.Model):
+    '''A unique combination of models. Workers serving the same models share the same set'''
+    __tablename__ = "model_sets"
+    id = db.Column(db.Integer, primary_key=True)
+    # A hash of the sorted model ids in this set
+    digest = db.Column(db.String(64), unique=True, nullable=False, index=True)
+    members = db.relationship("ModelSetMember", back_populates="model_set", cascade="all, delete-orphan")
+
+
+class ModelSetMember(db.Model):
+    __tablename__ = "model_set_members"
+    __table_args__ = (db.UniqueConstraint('model_set_id', 'model_id', name='model_set_member_uc'),)
+    id = db.Column(db.Integer, primary_key=True)
+    model_set_id = db.Column(db.Integer, db.ForeignKey("model_sets.id", ondelete="CASCADE"), nullable=False, index=True)
+    model_set = db.relationship("ModelSet", back_populates="members")
+    model_id = db.Column(db.Integer, db.ForeignKey("models.id"), nullable=False, index=True)
+
+
+def get_model_id(model_name, create = True):
+    '''Returns the id of this model name, registering it if it doesn't exist yet
+    If create is False, it returns None for unknown models instead
+    '''
+    if model_name in model_ids_by_name:
+        return model_ids_by_name[model_name]
+    model = db.session.query(RegisteredModel).filter_by(name=model_name).first()
+    if not model:
+        if not create:
+            return None
+        # Another node might be registering the same model at the same time
+        # so we do it in a savepoint to avoid rolling back the caller's transaction
+        try:
+            with db.session.begin_nested():
+                model = RegisteredModel(name=model_name)
+                db.session.add(model)
+        except IntegrityError:
+            model = db.session.query(RegisteredModel).filter_by(name=model_name).first()
+    model_ids_by_name[model.name] = model.id
+    model_names_by_id[model.id] = model.name
+    return model.id
+
+
+def get_model_ids(model_names, create = True):
+    '''Returns the ids of these model names. When create is False, unknown model names are ignored'''
+    model_ids = []
+    for model_name in model_names:
+        model_id = get_model_id(model_name, create)
+        if model_id is not None:
+            model_ids.append(model_id)
+    return model_ids
+
+
+def get_model_names(model_ids):
+    missing_ids = [model_id for model_id in model_ids if model_id not in model_names_by_id]
+    if len(missing_ids) > 0:
+        for model in db.session.query(RegisteredModel).filter(RegisteredModel.id.in_(missing_ids)).all():
+            model_ids_by_name[model.name] = model.id
+            model_names_by_id[model.id] = model.name
+    return [model_names_by_id[model_id] for model_id in model_ids if model_id in model_names_by_id]
+
+
+def get_model_set_id(model_names):
+    '''Returns the id of the model set containing exactly these model names, creating it if needed'''
+    model_ids = sorted(set(get_model_ids(model_names)))
+    digest = hashlib.sha256(",".join([str(model_id) for model_id in model_ids]).encode()).hexdigest()
+    if digest in model_set_ids_by_digest:
+        return model_set_ids_by_digest[digest]
+    model_set = db.session.query(ModelSet).filter_by(digest=digest).first()
+    if not model_set:
+        try:
+            with db.session.begin_nested():
+                model_set = ModelSet(digest=digest)
+                db.session.add(model_set)
+                db.session.flush()
+                for model_id in model_ids:
+                    db.session.add(ModelSetMember(model_set_id=model_set.id, model_id=model_id))
+            logger.debug(f"Registered new model set {model_set.id} with {len(model_ids)} models")
+        except IntegrityError:
+            model_set = db.session.query(ModelSet).filter_by(digest=digest).first()
+    model_set_ids_by_digest[digest] = model_set.id
+    model_set_members[model_set.id] = model_ids
+    return model_set.id
+
+
+def get_model_set_model_ids(model_set_id):
+    '''Returns the model ids in this model set'''
+    if model_set_id is None:
+        return []
+    if model_set_id not in model_set_members:
+        model_ids = db.session.query(ModelSetMember.model_id).filter(ModelSetMember.model_set_id == model_set_id).all()
+        model_set_members[model_set_id] = sorted([m.model_id for m in model_ids])
+    return model_set_members[model_set_id]
+
+
+def get_model_set_names(model_set_id):
+    '''Returns the model names in this model set'''
+    return get_model_names(get_model_set_model_ids(model_set_id))
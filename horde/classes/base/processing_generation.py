@@ -6,6 +6,7 @@ from sqlalchemy.dialects.postgresql import JSONB, UUID
 from horde.utils import get_db_uuid
 from horde.logger import logger
 from horde.flask import db, SQLITE_MODE
+from horde.classes.base.stats import get_model_throughput
 
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)
 
@@ -18,6 +19,12 @@ class ProcessingGeneration(db.Model):
     model = db.Column(db.String(40), default='', nullable=False)
     seed = db.Column(db.BigInteger, default=0, nullable=False)
     start_time = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # When this generation is considered stale, based on the speed of the worker which picked it up
+    deadline = db.Column(db.DateTime, default=None, nullable=True, index=True)
+    # The first job of a worker on a model gets the whole job TTL, and its expiry does not affect the worker's reliability
+    first_job = db.Column(db.Boolean, default=False, nullable=False)
+    # How many images of the same WP were given to the worker in the same job as this one
+    batch_size = db.Column(db.Integer, default=1, nullable=False)
 
     cancelled = db.Column(db.Boolean, default=False, nullable=False)
     faulted = db.Column(db.Boolean, default=False, nullable=False)
@@ -29,24 +36,29 @@ class ProcessingGeneration(db.Model):
     worker = db.relationship("WorkerExtended", back_populates="processing_gens")
     created = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, commit = True, **kwargs):
+        '''When commit is False, the caller has to commit this procgen along with the rest of its transaction'''
         super().__init__(*args, **kwargs)
-        # If there has been no explicit model requested by the user, we just choose the first available from the worker
         db.session.add(self)
-        db.session.commit()
-        worker_models = self.worker.get_model_names()
-        if len(worker_models):
-            self.model = worker_models[0]
-        else:
-            self.model = ''
-        # If we reached this point, it means there is at least 1 matching model between worker and client
-        # so we pick the first one.
-        for model in self.wp.get_model_names():
-            if model in worker_models:
-                self.model = model
-        db.session.commit()
-
-    def set_generation(self, generation, things_per_sec, **kwargs):
+        # If there has been no explicit model requested by the user, we just choose the first available from the worker
+        if "model" not in kwargs:
+            # We need to flush so that the worker and wp relationships can be loaded
+            db.session.flush()
+            worker_models = self.worker.get_model_names()
+            if len(worker_models):
+                self.model = worker_models[0]
+            else:
+                self.model = ''
+            # If we reached this point, it means there is at least 1 matching model between worker and client
+            # so we pick the first one.
+            for model in self.wp.get_model_names():
+                if model in worker_models:
+                    self.model = model
+        if commit:
+            db.session.commit()
+
+    def set_generation(self, generation, things_per_sec, commit = True, **kwargs):
+        '''When commit is False, the caller has to commit after recording all its generations'''
         if self.is_completed() or self.is_faulted():
             return(0)
         self.generation = generation
@@ -54,8 +66,16 @@ class ProcessingGeneration(db.Model):
         self.seed = kwargs.get('seed', None)
         kudos = self.get_gen_kudos()
         self.cancelled = False
-        self.record(things_per_sec, kudos)
-        db.session.commit()
+        self.worker.record_job_outcome(
+            completed = True,
+            ttl_usage = (datetime.utcnow() - self.start_time).total_seconds() / (self.wp.job_ttl * self.batch_size),
+        )
+        self.worker.record_delivered_model(self.model)
+        self.record(things_per_sec, kudos, commit = False)
+        if self.wp.hedges > 0:
+            self.wp.resolve_hedges(commit = False)
+        if commit:
+            db.session.commit()
         return(kudos)
         
 
@@ -72,25 +92,35 @@ class ProcessingGeneration(db.Model):
         db.session.commit()
         return(kudos)
     
-    def record(self, things_per_sec, kudos):
+    def record(self, things_per_sec, kudos, commit = True):
         cancel_txt = ""
         if self.cancelled:
             cancel_txt = " Cancelled"
         if self.fake and self.worker.user == self.wp.user:
             # We do not record usage for paused workers, unless the requestor was the same owner as the worker
-            self.worker.record_contribution(raw_things = self.wp.things, kudos = kudos, things_per_sec = things_per_sec)
+            self.worker.record_contribution(raw_things = self.wp.things, kudos = kudos, things_per_sec = things_per_sec, commit = commit)
             logger.info(f"Fake{cancel_txt} Generation {self.id} worth {self.kudos} kudos, delivered by worker: {self.worker.name} for wp {self.wp.id}")
         else:
-            self.worker.record_contribution(raw_things = self.wp.things, kudos = kudos, things_per_sec = things_per_sec)
-            self.wp.record_usage(raw_things = self.wp.things, kudos = kudos)
+            self.worker.record_contribution(raw_things = self.wp.things, kudos = kudos, things_per_sec = things_per_sec, commit = commit)
+            self.wp.record_usage(raw_things = self.wp.things, kudos = kudos, commit = commit)
             logger.info(f"New{cancel_txt} Generation {self.id} worth {kudos} kudos, delivered by worker: {self.worker.name} for wp {self.wp.id}")
 
+    def cancel_duplicate(self):
+        '''Stops a duplicate generation which another worker delivered first
+        Neither the worker is rewarded nor the requestor charged for it
+        '''
+        if self.is_completed() or self.is_faulted():
+            return
+        self.faulted = True
+        self.cancelled = True
+        logger.info(f"Cancelled Duplicate Generation {self.id} from worker: {self.worker.name} ({self.worker.id})")
+
     def abort(self):
         '''Called when this request needs to be stopped without rewarding kudos. Say because it timed out due to a worker crash'''
         if self.is_completed() or self.is_faulted():
             return        
         self.faulted = True
-        self.worker.log_aborted_job()
+        self.worker.log_aborted_job(record_outcome = not self.first_job)
         self.log_aborted_generation()
         db.session.commit()
         
@@ -113,6 +143,8 @@ class ProcessingGeneration(db.Model):
     def is_stale(self, ttl):
         if self.is_completed() or self.is_faulted():
             return False
+        if self.deadline is not None:
+            return datetime.utcnow() > self.deadline
         return (datetime.utcnow() - self.start_time).seconds > ttl
 
     def delete(self):
@@ -120,7 +152,27 @@ class ProcessingGeneration(db.Model):
         db.session.commit()
 
     def get_seconds_needed(self):
-        return(self.wp.things / self.worker.get_performance_average())
+        # We prefer the forecast for this model and job size, as the worker average does not take either into account
+        things_per_sec = get_model_throughput(self.model, self.wp.things)
+        if not things_per_sec:
+            things_per_sec = self.worker.get_performance_average()
+        return(self.wp.things * self.batch_size / things_per_sec)
+
+    def is_straggling(self):
+        '''Returns True once this job has been running for longer than 95% of the jobs of its model and size
+        We never consider a job straggling when we don't have a forecast for it
+        '''
+        if self.is_completed() or self.is_faulted():
+            return False
+        things_per_sec = get_model_throughput(self.model, self.wp.things, estimate = "p05")
+        if not things_per_sec:
+            return False
+        seconds_elapsed = (datetime.utcnow() - self.start_time).total_seconds()
+        return seconds_elapsed > self.wp.things * self.batch_size / things_per_sec
+
+    def is_outrun_duplicate(self):
+        '''Returns True if this job was cancelled because another worker delivered the hedged WP first'''
+        return self.cancelled and self.generation is None and self.wp.hedges > 0
 
     def get_expected_time_left(self):
         if self.is_completed():
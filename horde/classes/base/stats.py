@@ -1,16 +1,37 @@
 
+import json
+import time
 from datetime import datetime, timedelta
 
 from horde.logger import logger
 from horde.flask import db
 from horde.vars import thing_divisor
 from horde.argparser import args
+from horde.horde_redis import horde_r
+from horde.forecast import FORECAST_ALPHA, get_size_bucket, update_forecast, get_forecast_throughput
+
+FORECASTS_KEY = "model_forecasts"
+# How often each node reloads the forecasts from redis
+LOCAL_FORECASTS_SECONDS = 5
+# Only used by the primary, which updates the forecasts with the performances recorded since its last update
+forecast_state = {
+    "last_id": None,
+    "models": {},
+    "horde_throughput": None,
+}
+local_forecasts = {
+    "time": 0,
+    "models": {},
+    "horde_throughput": None,
+}
 
 class ModelPerformance(db.Model):
     __tablename__ = "model_performances"
     id = db.Column(db.Integer, primary_key=True)
     model = db.Column(db.String(30), index=True)
     performance = db.Column(db.Float)
+    # See forecast.get_size_bucket()
+    size_bucket = db.Column(db.Integer, nullable=True)
     created = db.Column(db.DateTime(timezone=False), default=datetime.utcnow)  # Maybe index this, but I'm not actually sure how big this table is
 
 class FulfillmentPerformance(db.Model):
@@ -21,7 +42,7 @@ class FulfillmentPerformance(db.Model):
     created = db.Column(db.DateTime, default=datetime.utcnow)
 
 
-def record_fulfilment(procgen):
+def record_fulfilment(procgen, commit = True):
     things = procgen.wp.things
     starting_time = procgen.start_time
     model = procgen.model
@@ -29,12 +50,14 @@ def record_fulfilment(procgen):
     if seconds_taken == 0:
         things_per_sec = 1
     else:
-        things_per_sec = round(things / seconds_taken,1)
-    new_performance = ModelPerformance(model=model,performance=things_per_sec)
+        # All the images of a batched job share the same generation time
+        things_per_sec = round(things * procgen.batch_size / seconds_taken,1)
+    new_performance = ModelPerformance(model=model,performance=things_per_sec,size_bucket=get_size_bucket(things))
     new_fulfillment = FulfillmentPerformance(things=things)
     db.session.add(new_performance)
     db.session.add(new_fulfillment)
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return(things_per_sec)
 
 def get_things_per_min():
@@ -56,14 +79,71 @@ def get_request_avg(worker_performances):
     return(round(avg,1))
 
 def get_model_avg(model):
-    return 1000000 #TODO
-    # TODO: Add the sum / coun calculation as part of the query
-    model_performances = db.session.query(ModelPerformance).filter_by(
-        model=model_name
-    ).order_by(
-        ModelPerformance.created.desc()
-    ).limit(10)
-    if model_performances.count() == 0:
+    '''Returns the average things per second of this model, or 0 if we do not know it yet'''
+    model_estimate = get_forecasts()["models"].get(model, {}).get("all")
+    if model_estimate is None:
         return 0
-    avg = sum([m.performance for m in model_performances]) / model_performances.count()
-    return(round(avg,1))
\ No newline at end of file
+    return(round(model_estimate["ewma"],1))
+
+def update_forecasts():
+    '''Feeds the performances recorded since the last update into the forecasts and stores them horde-wide
+    This should only run on the primary
+    '''
+    performances_query = db.session.query(
+        ModelPerformance.id,
+        ModelPerformance.model,
+        ModelPerformance.size_bucket,
+        ModelPerformance.performance,
+    ).filter(
+        ModelPerformance.size_bucket != None,
+    )
+    # After a restart, we rebuild the forecasts from the history we still have
+    if forecast_state["last_id"] is not None:
+        performances_query = performances_query.filter(ModelPerformance.id > forecast_state["last_id"])
+    performances = performances_query.order_by(ModelPerformance.id.asc()).all()
+    for performance in performances:
+        update_forecast(forecast_state["models"], performance.model, performance.size_bucket, performance.performance)
+    if len(performances) > 0:
+        forecast_state["last_id"] = performances[-1].id
+    # How many things the whole horde delivered per second in the past minute
+    delivered_things = db.session.query(
+        db.func.sum(FulfillmentPerformance.things)
+    ).filter(
+        FulfillmentPerformance.created >= datetime.utcnow() - timedelta(seconds=60)
+    ).scalar() or 0
+    if forecast_state["horde_throughput"] is None:
+        forecast_state["horde_throughput"] = delivered_things / 60
+    else:
+        forecast_state["horde_throughput"] += FORECAST_ALPHA * (delivered_things / 60 - forecast_state["horde_throughput"])
+    if horde_r is None:
+        return
+    forecasts = {
+        "models": forecast_state["models"],
+        "horde_throughput": forecast_state["horde_throughput"],
+    }
+    horde_r.set(FORECASTS_KEY, json.dumps(forecasts))
+
+def get_forecasts():
+    '''Returns this node's copy of the forecasts, which it refreshes from redis every few seconds'''
+    if horde_r is None or time.time() - local_forecasts["time"] < LOCAL_FORECASTS_SECONDS:
+        return local_forecasts
+    local_forecasts["time"] = time.time()
+    cached_forecasts = horde_r.get(FORECASTS_KEY)
+    if cached_forecasts is None:
+        return local_forecasts
+    try:
+        forecasts = json.loads(cached_forecasts)
+    except (TypeError, ValueError) as err:
+        logger.error(f"Failed deserializing the forecasts with error: {err}")
+        return local_forecasts
+    local_forecasts["models"] = forecasts["models"]
+    local_forecasts["horde_throughput"] = forecasts["horde_throughput"]
+    return local_forecasts
+
+def get_model_throughput(model, things, estimate = "p50"):
+    '''Returns the expected things per second for a job of this size on this model, or None if we do not know it yet'''
+    return get_forecast_throughput(get_forecasts()["models"], model, things, estimate)
+
+def get_horde_throughput():
+    '''Returns how many things per second the horde has been delivering lately, or None if we do not know it yet'''
+    return get_forecasts()["horde_throughput"]
\ No newline at end of file
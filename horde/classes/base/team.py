@@ -101,12 +101,13 @@ class Team(db.Model):
         self.last_active = datetime.utcnow()
         db.session.commit()
     
-    def record_contribution(self, contributions, kudos):
+    def record_contribution(self, contributions, kudos, commit = True):
         self.contributions = round(self.contributions + contributions, 2)
         self.fulfilments += 1
         self.kudos = round(self.kudos + kudos, 2)
         self.last_active = datetime.utcnow()
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
    # Should be extended by each specific horde
     @logger.catch(reraise=True)
@@ -113,12 +113,13 @@ class User(db.Model):
         db.session.commit()
         return("OK")
 
-    def set_trusted(self,is_trusted):
+    def set_trusted(self,is_trusted, commit = True):
         # Anonymous can never be trusted
         if self.is_anon():
             return
         self.trusted = is_trusted
-        db.session.commit()
+        if commit:
+            db.session.commit()
         if self.trusted:
             for worker in self.workers:
                 worker.paused = False
@@ -135,14 +136,15 @@ class User(db.Model):
     def get_unique_alias(self):
         return(f"{self.username}#{self.id}")
 
-    def record_usage(self, raw_things, kudos):
+    def record_usage(self, raw_things, kudos, commit = True):
         self.last_active = datetime.utcnow()
         self.usage_requests += 1
-        self.modify_kudos(-kudos,"accumulated")
+        self.modify_kudos(-kudos,"accumulated", commit = commit)
         self.usage_thing = round(self.usage_thing + (raw_things * self.usage_multiplier / thing_divisor),2)
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
-    def record_contributions(self, raw_things, kudos):
+    def record_contributions(self, raw_things, kudos, commit = True):
         self.last_active = datetime.utcnow()
         self.contributed_fulfillments += 1
         # While a worker is untrusted, half of all generated kudos go for evaluation
@@ -150,12 +152,13 @@ class User(db.Model):
             kudos_eval = round(kudos / 2)
             kudos -= kudos_eval
             self.evaluating_kudos += kudos_eval
-            self.modify_kudos(kudos,"accumulated")
-            self.check_for_trust()
+            self.modify_kudos(kudos,"accumulated", commit = commit)
+            self.check_for_trust(commit = commit)
         else:
-            self.modify_kudos(kudos,"accumulated")
+            self.modify_kudos(kudos,"accumulated", commit = commit)
         self.contributed_thing = round(self.contributed_thing + raw_things/thing_divisor,2)
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
     def record_uptime(self, kudos):
         self.last_active = datetime.utcnow()
@@ -166,15 +169,15 @@ class User(db.Model):
         else:
             self.modify_kudos(kudos,"accumulated")
 
-    def check_for_trust(self):
+    def check_for_trust(self, commit = True):
         '''After a user passes the evaluation threshold (?? kudos)
         All the evaluating Kudos added to their total and they automatically become trusted
         Suspicious users do not automatically pass evaluation
         '''
         if self.evaluating_kudos >= int(os.getenv("KUDOS_TRUST_THRESHOLD")) and not self.is_suspicious() and not self.is_anon():
-            self.modify_kudos(self.evaluating_kudos,"accumulated")
+            self.modify_kudos(self.evaluating_kudos,"accumulated", commit = commit)
             self.evaluating_kudos = 0
-            self.set_trusted(True)
+            self.set_trusted(True, commit = commit)
 
     def modify_monthly_kudos(self, monthly_kudos):
         # We always give upfront the monthly kudos to the user once.
@@ -210,7 +213,7 @@ class User(db.Model):
         base_amount += patrons.get_monthly_kudos(self.id)
         return(base_amount)
 
-    def modify_kudos(self, kudos, action = 'accumulated'):
+    def modify_kudos(self, kudos, action = 'accumulated', commit = True):
         logger.debug(f"modifying existing {self.kudos} kudos of {self.get_unique_alias()} by {kudos} for {action}")
         self.kudos = round(self.kudos + kudos, 2)
         self.ensure_kudos_positive()
@@ -218,9 +221,9 @@ class User(db.Model):
         if not kudos_details:
             kudos_details = UserStats(user_id=self.id, action=action, value=round(kudos, 2))
             db.session.add(kudos_details)
-            db.session.commit()
         else:
             kudos_details.value = round(kudos_details.value + kudos, 2)
+        if commit:
             db.session.commit()
 
     def ensure_kudos_positive(self):
@@ -242,25 +245,23 @@ class User(db.Model):
         except ValueError:
             return(False)
 
-    def get_concurrency(self, models_requested = None, models_dict = None):
+    def get_concurrency(self, models_requested = None, model_workers = None):
+        '''model_workers is a dict with the list of active worker ids serving each model'''
         if not models_requested: models_requested=[]
-        if not models_dict: models_dict={}
-        if not self.is_anon() or len(models_requested) == 0:
+        if not (self.is_anon() or self.is_pseudonymous()) or len(models_requested) == 0:
+            return(self.concurrency)
+        # If we don't know which workers are active, we cannot limit by them
+        if not model_workers:
             return(self.concurrency)
-        return self.concurrency # FIXME: For this to work, each model_dict needs to contain a list of worker ids in the "workers" key
-        found_workers = []
+        found_workers = set()
         for model_name in models_requested:
-            model_dict = models_dict.get(model_name)
-            if model_dict:
-                for worker in model_dict["workers"]:
-                    if worker not in found_workers:
-                        found_workers.append(worker)
-        # We allow 10 concurrency per worker serving the models requested
-        allowed_concurrency = len(found_workers) * 4
-        # logger.debug([allowed_concurrency,models_dict.get(model_name,{"count":0})["count"]])
-        return(allowed_concurrency)
-
-    def report_suspicion(self, amount = 1, reason = Suspicions.USERNAME_PROFANITY, formats = None):
+            found_workers.update(model_workers.get(model_name, []))
+        # We allow 4 concurrency per worker serving the models requested
+        # But always at least 1, in case a worker for that model appears while the request is queued
+        allowed_concurrency = max(len(found_workers) * 4, 1)
+        return(min(allowed_concurrency, self.concurrency))
+
+    def report_suspicion(self, amount = 1, reason = Suspicions.USERNAME_PROFANITY, formats = None, commit = True):
         if not formats: formats = []
         # Anon is never considered suspicious
         if self.is_anon():
@@ -269,7 +270,8 @@ class User(db.Model):
             return
         new_suspicion = UserSuspicions(user_id=self.id, suspicion_id=int(reason))
         db.session.add(new_suspicion)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         if reason:
             reason_log = SUSPICION_LOGS[reason].format(*formats)
             logger.warning(f"User '{self.id}' suspicion increased to {len(self.suspicions)}. Reason: {reason}")
@@ -1,36 +1,44 @@
 import uuid
 
-from datetime import datetime
+from calendar import timegm
+from datetime import datetime, timedelta
 from sqlalchemy.ext.mutable import MutableDict
 from sqlalchemy.dialects.postgresql import JSONB, UUID
-from sqlalchemy import JSON, func, or_
+from sqlalchemy import JSON, or_
+from sqlalchemy.orm import defer
 
 from horde.logger import logger
 from horde.flask import db, SQLITE_MODE
 from horde.vars import thing_divisor
 from horde.utils import is_profane, get_db_uuid, get_expiry_date, get_db_uuid
+from horde.matchmaking import announce_waiting_prompt, add_personal_ids
+from horde.enums import Capabilities
+from horde.classes.base.model import get_model_ids, get_model_names
+from horde.classes.base.stats import get_horde_throughput
 
 from horde.classes import ProcessingGeneration
 
 
 json_column_type = JSONB if not SQLITE_MODE else JSON
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)
+# Every second a WP spends in the queue, it gains as much priority as this many kudos
+PRIORITY_AGING_PER_SECOND = 5
 
 class WPAllowedWorkers(db.Model):
     __tablename__ = "wp_allowed_workers"
     id = db.Column(db.Integer, primary_key=True)
-    worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id"), nullable=False)
+    worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id"), nullable=False, index=True)
     worker = db.relationship(f"WorkerExtended")
-    wp_id = db.Column(uuid_column_type(), db.ForeignKey("waiting_prompts.id", ondelete="CASCADE"), nullable=False)
+    wp_id = db.Column(uuid_column_type(), db.ForeignKey("waiting_prompts.id", ondelete="CASCADE"), nullable=False, index=True)
     wp = db.relationship(f"WaitingPromptExtended", back_populates="workers")
 
 
 class WPTrickedWorkers(db.Model):
     __tablename__ = "wp_tricked_workers"
     id = db.Column(db.Integer, primary_key=True)
-    worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id"), nullable=False)
+    worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id"), nullable=False, index=True)
     worker = db.relationship(f"WorkerExtended")
-    wp_id = db.Column(uuid_column_type(), db.ForeignKey("waiting_prompts.id", ondelete="CASCADE"), nullable=False)
+    wp_id = db.Column(uuid_column_type(), db.ForeignKey("waiting_prompts.id", ondelete="CASCADE"), nullable=False, index=True)
     wp = db.relationship(f"WaitingPromptExtended", back_populates="tricked_workers")
 
 
@@ -39,7 +47,7 @@ class WPModels(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     wp_id = db.Column(uuid_column_type(), db.ForeignKey("waiting_prompts.id", ondelete="CASCADE"), nullable=False)
     wp = db.relationship(f"WaitingPromptExtended", back_populates="models")
-    model = db.Column(db.String(30), nullable=False)
+    model_id = db.Column(db.Integer, db.ForeignKey("models.id"), nullable=False, index=True)
 
 
 class WaitingPrompt(db.Model):
@@ -66,8 +74,19 @@ class WaitingPrompt(db.Model):
     jobs = db.Column(db.Integer, default=0, nullable=False)
     things = db.Column(db.BigInteger, default=0, nullable=False)
     total_usage = db.Column(db.Float, default=0, nullable=False)
-    extra_priority = db.Column(db.Integer, default=0, nullable=False, index=True)
+    # The priority this WP entered the queue with
+    extra_priority = db.Column(db.Integer, default=0, nullable=False)
+    # The queue is sorted by this. It is the extra_priority minus the aging the WP would have gained if it had been created at the epoch.
+    # As every WP ages at the same rate, sorting by this gives the same order as sorting by the aged priority, without ever updating it.
+    queue_priority = db.Column(db.BigInteger, default=0, nullable=False, index=True)
     job_ttl = db.Column(db.Integer, default=150, nullable=False)
+    # The Capabilities a worker needs to offer to pick up this WP
+    requirement_mask = db.Column(db.Integer, default=0, nullable=False)
+    min_bridge_version = db.Column(db.Integer, default=1, nullable=False)
+    # When true, the job waiting in this WP is a duplicate of a straggling one
+    hedging = db.Column(db.Boolean, default=False, nullable=False)
+    # How many duplicate jobs have been issued for this WP
+    hedges = db.Column(db.Integer, default=0, nullable=False)
 
     processing_gens = db.relationship("ProcessingGenerationExtended", back_populates="wp", passive_deletes=True, cascade="all, delete-orphan")
     tricked_workers = db.relationship("WPTrickedWorkers", back_populates="wp", passive_deletes=True, cascade="all, delete-orphan")
@@ -77,6 +96,8 @@ class WaitingPrompt(db.Model):
     expiry = db.Column(db.DateTime, default=get_expiry_date, index=True)
 
     created = db.Column(db.DateTime(timezone=False), default=datetime.utcnow, index=True)
+    # Computed once per instance, as we match it against every worker blacklist
+    _normalized_prompt = None
 
     def __init__(self, worker_ids, models, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -96,8 +117,9 @@ class WaitingPrompt(db.Model):
     def set_models(self, model_names = None):
         if not model_names: model_names = []
         # We don't allow more workers to claim they can server more than 50 models atm (to prevent abuse)
-        for model in model_names:
-            model_entry = WPModels(model=model,wp_id=self.id)
+        # Models which no worker has served yet are registered as well, so that the request can wait for one
+        for model_id in set(get_model_ids(model_names)):
+            model_entry = WPModels(model_id=model_id,wp_id=self.id)
             db.session.add(model_entry)
 
     def activate(self):
@@ -106,12 +128,61 @@ class WaitingPrompt(db.Model):
         '''
         self.active = True
         self.extra_priority = self.user.kudos
+        # created is a naive UTC datetime, so we can't use its timestamp(), which assumes local time
+        self.queue_priority = self.extra_priority - timegm(self.created.utctimetuple()) * PRIORITY_AGING_PER_SECOND
         db.session.commit()
+        add_personal_ids([w.worker_id for w in self.workers], [self.user_id])
+        announce_waiting_prompt(self.get_model_names())
+
+    def get_matchmaking_tags(self):
+        '''The tags we match against the worker capability index, to quickly tell if any worker can generate this WP
+        This should be extended by each horde type with their own capabilities
+        '''
+        return {
+            "requirements": self.requirement_mask,
+            "min_bridge_version": self.min_bridge_version,
+            "user_id": self.user_id,
+        }
+
+    def get_requirement_mask(self):
+        '''Compiles the Capabilities a worker needs to offer in order to generate this WP
+        This should be extended by each horde type with their own requirements
+        '''
+        requirements = Capabilities(0)
+        if self.nsfw:
+            requirements |= Capabilities.NSFW
+        if self.trusted_workers:
+            requirements |= Capabilities.TRUSTED
+        return requirements
+
+    def get_min_bridge_version(self):
+        '''The minimum bridge version required to generate this WP
+        This should be extended by each horde type
+        '''
+        return 1
+
+    def compile_requirements(self):
+        self.requirement_mask = int(self.get_requirement_mask())
+        self.min_bridge_version = self.get_min_bridge_version()
+
+    def is_time_sensitive(self):
+        '''WPs which are almost done, or have already waited for longer than a job should take
+        are the ones which suffer the most from being given to a worker which might drop them
+        '''
+        if self.jobs > 1 and self.n <= max(1, self.jobs // 4):
+            return True
+        return datetime.utcnow() - self.created > timedelta(seconds=self.job_ttl)
+
+    def get_normalized_prompt(self):
+        '''The lowercase prompt we match the worker blacklists against'''
+        if self._normalized_prompt is None:
+            self._normalized_prompt = self.prompt.lower()
+        return self._normalized_prompt
 
     def get_model_names(self):
         # Could also do this based on self.models, but no need
-        model_names = db.session.query(func.distinct(WPModels.model).label('name')).filter(WPModels.wp_id == self.id).all()
-        return [m.name for m in model_names]
+        model_ids = db.session.query(WPModels.model_id).filter(WPModels.wp_id == self.id).all()
+        return get_model_names([m.model_id for m in model_ids])
 
     # These are typically horde-specific so they will be defined in the specific class for this horde type
     def extract_params(self):
@@ -122,6 +193,7 @@ class WaitingPrompt(db.Model):
         # This specific per horde so it should be set in the extended class
         self.things = 0
         self.total_usage = round(self.things * self.n / thing_divisor,2)
+        self.compile_requirements()
         self.prepare_job_payload()
         db.session.commit()
 
@@ -136,38 +208,87 @@ class WaitingPrompt(db.Model):
     def needs_gen(self):
         return self.n > 0
 
-    def start_generation(self, worker):
-        # We have to do this to lock the row for updates, to ensure we don't have racing conditions on who is picking up requests
-        myself_refresh = db.session.query(WaitingPrompt).filter(WaitingPrompt.id == self.id, WaitingPrompt.n > 0).with_for_update().first()
+    def pick_model(self, worker):
+        '''Chooses which model the worker should use for this WP'''
+        worker_models = worker.get_model_names()
+        # If there has been no explicit model requested by the user, we just choose the first available from the worker
+        if len(worker_models):
+            model = worker_models[0]
+        else:
+            model = ''
+        # If we reached this point, it means there is at least 1 matching model between worker and client
+        # so we pick the first one.
+        for model_name in self.get_model_names():
+            if model_name in worker_models:
+                model = model_name
+        return model
+
+    def start_generation(self, worker, amount = 1):
+        '''Claims up to amount images of this WP for the worker, as a single job
+        Each image still gets its own procgen, so that it is submitted, rewarded and recorded on its own
+        '''
+        # We pick the model before locking, so that we don't hold the lock while querying
+        model = self.pick_model(worker)
+        # We lock the row for updates, to ensure we don't have racing conditions on who is picking up requests
+        # If another worker is currently claiming it, we skip it instead of waiting for the lock to be released.
+        myself_refresh = db.session.query(
+            WaitingPrompt
+        ).filter(
+            WaitingPrompt.id == self.id, 
+            WaitingPrompt.n > 0
+        ).with_for_update(
+            skip_locked=True
+        ).populate_existing().first()
         if not myself_refresh:
             return None
-        myself_refresh.n -= 1
+        # The claim, the expiry refresh and the new procgen all go in the same transaction
+        batch_size = max(1, min(amount, myself_refresh.n))
+        myself_refresh.n -= batch_size
+        myself_refresh.expiry = get_expiry_date()
+        first_job = worker.is_first_job(model)
+        deadline = worker.get_job_deadline(self, batch_size, first_job)
+        new_gens = [
+            ProcessingGeneration(wp_id=self.id, worker_id=worker.id, model=model, deadline=deadline, first_job=first_job, batch_size=batch_size, commit=False)
+            for _ in range(batch_size)
+        ]
+        # Only now is the claim visible to anyone else
         db.session.commit()
-        new_gen = ProcessingGeneration(wp_id=self.id, worker_id=worker.id)
-        self.refresh()
-        logger.audit(f"Procgen with ID {new_gen.id} popped from WP {self.id} by worker {worker.id} ('{worker.name}' / {worker.ipaddr}) - {self.n} gens left")
-        return self.get_pop_payload(new_gen)
+        for new_gen in new_gens:
+            logger.audit(f"Procgen with ID {new_gen.id} popped from WP {self.id} by worker {worker.id} ('{worker.name}' / {worker.ipaddr}) - {self.n} gens left")
+        if batch_size == 1:
+            return self.get_pop_payload(new_gens[0])
+        return self.get_pop_payload(new_gens[0], batch = new_gens)
 
     def fake_generation(self, worker):
+        model = self.pick_model(worker)
+        first_job = worker.is_first_job(model)
         new_gen = ProcessingGeneration(
             wp_id=self.id, 
             worker_id=worker.id,
-            fake=True)
+            model=model,
+            deadline=worker.get_job_deadline(self, first_job=first_job),
+            first_job=first_job,
+            fake=True,
+            commit=False)
         new_trick = WPTrickedWorkers(wp_id=self.id, worker_id=worker.id)
         db.session.add(new_trick)
         db.session.commit()
+        add_personal_ids([worker.id], [])
         logger.audit(f"FAKE Procgen with ID {new_gen.id} popped from WP {self.id} by worker {worker.id} ('{worker.name}' / {worker.ipaddr}) - {self.n} gens left")
         return self.get_pop_payload(new_gen)
     
     def tricked_worker(self, worker):
         return worker.id in [w.worker_id for w in self.tricked_workers]
 
-    def get_pop_payload(self, procgen):
+    def get_pop_payload(self, procgen, batch = None):
+        '''batch is the list of all the procgens in the same job, when the job covers more than one image'''
         prompt_payload = {
             "payload": self.get_job_payload(procgen),
             "id": procgen.id,
             "model": procgen.model,
         }
+        if batch:
+            prompt_payload["ids"] = [p.id for p in batch]
         return(prompt_payload)
 
     def is_completed(self):
@@ -189,6 +310,71 @@ class WaitingPrompt(db.Model):
             return False
         return True
 
+    def count_hedged_jobs(self):
+        '''Returns how many jobs have been generated, and the procgens which are still being generated
+        This runs for every hedging WP a worker is offered, so we only check if each generation exists
+        instead of loading the generations themselves
+        '''
+        procgens = db.session.query(
+            ProcessingGeneration,
+            (ProcessingGeneration.generation != None).label("generated"),
+        ).options(
+            defer(ProcessingGeneration.generation),
+        ).filter(
+            ProcessingGeneration.wp_id == self.id,
+            ProcessingGeneration.fake == False,
+        ).populate_existing().all()
+        done = 0
+        outstanding = []
+        for procgen, generated in procgens:
+            if generated:
+                done += 1
+            elif not procgen.faulted:
+                outstanding.append(procgen)
+        return done, outstanding
+
+    def lock(self):
+        '''Locks this WP row until the end of the transaction and refreshes it along with its procgens'''
+        db.session.query(
+            WaitingPrompt
+        ).filter(
+            WaitingPrompt.id == self.id,
+        ).with_for_update().populate_existing().first()
+        db.session.expire(self, ["processing_gens"])
+
+    def hedge(self):
+        '''Offers the straggling job of this WP to a second worker'''
+        self.lock()
+        # Its job might have been requeued or already hedged since we decided to hedge it
+        if self.n > 0 or self.hedges > 0:
+            db.session.commit()
+            return
+        self.n += 1
+        self.hedging = True
+        self.hedges += 1
+        db.session.commit()
+        logger.info(f"Hedging the straggling job of WP {self.id}")
+        announce_waiting_prompt(self.get_model_names())
+
+    def resolve_hedges(self, commit = True):
+        '''Brings n in line with the jobs this hedged WP still needs, after one of its jobs finished or was aborted
+        The first result wins and any duplicates still being generated are cancelled
+        '''
+        # Two results for the same job might arrive at the same time, so only one of them should resolve it
+        self.lock()
+        done, outstanding = self.count_hedged_jobs()
+        needed = self.jobs - done
+        if needed <= 0:
+            for procgen in outstanding:
+                procgen.cancel_duplicate()
+            self.n = 0
+        else:
+            self.n = max(needed - len(outstanding), 0)
+        # Any job still waiting is now a normal one
+        self.hedging = False
+        if commit:
+            db.session.commit()
+
     def count_processing_gens(self):
         ret_dict = {
             "finished": 0,
@@ -245,6 +431,10 @@ class WaitingPrompt(db.Model):
         if queued_n < active_worker_thread_count:
             active_worker_thread_count = queued_n
         avg_things_per_sec = (request_avg / thing_divisor) * active_worker_thread_count
+        # When there's more queued than the workers can run at once, the queue drains as fast as the horde has been delivering lately
+        horde_throughput = get_horde_throughput()
+        if queued_n >= active_worker_thread_count and horde_throughput:
+            avg_things_per_sec = horde_throughput / thing_divisor
         # Is this is 0, it means one of two things:
         # 1. This horde hasn't had any requests yet. So we'll initiate it to 1 avg_things_per_sec
         # 2. All gens for this WP are being currently processed, so we'll just set it to 1 to avoid a div by zero, but it's not used anyway as it will just divide 0/1
@@ -268,14 +458,14 @@ class WaitingPrompt(db.Model):
         ret_dict = self.get_status(lite=True, **kwargs)
         return(ret_dict)
 
-    def record_usage(self, raw_things, kudos):
+    def record_usage(self, raw_things, kudos, commit = True):
         '''Record that we received a requested generation and how much kudos it costs us
         We use 'thing' here as we do not care what type of thing we're recording at this point
         This avoids me having to extend this just to change a var name
         '''
-        self.user.record_usage(raw_things, kudos)
+        self.user.record_usage(raw_things, kudos, commit = commit)
         self.consumed_kudos = round(self.consumed_kudos + kudos,2)
-        self.refresh()
+        self.refresh(commit = commit)
 
     def log_faulted_prompt(self):
         '''Extendable function to log why a request was aborted'''
@@ -302,9 +492,10 @@ class WaitingPrompt(db.Model):
         self.n = 0
         db.session.commit()
 
-    def refresh(self):
+    def refresh(self, commit = True):
         self.expiry = get_expiry_date()
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
     def is_stale(self):
         if datetime.utcnow() > self.expiry:
@@ -312,7 +503,8 @@ class WaitingPrompt(db.Model):
         return(False)
 
     def get_priority(self):
-        return(self.extra_priority)
+        '''Returns the priority this WP has aged to so far'''
+        return(self.extra_priority + int((datetime.utcnow() - self.created).total_seconds() * PRIORITY_AGING_PER_SECOND))
 
     def set_job_ttl(self):
         '''Returns how many seconds each job request should stay waiting before considering it stale and cancelling it
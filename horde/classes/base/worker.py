@@ -1,20 +1,40 @@
 import uuid
+import json
+import hashlib
 
-from sqlalchemy import func
 from sqlalchemy.dialects.postgresql import UUID
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from horde.classes.base.waiting_prompt import WPModels
 from horde.logger import logger
+from horde.horde_redis import horde_r
 from horde.argparser import raid
 from horde.flask import db, SQLITE_MODE
 from horde.vars import thing_name, thing_divisor, things_per_sec_suspicion_threshold
 from horde.suspicions import SUSPICION_LOGS, Suspicions
 from horde.utils import is_profane, get_db_uuid, sanitize_string
+from horde.enums import Capabilities, get_missing_capabilities, get_capability_skip_reason
+from horde.blacklist import get_worker_matcher, get_digest_matcher
+from horde.classes.base.model import get_model_set_id, get_model_set_names, get_model_set_model_ids
+from horde.assignment import update_ewma, get_reliability_score, get_reliability_shift, RELIABILITY_THRESHOLD
 
 
 uuid_column_type = lambda: UUID(as_uuid=True) if not SQLITE_MODE else db.String(36)
 
+# How often we write the check-in time of an active worker to the DB
+# So last_check_in can be up to this many seconds behind the worker's actual last check-in.
+# This has to stay well below the 300 seconds after which a worker is considered stale,
+# so that active workers never look stale in between flushes.
+CHECK_IN_FLUSH_INTERVAL = 30
+# The job deadlines are the expected generation time times this factor, plus some overhead for the transfers
+JOB_DEADLINE_SAFETY_FACTOR = 3
+JOB_DEADLINE_OVERHEAD = 30
+JOB_DEADLINE_MINIMUM = 60
+# The models each worker has delivered lately. The first job of a worker on a model might include loading it,
+# so until the worker has delivered that model, its jobs get the whole WP job TTL instead of a measured deadline.
+DELIVERED_MODELS_KEY = "worker_delivered_models:{worker_id}"
+DELIVERED_MODELS_EXPIRY = 3600
+
 class WorkerStats(db.Model):
     __tablename__ = "worker_stats"
     id = db.Column(db.Integer, primary_key=True)
@@ -34,7 +54,7 @@ class WorkerPerformance(db.Model):
 class WorkerBlackList(db.Model):
     __tablename__ = "worker_blacklists"
     id = db.Column(db.Integer, primary_key=True)
-    worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id", ondelete="CASCADE"), nullable=False)
+    worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id", ondelete="CASCADE"), nullable=False, index=True)
     worker = db.relationship(f"WorkerExtended", back_populates="blacklist")
     word = db.Column(db.String(20), primary_key=False)
 
@@ -45,13 +65,6 @@ class WorkerSuspicions(db.Model):
     worker = db.relationship(f"WorkerExtended", back_populates="suspicions")
     suspicion_id = db.Column(db.Integer, primary_key=False)
 
-class WorkerModel(db.Model):
-    __tablename__ = "worker_models"
-    id = db.Column(db.Integer, primary_key=True)
-    worker_id = db.Column(uuid_column_type(), db.ForeignKey("workers.id", ondelete="CASCADE"), nullable=False)
-    worker = db.relationship(f"WorkerExtended", back_populates="models")
-    model = db.Column(db.String(30))  # TODO model should be a foreign key to a model table
-
 class WorkerTemplate(db.Model):
     __tablename__ = "workers"
     __mapper_args__ = {
@@ -80,6 +93,9 @@ class WorkerTemplate(db.Model):
     fulfilments = db.Column(db.Integer, default=0, nullable=False)
     aborted_jobs = db.Column(db.Integer, default=0, nullable=False)
     uncompleted_jobs = db.Column(db.Integer, default=0, nullable=False)
+    # Rolling averages of the fraction of jobs this worker completes, and of how much of the job TTL it uses to do so
+    completion_rate = db.Column(db.Float, default=1, nullable=False)
+    ttl_usage = db.Column(db.Float, default=0, nullable=False)
     uptime = db.Column(db.BigInteger, default=0, nullable=False)
     threads = db.Column(db.Integer, default=1, nullable=False)
     bridge_version = db.Column(db.Integer, default=1, nullable=False)
@@ -92,6 +108,8 @@ class WorkerTemplate(db.Model):
     team = db.relationship("Team", back_populates="workers")
 
     allow_unsafe_ipaddr = db.Column(db.Boolean, default=True, nullable=False)
+    # A digest of the configuration sent at the last check-in, so that we can skip applying it again when unchanged
+    check_in_digest = db.Column(db.String(64), default=None)
 
     stats = db.relationship("WorkerStats", back_populates="worker", cascade="all, delete-orphan")
     performance = db.relationship("WorkerPerformance", back_populates="worker", cascade="all, delete-orphan")
@@ -119,19 +137,20 @@ class WorkerTemplate(db.Model):
         if is_profane(self.name):
             self.report_suspicion(reason = Suspicions.WORKER_PROFANITY, formats = [self.name])
 
-    def report_suspicion(self, amount = 1, reason = Suspicions.WORKER_PROFANITY, formats = None):
+    def report_suspicion(self, amount = 1, reason = Suspicions.WORKER_PROFANITY, formats = None, commit = True):
         if not formats: formats = []
         # Unreasonable Fast can be added multiple times and it increases suspicion each time
         if int(reason) in self.suspicions and reason not in [Suspicions.UNREASONABLY_FAST,Suspicions.TOO_MANY_JOBS_ABORTED]:
             return
         new_suspicion = WorkerSuspicions(worker_id=self.id, suspicion_id=int(reason))
-        self.user.report_suspicion(amount, reason, formats)
+        self.user.report_suspicion(amount, reason, formats, commit = commit)
         if reason:
             reason_log = SUSPICION_LOGS[reason].format(*formats)
             logger.warning(f"Worker '{self.id}' suspicion increased. Reason: {reason_log}")
         if self.is_suspicious():
             self.paused = True
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
     def reset_suspicion(self):
         '''Clears the worker's suspicion and resets their reasons'''
@@ -204,6 +223,12 @@ class WorkerTemplate(db.Model):
         if not kwargs.get("safe_ip", True):
             if not self.user.trusted:
                 self.report_suspicion(reason = Suspicions.UNSAFE_IP)
+        # Active workers check in on every pop, so we only record it every few seconds to avoid writing to the DB each time.
+        # The uptime is calculated from the last recorded check-in, so no uptime is lost.
+        # A worker which stops checking in will appear stale up to CHECK_IN_FLUSH_INTERVAL seconds early.
+        if not self.is_stale() and (datetime.utcnow() - self.last_check_in).total_seconds() < CHECK_IN_FLUSH_INTERVAL:
+            db.session.commit()
+            return
         if not self.is_stale() and not self.paused and not self.maintenance:
             self.uptime += (datetime.utcnow() - self.last_check_in).seconds
             # Every 10 minutes of uptime gets 100 kudos rewarded
@@ -240,38 +265,51 @@ class WorkerTemplate(db.Model):
         return(converted)
 
     @logger.catch(reraise=True)
-    def record_contribution(self, raw_things, kudos, things_per_sec):
+    def record_contribution(self, raw_things, kudos, things_per_sec, commit = True):
         '''We record the servers newest contribution
         We do not need to know what type the contribution is, to avoid unnecessarily extending this method
         '''
-        self.user.record_contributions(raw_things = raw_things, kudos = kudos)
-        self.modify_kudos(kudos,'generated')
+        self.user.record_contributions(raw_things = raw_things, kudos = kudos, commit = commit)
+        self.modify_kudos(kudos,'generated', commit = commit)
         converted_amount = self.convert_contribution(raw_things)
         self.fulfilments += 1
         if self.team:
-            self.team.record_contribution(converted_amount, kudos)
+            self.team.record_contribution(converted_amount, kudos, commit = commit)
         performances = db.session.query(WorkerPerformance).filter_by(worker_id=self.id).order_by(WorkerPerformance.created.asc())
         if performances.count() >= 20:
             db.session.delete(performances.first())
         new_performance = WorkerPerformance(worker_id=self.id, performance=things_per_sec)
         db.session.add(new_performance)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         if things_per_sec / thing_divisor > things_per_sec_suspicion_threshold:
-            self.report_suspicion(reason = Suspicions.UNREASONABLY_FAST, formats=[round(things_per_sec / thing_divisor,2)])
+            self.report_suspicion(reason = Suspicions.UNREASONABLY_FAST, formats=[round(things_per_sec / thing_divisor,2)], commit = commit)
 
-    def modify_kudos(self, kudos, action = 'generated'):
+    def modify_kudos(self, kudos, action = 'generated', commit = True):
         self.kudos = round(self.kudos + kudos, 2)
         kudos_details = db.session.query(WorkerStats).filter_by(worker_id=self.id).filter_by(action=action).first()
         if not kudos_details:
             kudos_details = WorkerStats(worker_id=self.id,action=action, value=round(kudos, 2))
             db.session.add(kudos_details)
-            db.session.commit()
         else:
             kudos_details.value = round(kudos_details.value + kudos, 2)
+        if commit:
             db.session.commit()
         logger.trace([kudos_details,kudos_details.value])
 
-    def log_aborted_job(self):
+    def record_job_outcome(self, completed, ttl_usage):
+        '''Updates the rolling reliability of this worker. The caller is expected to commit'''
+        self.completion_rate = update_ewma(self.completion_rate, 1 if completed else 0)
+        self.ttl_usage = update_ewma(self.ttl_usage, min(ttl_usage, 1))
+
+    def get_reliability_score(self):
+        return get_reliability_score(self.completion_rate, self.ttl_usage)
+
+    def log_aborted_job(self, record_outcome = True):
+        '''When record_outcome is False, the aborted job does not affect the reliability of this worker'''
+        # Aborted jobs have used up their whole TTL
+        if record_outcome:
+            self.record_job_outcome(completed = False, ttl_usage = 1)
         # We count the number of jobs aborted in an 1 hour period. So we only log the new timer each time an hour expires.
         if (datetime.utcnow() - self.last_aborted_job).seconds > 3600:
             self.aborted_jobs = 0
@@ -308,6 +346,13 @@ class WorkerTemplate(db.Model):
             ret_num = 1
         return(ret_num)
 
+    def get_measured_speed(self):
+        '''Returns the average things per second of this worker, or None if we have not measured it yet'''
+        performances = [p.performance for p in self.performance]
+        if len(performances) == 0:
+            return None
+        return sum(performances) / len(performances)
+
     def get_performance(self):
         performances = [p.performance for p in self.performance]
         if len(performances):
@@ -396,24 +441,87 @@ class Worker(WorkerTemplate):
         "polymorphic_identity": "worker",
     }    
     nsfw = db.Column(db.Boolean, default=False, nullable=False)
+    # The Capabilities this worker offered at its last check-in
+    capability_mask = db.Column(db.Integer, default=0, nullable=False)
+    # Workers serving the exact same models share the same model set
+    model_set_id = db.Column(db.Integer, db.ForeignKey("model_sets.id"), default=None, index=True)
+    # Cached for the duration of the request, as we need them for every WP we check
+    _model_names = None
+    _blacklist_matcher = None
     
     blacklist = db.relationship("WorkerBlackList", back_populates="worker", cascade="all, delete-orphan")
-    models = db.relationship("WorkerModel", back_populates="worker", cascade="all, delete-orphan")
     processing_gens = db.relationship("ProcessingGenerationExtended", back_populates="worker")
 
     # This should be extended by each specific horde
     def check_in(self, **kwargs):
         super().check_in(**kwargs)
+        check_in_digest = kwargs.get("check_in_digest")
+        if self.is_check_in_unchanged(check_in_digest):
+            # The matcher compiled for this configuration is typically still in the process cache.
+            # If not, get_blacklist_matcher() compiles it from the stored words once it's needed.
+            self._blacklist_matcher = get_digest_matcher(self.id, check_in_digest)
+            return
         self.set_models(kwargs.get("models"))
         self.nsfw = kwargs.get("nsfw", True)
-        self.set_blacklist(kwargs.get("blacklist", []))
+        self.set_blacklist(kwargs.get("blacklist", []), check_in_digest)
+        self.capability_mask = int(self.get_capability_mask())
+        self.check_in_digest = check_in_digest
         db.session.commit()    
 
-    def set_blacklist(self, blacklist):
+    def is_check_in_unchanged(self, check_in_digest):
+        '''Returns True if this worker has already applied the exact same configuration'''
+        return check_in_digest is not None and check_in_digest == self.check_in_digest
+
+    def get_capabilities(self):
+        '''The capabilities we match against the WP matchmaking tags
+        This should be extended by each specific horde
+        '''
+        return {
+            "models": self.get_model_names(),
+            "capability_mask": int(self.capability_mask),
+            "bridge_version": self.bridge_version,
+            "maintenance": self.maintenance,
+            "user_id": self.user_id,
+        }
+
+    def get_profile_parts(self):
+        '''The worker attributes which decide which WPs it can be offered by the candidate query
+        This should be extended by each specific horde
+        '''
+        parts = [self.model_set_id, int(self.capability_mask), self.bridge_version]
+        # Workers in maintenance only receive their owner's WPs, so they cannot share with anyone else
+        if self.maintenance:
+            parts.append(str(self.user_id))
+        return parts
+
+    def get_profile_key(self):
+        '''Workers with the same profile key share the same cached candidate list'''
+        return hashlib.sha256(json.dumps(self.get_profile_parts()).encode()).hexdigest()
+
+    def get_capability_mask(self):
+        '''Compiles the Capabilities this worker offers
+        This should be extended by each specific horde
+        '''
+        capabilities = Capabilities(0)
+        if self.nsfw:
+            capabilities |= Capabilities.NSFW
+        if self.user.trusted:
+            capabilities |= Capabilities.TRUSTED
+        return capabilities
+
+    def get_missing_capabilities(self, waiting_prompt):
+        return get_missing_capabilities(waiting_prompt.requirement_mask, self.capability_mask)
+
+    def prepare_blacklist(self, blacklist):
         # We don't allow more workers to claim they can server more than 50 models atm (to prevent abuse)
         blacklist = [sanitize_string(word) for word in blacklist]
         del blacklist[100:]
-        blacklist = set(blacklist)
+        return set(blacklist)
+
+    def set_blacklist(self, blacklist, check_in_digest = None):
+        blacklist = self.prepare_blacklist(blacklist)
+        # We compile the matcher from the words as they're stored
+        self._blacklist_matcher = get_worker_matcher(self.id, [word[0:15] for word in blacklist], check_in_digest)
         existing_blacklist = db.session.query(WorkerBlackList).filter_by(worker_id=self.id)
         existing_blacklist_words = set([b.word for b in existing_blacklist.all()])
         if existing_blacklist_words == blacklist:
@@ -424,26 +532,93 @@ class Worker(WorkerTemplate):
             db.session.add(blacklisted_word)
         db.session.commit()
 
+    def get_blacklist_words(self):
+        return [b.word for b in self.blacklist]
+
+    def get_blacklist_matcher(self):
+        if self._blacklist_matcher is None:
+            self._blacklist_matcher = get_worker_matcher(self.id, self.get_blacklist_words(), self.check_in_digest)
+        return self._blacklist_matcher
+
     def get_model_names(self):
-        model_names = db.session.query(func.distinct(WorkerModel.model).label('name')).filter(WorkerModel.worker_id == self.id).all()
-        return [m.name for m in model_names]
+        if self._model_names is None:
+            self._model_names = get_model_set_names(self.model_set_id)
+        return self._model_names
+
+    def get_model_ids(self):
+        return get_model_set_model_ids(self.model_set_id)
 
     def set_models(self, models):
         # We don't allow more workers to claim they can server more than 100 models atm (to prevent abuse)
         models = [sanitize_string(model_name[0:100]) for model_name in models]
         del models[100:]
         models = set(models)
-        existing_models = db.session.query(WorkerModel).filter_by(worker_id=self.id)
-        existing_model_names = set([m.model for m in existing_models.all()])
-        if existing_model_names == models:
+        model_set_id = get_model_set_id(models)
+        self._model_names = get_model_set_names(model_set_id)
+        if self.model_set_id == model_set_id:
             return
-        existing_models.delete()
-        for model_name in models:
-            model = WorkerModel(worker_id=self.id,model=model_name)
-            db.session.add(model)
+        self.model_set_id = model_set_id
         db.session.commit()
 
 
+    def record_delivered_model(self, model):
+        if horde_r is None:
+            return
+        try:
+            delivered_models_key = DELIVERED_MODELS_KEY.format(worker_id=self.id)
+            pipe = horde_r.pipeline()
+            pipe.sadd(delivered_models_key, model)
+            pipe.expire(delivered_models_key, timedelta(seconds=DELIVERED_MODELS_EXPIRY))
+            pipe.execute()
+        except Exception as err:
+            logger.error(f"Failed to record the delivered model of worker {self.id}: {err}")
+
+    def is_first_job(self, model):
+        '''Returns True if we cannot expect this worker to generate with this model at its measured speed
+        Either because we have not measured it yet, or because it has not delivered this model lately
+        '''
+        if horde_r is None or self.get_measured_speed() is None:
+            return True
+        try:
+            return not horde_r.sismember(DELIVERED_MODELS_KEY.format(worker_id=self.id), model)
+        except Exception as err:
+            logger.error(f"Failed to read the delivered models of worker {self.id}: {err}")
+            return True
+
+    def get_job_deadline(self, waiting_prompt, batch_size = 1, first_job = True):
+        '''Returns by when this worker should have delivered a job from this WP
+        We expect it to take as long as its measured speed suggests, times a safety margin
+        But we never allow it longer than the WP job TTL for each image in the job
+        The first job of a worker on a model always gets the whole job TTL, as it might need to load the model
+        '''
+        job_seconds = waiting_prompt.job_ttl * batch_size
+        worker_speed = self.get_measured_speed()
+        if worker_speed and not first_job:
+            expected_seconds = waiting_prompt.things * batch_size / worker_speed * JOB_DEADLINE_SAFETY_FACTOR + JOB_DEADLINE_OVERHEAD
+            job_seconds = min(max(expected_seconds, JOB_DEADLINE_MINIMUM), waiting_prompt.job_ttl * batch_size)
+        return datetime.utcnow() + timedelta(seconds=job_seconds)
+
+    def get_reliability_shift(self, waiting_prompt):
+        '''Returns how many positions this WP should be moved backwards, when this worker is unreliable'''
+        return get_reliability_shift(self.get_reliability_score(), waiting_prompt.is_time_sensitive())
+
+    def get_assignment_shift(self, waiting_prompt, assignment_stats):
+        '''Returns how many positions this WP should be moved in the queue order for this worker by the fit policy
+        This should be extended by each specific horde
+        '''
+        return 0
+
+    def can_hedge(self, waiting_prompt):
+        '''Only reliable workers faster than the ones already generating for this WP receive its duplicate job'''
+        worker_speed = self.get_measured_speed()
+        if worker_speed is None or self.get_reliability_score() < RELIABILITY_THRESHOLD:
+            return False
+        _, outstanding = waiting_prompt.count_hedged_jobs()
+        for procgen in outstanding:
+            if procgen.worker_id == self.id or worker_speed <= procgen.worker.get_performance_average():
+                return False
+        return True
+
     def can_generate(self, waiting_prompt):
         '''Takes as an argument a WaitingPrompt class and checks if this worker is valid for generating it'''
         # Workers in maintenance are still allowed to generate for their owner
@@ -453,19 +628,19 @@ class Worker(WorkerTemplate):
         if self.is_stale():
             # We don't consider stale workers in the request, so we don't need to report a reason
             return [False, None]
+        if waiting_prompt.hedging and not self.can_hedge(waiting_prompt):
+            return [False, None]
         #logger.warning(datetime.utcnow())
-        if waiting_prompt.nsfw and not self.nsfw:
-            return [False, 'nsfw']
-        #logger.warning(datetime.utcnow())
-        if waiting_prompt.trusted_workers and not self.user.trusted:
-            return [False, 'untrusted']
+        skipped_reason = get_capability_skip_reason(waiting_prompt.requirement_mask, self.capability_mask)
+        if skipped_reason is not None:
+            return [False, skipped_reason]
         # If the worker has been tricked once by this prompt, we don't want to resend it it
         # as it may give up the jig
         #logger.warning(datetime.utcnow())
         if waiting_prompt.tricked_worker(self):
             return [False, 'secret']
         #logger.warning(datetime.utcnow())
-        if any(b.word.lower() in waiting_prompt.prompt.lower() for b in self.blacklist):
+        if self.get_blacklist_matcher().search(waiting_prompt.get_normalized_prompt()):
             return [False, 'blacklist']
         # Skips working prompts which require a specific worker from a list, and our ID is not in that list
         if len(waiting_prompt.workers) and self.id not in [wref.worker_id for wref in waiting_prompt.workers]:
@@ -503,6 +678,4 @@ class Worker(WorkerTemplate):
             procgen.abort()
         for word in self.blacklist:
             db.session.delete(word)
-        for model in self.models:
-            db.session.delete(model)
         super().delete()
@@ -41,7 +41,7 @@ class ProcessingGenerationExtended(ProcessingGeneration):
         )
 
 
-    def set_generation(self, generation, things_per_sec, **kwargs):
+    def set_generation(self, generation, things_per_sec, commit = True, **kwargs):
         if self.wp.r2 and generation != "R2":
             logger.warning(f"Worker {self.worker.name} ({self.worker.id}) with bridge version {self.worker.bridge_version} uploaded an R2 request as b64. Converting...")
             if self.wp.shared:
@@ -59,10 +59,11 @@ class ProcessingGenerationExtended(ProcessingGeneration):
                 # This signifies to send the download URL
                 generation = "R2"
                 os.remove(filename)
-        kudos = super().set_generation(generation, things_per_sec, **kwargs)
+        kudos = super().set_generation(generation, things_per_sec, commit = commit, **kwargs)
         if kwargs.get("censored", False):
             self.censored = True
-            db.session.commit()
+            if commit:
+                db.session.commit()
         if self.wp.shared and not self.fake and generation == "R2":
             self.upload_generation_metadata()
         return(kudos)
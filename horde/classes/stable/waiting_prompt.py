@@ -1,4 +1,5 @@
 import random
+import copy
 
 from horde.logger import logger
 from horde.vars import thing_divisor
@@ -6,6 +7,7 @@ from horde.flask import db
 from horde.utils import get_random_seed
 from horde.classes.base.waiting_prompt import WaitingPrompt
 from horde.r2 import generate_procgen_upload_url
+from horde.enums import Capabilities
 
 class WaitingPromptExtended(WaitingPrompt):
     width = db.Column(db.Integer, default=512, nullable=False)
@@ -63,6 +65,7 @@ class WaitingPromptExtended(WaitingPrompt):
         # logger.debug([self.prompt,self.params['width'],self.params['sampler_name']])
         self.things = self.width * self.height * self.get_accurate_steps()
         self.total_usage = round(self.things * self.n / thing_divisor,2)
+        self.compile_requirements()
         self.prepare_job_payload(self.params)
         self.calculate_kudos()
         # Commit will happen in prepare_job_payload()
@@ -73,7 +76,7 @@ class WaitingPromptExtended(WaitingPrompt):
         if not initial_dict: initial_dict = {}
         self.gen_payload = initial_dict.copy()
         self.gen_payload["prompt"] = self.prompt
-        # We always send only 1 iteration to Stable Diffusion
+        # Jobs covering more than 1 image get their batch_size set in get_job_payload()
         self.gen_payload["batch_size"] = 1
         self.gen_payload["ddim_steps"] = self.params['steps']
         self.gen_payload["seed"] = self.seed
@@ -81,32 +84,48 @@ class WaitingPromptExtended(WaitingPrompt):
         db.session.commit()
 
     @logger.catch(reraise=True)
-    def get_job_payload(self,procgen):
+    def get_image_seed(self, image_index):
+        '''Returns the seed of the image in this position of the WP'''
         # If self.seed is None, we randomize the seed we send to the worker each time.
         if self.seed is None:
-            self.gen_payload["seed"] = self.seed_to_int(self.seed)
-        if self.seed_variation and self.jobs - self.n > 1:
-            self.gen_payload["seed"] += self.seed_variation
-            while self.gen_payload["seed"] >= 2**32:
-                self.gen_payload["seed"] = self.gen_payload["seed"] >> 32
-        # logger.debug([self.gen_payload["seed"],self.seed_variation])
+            return self.seed_to_int(self.seed)
+        seed = self.seed
+        # Each image after the first one, gets the seed_variation added once more
+        if self.seed_variation and image_index > 0:
+            seed += self.seed_variation * image_index
+            while seed >= 2**32:
+                seed = seed >> 32
+        return seed
+
+    def get_job_payload(self, procgen, batch_size = 1):
+        '''Builds the payload for this specific job
+        We work on a copy of the stored gen_payload, so that we do not need to write anything back to the DB
+        '''
+        job_payload = copy.deepcopy(dict(self.gen_payload))
+        # The images of this job were the last ones claimed from this WP
+        first_image = self.jobs - self.n - batch_size
+        seeds = [self.get_image_seed(first_image + i) for i in range(batch_size)]
+        job_payload["seed"] = seeds[0]
+        if batch_size > 1:
+            job_payload["batch_size"] = batch_size
+            job_payload["seeds"] = seeds
+        # logger.debug([job_payload["seed"],self.seed_variation])
         if procgen.worker.bridge_version >= 2:
             if not self.nsfw and self.censor_nsfw:
-                self.gen_payload["use_nsfw_censor"] = True
+                job_payload["use_nsfw_censor"] = True
         else:
             # These parameters are not used in bridge v1
             for v2_param in ["use_gfpgan","use_real_esrgan","use_ldsr","use_upscaling"]:
-                if v2_param in self.gen_payload:
-                    del self.gen_payload[v2_param]
+                if v2_param in job_payload:
+                    del job_payload[v2_param]
             if not self.nsfw and self.censor_nsfw:
-                if "toggles" not in self.gen_payload:
-                    self.gen_payload["toggles"] = [1, 4, 8]
-                elif 8 not in self.gen_payload["toggles"]:
-                    self.gen_payload["toggles"].append(8)
-            if "denoising_strength" in self.gen_payload:
-                del self.gen_payload["denoising_strength"]
-        db.session.commit()
-        return(self.gen_payload)
+                if "toggles" not in job_payload:
+                    job_payload["toggles"] = [1, 4, 8]
+                elif 8 not in job_payload["toggles"]:
+                    job_payload["toggles"].append(8)
+            if "denoising_strength" in job_payload:
+                del job_payload["denoising_strength"]
+        return(job_payload)
 
     def get_share_metadata(self):
         '''This is uploaded along with the image to the shared R2, when this WP shared'''
@@ -123,15 +142,21 @@ class WaitingPromptExtended(WaitingPrompt):
         }
         return ret_dict
 
-    def get_pop_payload(self, procgen):
+    def get_pop_payload(self, procgen, batch = None):
+        '''batch is the list of all the procgens in the same job, when the job covers more than one image
+        Each image in the batch is submitted against its own ID, in the same order as the seeds in the payload
+        '''
+        batch_size = len(batch) if batch else 1
         # This prevents from sending a payload with an ID when there has been an exception inside get_job_payload()
-        payload = self.get_job_payload(procgen)
+        payload = self.get_job_payload(procgen, batch_size)
         if payload:
             prompt_payload = {
                 "payload": payload,
                 "id": procgen.id,
                 "model": procgen.model,
             }
+            if batch:
+                prompt_payload["ids"] = [p.id for p in batch]
             if self.source_image and procgen.worker.bridge_version > 2:
                 prompt_payload["source_image"] = self.source_image
             if procgen.worker.bridge_version > 3:
@@ -140,6 +165,8 @@ class WaitingPromptExtended(WaitingPrompt):
                     prompt_payload["source_mask"] = self.source_mask
             if procgen.worker.bridge_version >= 8 and self.r2:
                 prompt_payload["r2_upload"] = generate_procgen_upload_url(str(procgen.id), self.shared)
+                if batch:
+                    prompt_payload["r2_uploads"] = [generate_procgen_upload_url(str(p.id), self.shared) for p in batch]
         else:
             prompt_payload = {}
             self.faulted = True
@@ -159,6 +186,43 @@ class WaitingPromptExtended(WaitingPrompt):
             f"w:{self.width} * h:{self.height} * s:{self.params['steps']} * n:{self.n} == {self.total_usage} Total MPs"
         )
 
+    def get_matchmaking_tags(self):
+        tags = super().get_matchmaking_tags()
+        tags["pixels"] = self.width * self.height
+        tags["r2"] = self.r2
+        return tags
+
+    def get_requirement_mask(self):
+        requirements = super().get_requirement_mask()
+        if not self.safe_ip:
+            requirements |= Capabilities.UNSAFE_IP
+        # We do not give untrusted workers anon or VPN generations, to avoid anything slipping by and spooking them.
+        if not self.safe_ip and not self.user.trusted:
+            requirements |= Capabilities.TRUSTED
+        if self.source_image:
+            requirements |= Capabilities.IMG2IMG
+        if self.source_processing != 'img2img':
+            requirements |= Capabilities.PAINTING | Capabilities.INPAINTING_MODEL
+        else:
+            # If the only model loaded is the inpainting one, the worker cannot serve this kind of work
+            requirements |= Capabilities.GENERATION_MODEL
+        if len(self.params.get('post_processing', [])) >= 1:
+            requirements |= Capabilities.POST_PROCESSING
+        return requirements
+
+    def get_min_bridge_version(self):
+        min_bridge_version = super().get_min_bridge_version()
+        # These samplers are currently crashing nataili on older bridges.
+        if self.params.get('sampler_name', 'k_euler_a') in ["k_dpm_fast", "k_dpm_adaptive", "k_dpmpp_2s_a", "k_dpmpp_2m"]:
+            min_bridge_version = max(min_bridge_version, 5)
+        if self.params.get('karras', False):
+            min_bridge_version = max(min_bridge_version, 6)
+        if len(self.params.get('post_processing', [])) >= 1:
+            min_bridge_version = max(min_bridge_version, 7)
+        if "CodeFormers" in self.params.get('post_processing', []):
+            min_bridge_version = max(min_bridge_version, 9)
+        return min_bridge_version
+
     def seed_to_int(self, s = None):
         if type(s) is int:
             return s
@@ -170,7 +234,7 @@ class WaitingPromptExtended(WaitingPrompt):
         # logger.debug([s,n])
         return n
 
-    def record_usage(self, raw_things, kudos):
+    def record_usage(self, raw_things, kudos, commit = True):
         '''I have to extend this function for the stable cost, to add an extra cost when it's an img2img
         img2img burns more kudos than it generates, due to the extra bandwidth costs to the horde.
         Also extra cost when upscaling
@@ -191,7 +255,7 @@ class WaitingPromptExtended(WaitingPrompt):
             horde_tax -= 1
         kudos += horde_tax
 
-        super().record_usage(raw_things, kudos)
+        super().record_usage(raw_things, kudos, commit = commit)
 
     # We can calculate the kudos in advance as they model doesn't affect them
     def calculate_kudos(self):
@@ -3,6 +3,8 @@ from horde.logger import logger
 from horde.flask import db
 from horde.classes.base.worker import Worker
 from horde.suspicions import Suspicions
+from horde.enums import Capabilities
+from horde.assignment import get_assignment_shift, get_capacity_share
 
 class WorkerExtended(Worker):
     __mapper_args__ = {
@@ -14,16 +16,22 @@ class WorkerExtended(Worker):
     allow_post_processing = True
 
     def check_in(self, max_pixels, **kwargs):
+        # We need to check this before the base class stores the new digest
+        check_in_unchanged = self.is_check_in_unchanged(kwargs.get("check_in_digest"))
         super().check_in(**kwargs)
+        # This is not stored in the DB, so we always need to set it
+        self.allow_post_processing = kwargs.get('allow_post_processing', True)
+        if check_in_unchanged:
+            return
         if kwargs.get("max_pixels", 512 * 512) > 2048 * 2048:
             if not self.user.trusted:
                 self.report_suspicion(reason=Suspicions.EXTREME_MAX_PIXELS)
         self.max_pixels = max_pixels
         self.allow_img2img = kwargs.get('allow_img2img', True)
         self.allow_painting = kwargs.get('allow_painting', True)
-        self.allow_post_processing = kwargs.get('allow_post_processing', True)
         if len(self.get_model_names()) == 0:
             self.set_models(['stable_diffusion'])
+        self.capability_mask = int(self.get_capability_mask())
         paused_string = ''
         if self.paused:
             paused_string = '(Paused) '
@@ -33,63 +41,54 @@ class WorkerExtended(Worker):
     def calculate_uptime_reward(self):
         return 50
 
+    def get_capabilities(self):
+        capabilities = super().get_capabilities()
+        capabilities["max_pixels"] = self.max_pixels
+        return capabilities
+
+    def get_profile_parts(self):
+        parts = super().get_profile_parts()
+        parts.append(self.max_pixels)
+        return parts
+
+    def get_capability_mask(self):
+        capabilities = super().get_capability_mask()
+        if self.allow_unsafe_ipaddr:
+            capabilities |= Capabilities.UNSAFE_IP
+        if self.allow_img2img and self.bridge_version >= 2:
+            capabilities |= Capabilities.IMG2IMG
+        if self.allow_painting and self.bridge_version >= 4:
+            capabilities |= Capabilities.PAINTING
+        model_names = self.get_model_names()
+        if "stable_diffusion_inpainting" in model_names:
+            capabilities |= Capabilities.INPAINTING_MODEL
+        if any(model_name != "stable_diffusion_inpainting" for model_name in model_names):
+            capabilities |= Capabilities.GENERATION_MODEL
+        if self.allow_post_processing:
+            capabilities |= Capabilities.POST_PROCESSING
+        return capabilities
+
+    def get_assignment_shift(self, waiting_prompt, assignment_stats):
+        return get_assignment_shift(
+            job_pixels = waiting_prompt.width * waiting_prompt.height,
+            job_things = waiting_prompt.things,
+            job_ttl = waiting_prompt.job_ttl,
+            worker_max_pixels = self.max_pixels,
+            worker_speed = self.get_measured_speed(),
+            capacity_share = get_capacity_share(assignment_stats["worker_capacities"], self.max_pixels),
+            average_speed = assignment_stats["average_speed"],
+        )
+
     def can_generate(self, waiting_prompt):
         can_generate = super().can_generate(waiting_prompt)
         if not can_generate[0]:
             return [can_generate[0], can_generate[1]]
         #logger.warning(datetime.utcnow())
-        if self.max_pixels < waiting_prompt.params.get('width', 512) * waiting_prompt.params.get('height', 512):
+        if self.max_pixels < waiting_prompt.width * waiting_prompt.height:
             return [False, 'max_pixels']
         #logger.warning(datetime.utcnow())
-        if waiting_prompt.source_image and self.bridge_version < 2:
-            return [False, 'img2img']
-        #logger.warning(datetime.utcnow())
-        if waiting_prompt.source_processing != 'img2img':
-            if self.bridge_version < 4:
-                return [False, 'painting']
-            if "stable_diffusion_inpainting" not in self.get_model_names():
-                return [False, 'models']
-        # If the only model loaded is the inpainting one, we skip the worker when this kind of work is not required
-        #logger.warning(datetime.utcnow())
-        if waiting_prompt.source_processing not in ['inpainting', 'outpainting'] and self.get_model_names() == ["stable_diffusion_inpainting"]:
-            return [False, 'models']
-        #logger.warning(datetime.utcnow())
-        if waiting_prompt.source_processing != 'img2img' and self.bridge_version < 4:
-            return [False, 'painting']
-        # These samplers are currently crashing nataili. Disabling them from these workers until we can figure it out
-        #logger.warning(datetime.utcnow())
-        if waiting_prompt.gen_payload.get('sampler_name', 'k_euler_a') in ["k_dpm_fast", "k_dpm_adaptive", "k_dpmpp_2s_a", "k_dpmpp_2m"] and self.bridge_version < 5:
+        if waiting_prompt.min_bridge_version > self.bridge_version:
             return [False, 'bridge_version']
-        #logger.warning(datetime.utcnow())
-        if waiting_prompt.gen_payload.get('karras', False) and self.bridge_version < 6:
-            return [False, 'bridge_version']
-        #logger.warning(datetime.utcnow())
-        if len(waiting_prompt.gen_payload.get('post_processing', [])) >= 1 and self.bridge_version < 7:
-            return [False, 'bridge_version']
-        if "CodeFormers" in waiting_prompt.gen_payload.get('post_processing', []) and self.bridge_version < 9:
-            return [False, 'bridge_version']
-        #logger.warning(datetime.utcnow())
-        if waiting_prompt.source_image and not self.allow_img2img:
-            return [False, 'img2img']
-        # Prevent txt2img requests being sent to "stable_diffusion_inpainting" workers
-        #logger.warning(datetime.utcnow())
-        if not waiting_prompt.source_image and (self.models == ["stable_diffusion_inpainting"] or waiting_prompt.models == ["stable_diffusion_inpainting"]):
-            return [False, 'models']
-        #logger.warning(datetime.utcnow())
-        if waiting_prompt.source_processing != 'img2img' and not self.allow_painting:
-            return [False, 'painting']
-        #logger.warning(datetime.utcnow())
-        if not waiting_prompt.safe_ip and not self.allow_unsafe_ipaddr:
-            return [False, 'unsafe_ip']
-        # We do not give untrusted workers anon or VPN generations, to avoid anything slipping by and spooking them.
-        #logger.warning(datetime.utcnow())
-        if not self.user.trusted:
-            # if waiting_prompt.user.is_anon():
-            #    return [False, 'untrusted']
-            if not waiting_prompt.safe_ip and not waiting_prompt.user.trusted:
-                return [False, 'untrusted']
-        if not self.allow_post_processing and len(waiting_prompt.gen_payload.get('post_processing', [])) >= 1:
-            return [False, 'post-processing']
         # When the worker requires upfront kudos, the user has to have the required kudos upfront
         # But we allowe prioritized and trusted users to bypass this
         if self.requires_upfront_kudos:
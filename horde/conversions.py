@@ -3,6 +3,8 @@ import os
 import json
 from datetime import datetime
 
+from sqlalchemy import inspect, text
+
 from horde.database import functions as database
 from horde.logger import logger
 from horde.flask import db
@@ -10,6 +12,7 @@ from horde.vars import thing_name, thing_divisor, raw_thing_name
 from horde.suspicions import Suspicions, SUSPICION_LOGS
 from horde.classes import User, Worker, Team, stats
 from horde.utils import hash_api_key
+from horde.classes.base.model import get_model_id, get_model_set_id
 
 
 def convert_json_db():
@@ -157,3 +160,41 @@ def convert_stats(filename):
         db.session.add(new_f)
     logger.message("Converted Fulfillments")
     db.session.commit()
+
+
+def convert_model_registry():
+    '''Moves the model names stored by existing deployments into the model registry and exits
+    wp_models rows get the id of their model, and workers get the model set of the models they served.
+    The old model name column and the worker_models table are dropped afterwards.
+    This uses postgres DDL, so it's not meant for SQLite.
+    '''
+    db.session.execute(text("ALTER TABLE wp_models ADD COLUMN IF NOT EXISTS model_id INTEGER REFERENCES models(id)"))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_wp_models_model_id ON wp_models (model_id)"))
+    db.session.execute(text("ALTER TABLE workers ADD COLUMN IF NOT EXISTS model_set_id INTEGER REFERENCES model_sets(id)"))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_workers_model_set_id ON workers (model_set_id)"))
+    inspector = inspect(db.engine)
+    if "model" in [column["name"] for column in inspector.get_columns("wp_models")]:
+        wp_model_names = [row.model for row in db.session.execute(text("SELECT DISTINCT model FROM wp_models"))]
+        for model_name in wp_model_names:
+            db.session.execute(
+                text("UPDATE wp_models SET model_id = :model_id WHERE model = :model_name"),
+                {"model_id": get_model_id(model_name), "model_name": model_name},
+            )
+        db.session.execute(text("ALTER TABLE wp_models DROP COLUMN model"))
+        db.session.execute(text("ALTER TABLE wp_models ALTER COLUMN model_id SET NOT NULL"))
+        logger.message(f"Converted the models of queued requests to {len(wp_model_names)} registered models")
+    if inspector.has_table("worker_models"):
+        worker_models = {}
+        for row in db.session.execute(text("SELECT worker_id, model FROM worker_models")):
+            if row.model is None:
+                continue
+            worker_models.setdefault(row.worker_id, set()).add(row.model)
+        for worker_id, model_names in worker_models.items():
+            db.session.execute(
+                text("UPDATE workers SET model_set_id = :model_set_id WHERE id = :worker_id"),
+                {"model_set_id": get_model_set_id(model_names), "worker_id": worker_id},
+            )
+        db.session.execute(text("DROP TABLE worker_models"))
+        logger.message(f"Converted the models of {len(worker_models)} workers to model sets")
+    db.session.commit()
+    sys.exit()
@@ -1,6 +1,6 @@
 from horde.threads import PrimaryTimedFunction
 from horde.database.classes import Quorum
-from horde.database.threads import get_quorum, store_prioritized_wp_queue, check_waiting_prompts, assign_monthly_kudos, store_worker_list, store_available_models, store_totals, prune_stats, store_patreon_members, increment_extra_priority, check_interrogations
+from horde.database.threads import get_quorum, store_prioritized_wp_queue, check_waiting_prompts, assign_monthly_kudos, store_worker_list, store_available_models, store_totals, prune_stats, store_patreon_members, check_interrogations, store_worker_index, check_stale_procgens, store_forecasts, refresh_personal_ids
 from horde.horde_redis import horde_r
 
 # Threads
@@ -9,9 +9,12 @@ wp_list_cacher = PrimaryTimedFunction(1, store_prioritized_wp_queue, quorum=quor
 worker_cacher = PrimaryTimedFunction(25, store_worker_list, quorum=quorum)
 model_cacher = PrimaryTimedFunction(10, store_available_models, quorum=quorum)
 wp_cleaner = PrimaryTimedFunction(60, check_waiting_prompts, quorum=quorum)
+procgen_cleaner = PrimaryTimedFunction(5, check_stale_procgens, quorum=quorum)
 interrogations_cleaner = PrimaryTimedFunction(60, check_interrogations, quorum=quorum)
 monthly_kudos = PrimaryTimedFunction(86400, assign_monthly_kudos, quorum=quorum)
 totals_store = PrimaryTimedFunction(60, store_totals, quorum=quorum)
 prune_stats = PrimaryTimedFunction(60, prune_stats, quorum=quorum)
 patreon_cacher = PrimaryTimedFunction(3600, store_patreon_members, quorum=quorum)
-priority_increaser = PrimaryTimedFunction(10, increment_extra_priority, quorum=quorum)
\ No newline at end of file
+worker_index_cacher = PrimaryTimedFunction(30, store_worker_index, quorum=quorum)
+forecast_updater = PrimaryTimedFunction(10, store_forecasts, quorum=quorum)
+personal_ids_refresher = PrimaryTimedFunction(30, refresh_personal_ids, quorum=quorum)
\ No newline at end of file
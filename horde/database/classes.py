@@ -1,8 +1,6 @@
 import time
-import uuid
 import json
 import threading
-from datetime import datetime, timedelta
 from horde.argparser import args
 
 from horde.logger import logger
@@ -12,12 +10,15 @@ from horde import horde_instance_id
 from horde.threads import PrimaryTimedFunction
 
 class FakeWPRow:
-    def __init__(self,json_row):
-        self.id = uuid.UUID(json_row["id"])
-        self.things = json_row["things"]
-        self.n = json_row["n"]
-        self.extra_priority = json_row["extra_priority"]
-        self.created = datetime.strptime(json_row["created"],"%Y-%m-%d %H:%M:%S")
+    '''A lightweight row of the cached WP queue. Many of these are kept in memory, so we avoid a __dict__ for each'''
+    __slots__ = ("id", "things", "n", "queue_priority", "created")
+
+    def __init__(self, id, things, n, queue_priority, created):
+        self.id = id
+        self.things = things
+        self.n = n
+        self.queue_priority = queue_priority
+        self.created = created
 
 
 class Quorum(PrimaryTimedFunction):
@@ -3,11 +3,11 @@ import time
 import uuid
 import json
 from datetime import datetime, timedelta
-from sqlalchemy import func, or_, and_
+from sqlalchemy import func, or_, and_, case, cast
 from sqlalchemy.exc import DataError
 
-from horde.classes.base.waiting_prompt import WPModels
-from horde.classes.base.worker import WorkerModel
+from horde.classes.base.waiting_prompt import WPModels, WPAllowedWorkers, WPTrickedWorkers
+from horde.classes.base.model import ModelSetMember, get_model_ids, get_model_names
 from horde.flask import db, SQLITE_MODE
 from horde.logger import logger
 from horde.vars import thing_name,thing_divisor
@@ -16,11 +16,21 @@ from horde.classes.stable.interrogation import Interrogation, InterrogationForms
 from horde.classes.stable.interrogation_worker import InterrogationWorker
 from horde.utils import hash_api_key
 from horde.horde_redis import horde_r
-from horde.database.classes import FakeWPRow, PrimaryTimedFunction
+from horde.database.classes import PrimaryTimedFunction
+from horde.database.wp_cache import retrieve_wp_queue
 from horde.enums import State
+from horde.matchmaking import get_cached_profile_candidates, cache_profile_candidates, can_share_profile_candidates
+from horde.assignment import order_by_shift, PRIORITY_BAND_SIZE, RELIABILITY_THRESHOLD
+from horde.worker_index import has_capable_worker
+from horde.queue_positions import get_queue_positions, retrieve_queue_position
+from horde.argparser import args
 
 
 ALLOW_ANONYMOUS = True
+# The figures of the active workers which the assignment policy compares each worker against
+# These change slowly, so each node only refreshes them every minute
+ASSIGNMENT_STATS_TTL = 60
+assignment_stats = {"time": 0}
 
 def get_anon():
     return find_user_by_api_key('anon')
@@ -169,25 +179,30 @@ def find_team_by_name(team_name):
 def get_available_models():
     models_dict = {}
     available_worker_models = db.session.query(
-        WorkerModel.model,
-        func.count(WorkerModel.model).label('total_models'), # TODO: This needs to be multiplied by this worker's threads
-        # Worker.id.label('worker_id') # TODO: make the query return a list or workers serving this model?
+        ModelSetMember.model_id,
+        Worker.id.label('worker_id'),
     ).join(
         Worker,
+        Worker.model_set_id == ModelSetMember.model_set_id,
     ).filter(
         Worker.last_check_in > datetime.utcnow() - timedelta(seconds=300)
-    ).group_by(WorkerModel.model).all()
-
+    ).all()
+    model_workers = {}
     for model_row in available_worker_models:
-        model_name = model_row.model
+        if model_row.model_id not in model_workers:
+            model_workers[model_row.model_id] = []
+        model_workers[model_row.model_id].append(str(model_row.worker_id))
+
+    available_model_ids = list(model_workers.keys())
+    for model_id, model_name in zip(available_model_ids, get_model_names(available_model_ids)):
         models_dict[model_name] = {}
         models_dict[model_name]["name"] = model_name
-        models_dict[model_name]["count"] = model_row.total_models
+        models_dict[model_name]["count"] = len(model_workers[model_id]) # TODO: This needs to be multiplied by this worker's threads
 
         models_dict[model_name]['queued'] = 0
         models_dict[model_name]['eta'] = 0
         models_dict[model_name]['performance'] = stats.get_model_avg(model_name) #TODO: Currently returns 1000000
-        models_dict[model_name]['workers'] = []
+        models_dict[model_name]['workers'] = model_workers[model_id]
 
     # We don't want to report on any random model name a client might request
     try:
@@ -197,16 +212,15 @@ def get_available_models():
         logger.error(f"Error when downloading known models list: {e}")
         known_models = []
     ophan_models = db.session.query(
-        WPModels.model,
+        WPModels.model_id,
     ).join(
         WaitingPrompt,
     ).filter(
-        WPModels.model.not_in(list(models_dict.keys())),
-        WPModels.model.in_(known_models),
+        WPModels.model_id.not_in(available_model_ids),
+        WPModels.model_id.in_(get_model_ids(known_models, create=False)),
         WaitingPrompt.n > 0,
-    ).group_by(WPModels.model).all()
-    for model_row in ophan_models:
-        model_name = model_row.model
+    ).group_by(WPModels.model_id).all()
+    for model_name in get_model_names([model_row.model_id for model_row in ophan_models]):
         models_dict[model_name] = {}
         models_dict[model_name]["name"] = model_name
         models_dict[model_name]["count"] = 0
@@ -242,6 +256,45 @@ def retrieve_available_models():
         models_ret = get_available_models()
     return(models_ret)
 
+def get_model_demand(available_models):
+    '''Ranks the models by how much is waiting to be generated for each worker running them'''
+    model_demand = []
+    for model in available_models:
+        if model["queued"] <= 0:
+            continue
+        queued = round(model["queued"] / thing_divisor, 2)
+        model_demand.append({
+            "name": model["name"],
+            "queued": queued,
+            "count": model["count"],
+            # Models without workers are the most in need
+            "queued_per_worker": round(queued / model["count"], 2) if model["count"] > 0 else queued,
+        })
+    model_demand.sort(key=lambda m: (m["count"] > 0, -m["queued_per_worker"]))
+    return model_demand
+
+def retrieve_model_demand():
+    '''Retrieves the model demand snapshot from the Redis cache'''
+    model_demand_cache = horde_r.get('model_demand_cache')
+    try:
+        model_demand = json.loads(model_demand_cache)
+    except TypeError:
+        logger.error(f"Model demand cache could not be loaded: {model_demand_cache}")
+        return([])
+    return(model_demand)
+
+def retrieve_model_workers():
+    '''Retrieves the ids of the active workers serving each model from the Redis cache
+    Returns an empty dict if the cache is unavailable
+    '''
+    model_workers_cache = horde_r.get('model_workers_cache')
+    try:
+        model_workers = json.loads(model_workers_cache)
+    except TypeError:
+        logger.error(f"Model workers cache could not be loaded: {model_workers_cache}")
+        return({})
+    return(model_workers)
+
 def transfer_kudos(source_user, dest_user, amount):
     if source_user.is_suspicious():
         return([0,'Something went wrong when sending kudos. Please contact the mods.'])
@@ -291,7 +344,7 @@ def count_waiting_requests(user, models = None):
         ).join(
             WaitingPrompt
         ).filter(
-            WPModels.model.in_(models),
+            WPModels.model_id.in_(get_model_ids(models, create=False)),
             WaitingPrompt.user_id == user.id,
             WaitingPrompt.faulted == False,
             WaitingPrompt.n >= 1, 
@@ -394,20 +447,23 @@ def retrieve_totals():
 def get_organized_wps_by_model():
     org = {}
     #TODO: Offload the sorting to the DB through join() + SELECT statements
-    all_wps = db.session.query(
-        WaitingPrompt
+    all_wp_models = db.session.query(
+        WaitingPrompt,
+        WPModels.model_id,
+    ).join(
+        WPModels,
     ).filter(
         WaitingPrompt.faulted == False,
         WaitingPrompt.n >= 1,
     ).all() # TODO this can likely be improved
-    for wp in all_wps:
-        # Each wp we have will be placed on the list for each of it allowed models (in case it's selected multiple)
-        # This will inflate the overall expected times, but it shouldn't be by much.
-        # I don't see a way to do this calculation more accurately though
-        for model in wp.get_model_names():
-            if model not in org:
-                org[model] = []
-            org[model].append(wp)
+    # Each wp we have will be placed on the list for each of it allowed models (in case it's selected multiple)
+    # This will inflate the overall expected times, but it shouldn't be by much.
+    # I don't see a way to do this calculation more accurately though
+    for wp, model_id in all_wp_models:
+        model = get_model_names([model_id])[0]
+        if model not in org:
+            org[model] = []
+        org[model].append(wp)
     return(org)    
 
 def count_things_per_model():
@@ -422,46 +478,46 @@ def count_things_per_model():
     return(things_per_model)
 
 
-def get_sorted_wp_filtered_to_worker(worker, models_list = None, blacklist = None): 
+def get_sorted_wp_filtered_to_worker(worker, models_list = None, blacklist = None, priority_user_ids = None, use_profile_cache = True): 
     # This is just the top 100 - Adjusted method to send Worker object. Filters to add.
     # TODO: Ensure the procgen table is NOT retrieved along with WPs (because it contains images)
-    # TODO: Filter by (Worker in WP.workers) __ONLY IF__ len(WP.workers) >=1 
-    # TODO: Filter by WP.trusted_workers == False __ONLY IF__ Worker.user.trusted == False
-    # TODO: Filter by Worker not in WP.tricked_worker
-    # TODO: If any word in the prompt is in the WP.blacklist rows, then exclude it (L293 in base.worker.Worker.gan_generate())
-    final_wp_list = db.session.query(
+    # The trusted_workers requirement is part of the WP requirement_mask
+    if models_list is None:
+        models_list = worker.get_model_names()
+    if priority_user_ids is None:
+        priority_user_ids = []
+    # The worker blacklist is not filtered here, as can_generate() already matches it against each prompt
+    # This also allows workers with different blacklists to share the same profile
+    # Workers prioritizing users who have queued WPs get their own ordering
+    # and workers specifically included or excluded by some WPs get their own candidates
+    # so only the rest share the profile cache
+    # When use_profile_cache is False, we still refresh the cache for the rest of the profile
+    profile_key = None
+    if can_share_profile_candidates(worker.id, priority_user_ids):
+        profile_key = worker.get_profile_key()
+        cached_ids = None
+        if use_profile_cache:
+            cached_ids = get_cached_profile_candidates(profile_key)
+        if cached_ids is not None:
+            return apply_assignment_policy(worker, get_cached_wps(cached_ids), priority_user_ids)
+    final_wp_query = db.session.query(
         WaitingPrompt
-    ).join(
-        WPModels
     ).filter(
         WaitingPrompt.n > 0,
-        WPModels.model.in_(models_list),
+        # We use EXISTS instead of a join, so that WPs requesting multiple of our models are not returned multiple times
+        db.session.query(
+            WPModels.id
+        ).filter(
+            WPModels.wp_id == WaitingPrompt.id,
+            WPModels.model_id.in_(get_model_ids(models_list, create=False)),
+        ).exists(),
         WaitingPrompt.width * WaitingPrompt.height <= worker.max_pixels,
         WaitingPrompt.active == True,
         WaitingPrompt.faulted == False,
         WaitingPrompt.expiry > datetime.utcnow(),
-        or_(
-            WaitingPrompt.source_image == None,
-            and_(
-                WaitingPrompt.source_image != None,
-                worker.allow_img2img == True,
-            ),
-            
-        ),
-        or_(
-            WaitingPrompt.safe_ip == True,
-            and_(
-                WaitingPrompt.safe_ip == False,
-                worker.allow_unsafe_ipaddr == True,
-            ),
-        ),
-        or_(
-            WaitingPrompt.nsfw == False,
-            and_(
-                WaitingPrompt.nsfw == True,
-                worker.nsfw == True,
-            ),
-        ),
+        # The worker needs to offer every capability the WP requires
+        WaitingPrompt.requirement_mask.op('&')(worker.capability_mask) == WaitingPrompt.requirement_mask,
+        WaitingPrompt.min_bridge_version <= worker.bridge_version,
         or_(
             worker.maintenance == False,
             and_(
@@ -476,11 +532,145 @@ def get_sorted_wp_filtered_to_worker(worker, models_list = None, blacklist = Non
                 WaitingPrompt.r2 == False,
             ),
         ),
-    ).order_by(
-        WaitingPrompt.extra_priority.desc(), 
-        WaitingPrompt.created.asc()
+        # WPs which only allow specific workers are skipped unless this worker is one of them
+        or_(
+            ~db.session.query(
+                WPAllowedWorkers.id
+            ).filter(
+                WPAllowedWorkers.wp_id == WaitingPrompt.id,
+            ).exists(),
+            db.session.query(
+                WPAllowedWorkers.id
+            ).filter(
+                WPAllowedWorkers.wp_id == WaitingPrompt.id,
+                WPAllowedWorkers.worker_id == worker.id,
+            ).exists(),
+        ),
+        # If the worker has been tricked once by this prompt, we don't want to resend it it
+        ~db.session.query(
+            WPTrickedWorkers.id
+        ).filter(
+            WPTrickedWorkers.wp_id == WaitingPrompt.id,
+            WPTrickedWorkers.worker_id == worker.id,
+        ).exists(),
+    )
+    final_wp_list = final_wp_query.order_by(
+        # The WPs of the users prioritized by the worker always come first
+        case((WaitingPrompt.user_id.in_(priority_user_ids), 0), else_=1),
+        *get_queue_order()
     ).limit(100).all()
-    return final_wp_list
+    if profile_key is not None:
+        cache_profile_candidates(profile_key, [wp.id for wp in final_wp_list], models_list)
+    return apply_assignment_policy(worker, final_wp_list, priority_user_ids)
+
+def get_queue_order():
+    '''Returns the ORDER BY clauses of the queue, according to the queue order
+    See assignment.get_queue_order_key(), which sorts the same way
+    '''
+    if args.queue_order == "sjf":
+        return [
+            cast(WaitingPrompt.queue_priority / PRIORITY_BAND_SIZE, db.BigInteger).desc(),
+            (WaitingPrompt.things * WaitingPrompt.n).asc(),
+            WaitingPrompt.created.asc(),
+        ]
+    return [
+        WaitingPrompt.queue_priority.desc(),
+        WaitingPrompt.created.asc(),
+    ]
+
+def get_assignment_stats():
+    if time.time() - assignment_stats["time"] < ASSIGNMENT_STATS_TTL:
+        return assignment_stats
+    active_workers_filter = Worker.last_check_in > datetime.utcnow() - timedelta(seconds=300)
+    average_speed = db.session.query(
+        func.avg(WorkerPerformance.performance)
+    ).join(
+        Worker,
+    ).filter(
+        active_workers_filter
+    ).scalar()
+    worker_capacities = []
+    # Only the workers generating images have a max_pixels
+    if hasattr(Worker, "max_pixels"):
+        worker_capacities = sorted([
+            w.max_pixels for w in db.session.query(Worker.max_pixels).filter(active_workers_filter).all()
+        ])
+    assignment_stats["average_speed"] = average_speed
+    assignment_stats["worker_capacities"] = worker_capacities
+    assignment_stats["time"] = time.time()
+    return assignment_stats
+
+def apply_assignment_policy(worker, wps, priority_user_ids):
+    '''Adjusts the queue order to this worker
+    Unreliable workers always have the time sensitive WPs moved further down,
+    while the fit policy also takes into account how well each WP fits this worker.
+    The WPs of the prioritized users are still always offered first
+    '''
+    if len(wps) <= 1:
+        return wps
+    fit_policy = args.assignment_policy == "fit"
+    if not fit_policy and worker.get_reliability_score() >= RELIABILITY_THRESHOLD:
+        return wps
+    stats = None
+    if fit_policy:
+        stats = get_assignment_stats()
+    prioritized_wps = [wp for wp in wps if wp.user_id in priority_user_ids]
+    other_wps = [wp for wp in wps if wp.user_id not in priority_user_ids]
+    ordered_wps = []
+    for wps_band in [prioritized_wps, other_wps]:
+        shifts = []
+        for wp in wps_band:
+            shift = worker.get_reliability_shift(wp)
+            if fit_policy:
+                shift += worker.get_assignment_shift(wp, stats)
+            shifts.append(shift)
+        ordered_wps += order_by_shift(wps_band, shifts)
+    return ordered_wps
+
+def query_personal_ids():
+    '''Returns the ids of the workers which any queued WP specifically allows or excludes
+    along with the ids of the users who have WPs in the queue
+    '''
+    queued_filters = [
+        WaitingPrompt.n > 0,
+        WaitingPrompt.faulted == False,
+        WaitingPrompt.active == True,
+    ]
+    worker_ids = set()
+    for personal_table in [WPAllowedWorkers, WPTrickedWorkers]:
+        personal_workers = db.session.query(
+            personal_table.worker_id
+        ).join(
+            WaitingPrompt,
+            personal_table.wp_id == WaitingPrompt.id,
+        ).filter(
+            *queued_filters
+        ).distinct().all()
+        worker_ids.update([str(w.worker_id) for w in personal_workers])
+    queued_users = db.session.query(
+        WaitingPrompt.user_id
+    ).filter(
+        *queued_filters
+    ).distinct().all()
+    return worker_ids, [str(u.user_id) for u in queued_users]
+
+def get_cached_wps(wp_ids):
+    '''Loads the cached candidate WPs which are still in the queue, in their cached order'''
+    if len(wp_ids) == 0:
+        return []
+    if not SQLITE_MODE:
+        wp_ids = [uuid.UUID(wp_id) for wp_id in wp_ids]
+    wps = db.session.query(
+        WaitingPrompt
+    ).filter(
+        WaitingPrompt.id.in_(wp_ids),
+        WaitingPrompt.n > 0,
+        WaitingPrompt.active == True,
+        WaitingPrompt.faulted == False,
+        WaitingPrompt.expiry > datetime.utcnow(),
+    ).all()
+    wps_by_id = {wp.id: wp for wp in wps}
+    return [wps_by_id[wp_id] for wp_id in wp_ids if wp_id in wps_by_id]
 
 def get_sorted_forms_filtered_to_worker(worker, forms_list = None, priority_user_ids = None, excluded_forms = None): 
     # Currently the worker is not being used, but I leave it being sent in case we need it later for filtering
@@ -535,24 +725,16 @@ def get_sorted_forms_filtered_to_worker(worker, forms_list = None, priority_user
 def get_wp_queue_stats(wp):
     if not wp.needs_gen():
         return(-1,0,0)
-    things_ahead_in_queue = 0
-    n_ahead_in_queue = 0
+    queue_position = retrieve_queue_position(wp.id)
+    if queue_position is not None:
+        return queue_position
     priority_sorted_list = retrieve_prioritized_wp_queue()
     # In case the primary thread has borked, we fall back to the DB
     if priority_sorted_list is None:
         logger.warning("Cached WP priority query does not exist. Falling back to direct DB query. Please check thread on primary!")
         priority_sorted_list = query_prioritized_wps()
-    # logger.info(priority_sorted_list)
-    for iter in range(len(priority_sorted_list)):
-        iter_wp = priority_sorted_list[iter]
-        queued_things = round(iter_wp.things * iter_wp.n/thing_divisor,2)
-        things_ahead_in_queue += queued_things
-        n_ahead_in_queue += iter_wp.n
-        if iter_wp.id == wp.id:
-            things_ahead_in_queue = round(things_ahead_in_queue,2)
-            return(iter, things_ahead_in_queue, n_ahead_in_queue)
     # -1 means the WP is done and not in the queue
-    return(-1,0,0)
+    return get_queue_positions(priority_sorted_list).get(str(wp.id), (-1,0,0))
 
 
 def get_wp_by_id(wp_id):
@@ -575,6 +757,21 @@ def get_progen_by_id(procgen_id):
         procgen_uuid = str(procgen_uuid)
     return db.session.query(ProcessingGeneration).filter_by(id=procgen_uuid).first()
 
+def get_progens_by_ids(procgen_ids):
+    procgen_uuids = []
+    for procgen_id in procgen_ids:
+        try:
+            procgen_uuid = uuid.UUID(procgen_id)
+        except ValueError as e: 
+            logger.debug(f"Non-UUID procgen_id sent: '{procgen_id}'.")
+            continue
+        if SQLITE_MODE:
+            procgen_uuid = str(procgen_uuid)
+        procgen_uuids.append(procgen_uuid)
+    if len(procgen_uuids) == 0:
+        return []
+    return db.session.query(ProcessingGeneration).filter(ProcessingGeneration.id.in_(procgen_uuids)).all()
+
 def get_interrogation_by_id(i_id):
     try:
         i_uuid = uuid.UUID(i_id)
@@ -603,42 +800,25 @@ def get_worker_performances():
     return [p.performance for p in db.session.query(WorkerPerformance.performance).all()]
 
 def wp_has_valid_workers(wp, limited_workers_ids = None):
+    '''Checks the worker capability index for any active worker which could generate this WP
+    The worker blacklists are not taken into account
+    '''
     if not limited_workers_ids: limited_workers_ids = []
-    # FIXME: Too heavy
-    # TODO: Redis cached
-    return True
-    worker_found = False
-    for worker in get_active_workers():
-        if len(limited_workers_ids) and worker not in wp.get_worker_ids():
-            continue
-        if worker.can_generate(wp)[0]:
-            worker_found = True
-            break
-    return worker_found
+    tags = wp.get_matchmaking_tags()
+    tags["models"] = wp.get_model_names()
+    return has_capable_worker(tags, limited_workers_ids)
 
 @logger.catch(reraise=True)
 def retrieve_prioritized_wp_queue():
-    cached_queue = horde_r.get('wp_cache')
-    if cached_queue is None:
-        return None
-    try:
-        retrieved_json_list = json.loads(cached_queue)
-    except (TypeError, OverflowError) as e:
-        logger.error(f"Failed deserializing with error: {e}")
-        return None
-    deserialized_wp_list = []
-    for json_row in retrieved_json_list:
-        fake_wp_row = FakeWPRow(json_row)
-        deserialized_wp_list.append(fake_wp_row)
-    # logger.debug(len(deserialized_wp_list))
-    return deserialized_wp_list
+    '''Each process only decodes the cached queue once per version, so we can call this on every status check'''
+    return retrieve_wp_queue()
 
 def query_prioritized_wps():
     return db.session.query(
                 WaitingPrompt.id, 
                 WaitingPrompt.things, 
                 WaitingPrompt.n, 
-                WaitingPrompt.extra_priority, 
+                WaitingPrompt.queue_priority, 
                 WaitingPrompt.created,
                 WaitingPrompt.expiry,
             ).filter(
@@ -646,7 +826,7 @@ def query_prioritized_wps():
                 WaitingPrompt.faulted == False,
                 WaitingPrompt.active == True,
             ).order_by(
-                WaitingPrompt.extra_priority.desc(), WaitingPrompt.created.asc()
+                *get_queue_order()
             ).all()
 
 
@@ -8,17 +8,21 @@ from datetime import datetime, timedelta
 from sqlalchemy import func, or_
 
 from horde.horde_redis import horde_r
-from horde.classes import WaitingPrompt, User, ProcessingGeneration
+from horde.classes import WaitingPrompt, User, ProcessingGeneration, stats
 from horde.classes.stable.interrogation import Interrogation, InterrogationForms
 from horde.flask import HORDE, db, SQLITE_MODE
 from horde.logger import logger
-from horde.database.functions import query_prioritized_wps, get_active_workers, get_available_models, count_totals, prune_expired_stats
+from horde.database.functions import query_prioritized_wps, query_personal_ids, get_active_workers, get_available_models, get_model_demand, count_totals, prune_expired_stats
 from horde import horde_instance_id
 from horde.argparser import args
 from horde.r2 import delete_procgen_image, delete_source_image
 from horde.argparser import args
 from horde.patreon import patrons
 from horde.enums import State
+from horde.matchmaking import announce_waiting_prompt, store_personal_ids
+from horde.worker_index import rebuild_worker_index
+from horde.queue_positions import store_queue_positions
+from horde.database.wp_cache import store_wp_queue
 
 @logger.catch(reraise=True)
 def get_quorum():
@@ -58,26 +62,24 @@ def assign_monthly_kudos():
 
 @logger.catch(reraise=True)
 def store_prioritized_wp_queue():
-    '''Stores the retrieved WP queue as json for 1 second horde-wide'''
+    '''Stores the retrieved WP queue for 1 second horde-wide, along with the queue position of each WP'''
     with HORDE.app_context():
         wp_queue = query_prioritized_wps()
-        serialized_wp_list = []
-        for wp in wp_queue:
-            wp_json = {
-                "id": str(wp.id),
-                "things": wp.things, 
-                "n": wp.n, 
-                "extra_priority": wp.extra_priority, 
-                "created": wp.created.strftime("%Y-%m-%d %H:%M:%S"),
-            }
-            serialized_wp_list.append(wp_json)
-        try:
-            cached_queue = json.dumps(serialized_wp_list)
-            # We set the expiry in redis to 10 seconds, in case the primary thread dies
-            # However the primary thread is set to set the cache every 1 second
-            horde_r.setex('wp_cache', timedelta(seconds=10), cached_queue)
-        except (TypeError, OverflowError) as e:
-            logger.error(f"Failed serializing with error: {e}")
+        # We set the expiry in redis to 10 seconds, in case the primary thread dies
+        # However the primary thread is set to set the cache every 1 second
+        store_wp_queue(wp_queue, expiry=10)
+        store_queue_positions(wp_queue, expiry=10)
+
+
+@logger.catch(reraise=True)
+def refresh_personal_ids():
+    '''Rebuilds the workers and users which cannot use the shared profile candidates
+    New WPs add theirs as soon as they're queued, so this only needs to clear the ones which aren't needed anymore
+    '''
+    with HORDE.app_context():
+        queried_at = time.time()
+        worker_ids, user_ids = query_personal_ids()
+        store_personal_ids(worker_ids, user_ids, queried_at)
 
 
 
@@ -134,7 +136,8 @@ def check_waiting_prompts():
         logger.info(f"Pruned {expired_wps.count()} expired Waiting Prompts")
         expired_wps.delete()
         db.session.commit()
-        # Faults stale ProcGens
+        # Faults stale ProcGens which were started without a deadline
+        # The ones with a deadline are handled by check_stale_procgens()
         all_proc_gen = db.session.query(
             ProcessingGeneration,
         ).join(
@@ -142,20 +145,17 @@ def check_waiting_prompts():
         ).filter(
             ProcessingGeneration.generation == None,
             ProcessingGeneration.faulted == False,
-            # datetime.utcnow() - ProcessingGeneration.start_time > WaitingPrompt.job_ttl, # How do we calculate this in the query? Maybe I need to set an expiry time iun procgen as well better?
+            ProcessingGeneration.deadline == None,
         ).all()
-        for proc_gen in all_proc_gen:
-            if proc_gen.is_stale(proc_gen.wp.job_ttl):
-                proc_gen.abort()
-                proc_gen.wp.n += 1
-        if len(all_proc_gen) >= 1:
-            db.session.commit()
+        requeue_stale_procgens(all_proc_gen)
 
         # Faults WP with 3 or more faulted Procgens
         wp_ids = db.session.query(
             ProcessingGeneration.wp_id, 
         ).filter(
-            ProcessingGeneration.faulted == True
+            ProcessingGeneration.faulted == True,
+            # Cancelled procgens, such as duplicates which lost to another worker, are not faults
+            ProcessingGeneration.cancelled == False,
         ).group_by(
             ProcessingGeneration.wp_id
         ).having(func.count(ProcessingGeneration.wp_id) > 2)
@@ -167,6 +167,74 @@ def check_waiting_prompts():
         for wp in waiting_prompts.all():
             wp.log_faulted_prompt()
 
+def requeue_stale_procgens(procgens):
+    '''Aborts the stale procgens and puts their jobs back into the queue'''
+    requeued_wps = set()
+    for proc_gen in procgens:
+        if proc_gen.is_stale(proc_gen.wp.job_ttl):
+            proc_gen.abort()
+            # A duplicate might already be covering this job
+            if proc_gen.wp.hedges > 0:
+                proc_gen.wp.resolve_hedges()
+            else:
+                proc_gen.wp.n += 1
+            requeued_wps.add(proc_gen.wp)
+    if len(procgens) >= 1:
+        db.session.commit()
+    # The workers waiting for new jobs can pick up the ones we put back in the queue
+    for wp in requeued_wps:
+        if wp.active and not wp.faulted and wp.n > 0:
+            announce_waiting_prompt(wp.get_model_names())
+
+@logger.catch(reraise=True)
+def check_stale_procgens():
+    '''Requeues the jobs whose procgens went past their deadline'''
+    with HORDE.app_context():
+        stale_procgens = db.session.query(
+            ProcessingGeneration,
+        ).filter(
+            ProcessingGeneration.deadline < datetime.utcnow(),
+            ProcessingGeneration.generation == None,
+            ProcessingGeneration.faulted == False,
+        ).all()
+        if len(stale_procgens) > 0:
+            logger.info(f"Requeuing {len(stale_procgens)} jobs which went past their deadline")
+        requeue_stale_procgens(stale_procgens)
+        if args.hedge_jobs:
+            hedge_straggling_jobs()
+
+def hedge_straggling_jobs():
+    '''Duplicates the last job of multi-job WPs, when it is taking longer than expected'''
+    outstanding_procgens = db.session.query(
+        ProcessingGeneration,
+    ).join(
+        WaitingPrompt,
+    ).filter(
+        WaitingPrompt.n == 0,
+        WaitingPrompt.jobs > 1,
+        WaitingPrompt.hedges == 0,
+        WaitingPrompt.active == True,
+        WaitingPrompt.faulted == False,
+        ProcessingGeneration.generation == None,
+        ProcessingGeneration.faulted == False,
+        ProcessingGeneration.fake == False,
+    ).all()
+    procgens_per_wp = {}
+    for procgen in outstanding_procgens:
+        procgens_per_wp.setdefault(procgen.wp_id, []).append(procgen)
+    for procgens in procgens_per_wp.values():
+        # We only hedge the very last job
+        if len(procgens) != 1:
+            continue
+        if procgens[0].is_straggling():
+            procgens[0].wp.hedge()
+
+@logger.catch(reraise=True)
+def store_worker_index():
+    '''Rebuilds the worker capability index from the DB, in case any check-ins were missed'''
+    with HORDE.app_context():
+        rebuild_worker_index(get_active_workers(), 30)
+
 @logger.catch(reraise=True)
 def check_interrogations():
     with HORDE.app_context():
@@ -195,9 +263,14 @@ def check_interrogations():
 def store_available_models():
     '''Stores the retrieved model details as json for 5 seconds horde-wide'''
     with HORDE.app_context():
-        json_models = json.dumps(get_available_models())
+        available_models = get_available_models()
+        # The model workers are also stored on their own, so that we can check concurrency without retrieving all model details
+        model_workers = {model["name"]: model["workers"] for model in available_models}
         try:
+            json_models = json.dumps(available_models)
             horde_r.setex('models_cache', timedelta(seconds=60), json_models)
+            horde_r.setex('model_workers_cache', timedelta(seconds=60), json.dumps(model_workers))
+            horde_r.setex('model_demand_cache', timedelta(seconds=60), json.dumps(get_model_demand(available_models)))
         except (TypeError, OverflowError) as e:
             logger.error(f"Failed serializing workers with error: {e}")
 
@@ -211,6 +284,12 @@ def store_totals():
         except (TypeError, OverflowError) as e:
             logger.error(f"Failed serializing totals with error: {e}")
 
+@logger.catch(reraise=True)
+def store_forecasts():
+    '''Updates the per-model throughput forecasts with the latest performances'''
+    with HORDE.app_context():
+        stats.update_forecasts()
+
 @logger.catch(reraise=True)
 def prune_stats():
     '''Prunes performances which are too old'''
@@ -263,17 +342,3 @@ def store_patreon_members():
         active_members[user_id] = member_dict
     cached_patreons = json.dumps(active_members)
     horde_r.set('patreon_cache', cached_patreons)
-
-
-@logger.catch(reraise=True)
-def increment_extra_priority():
-    '''Increases the priority of every WP currently in the queue by 50 kudos'''
-    with HORDE.app_context():
-        wp_queue = db.session.query(
-            WaitingPrompt
-        ).update(
-            {
-                WaitingPrompt.extra_priority: WaitingPrompt.extra_priority + 50
-            }, synchronize_session=False
-        )
-        db.session.commit()
@@ -0,0 +1,80 @@
+import struct
+import threading
+from datetime import timedelta
+
+from horde.logger import logger
+from horde.horde_redis import horde_r, horde_r_binary
+from horde.database.classes import FakeWPRow
+from horde.wp_snapshot import pack_snapshot, pack_wp_queue, unpack_wp_queue
+
+# The WP queue cache is stored as a packed array of fixed-width records, behind a small header. See horde/wp_snapshot.py
+# Every snapshot gets a new version, which is also stored on its own key,
+# so that each process only downloads and decodes the queue when it has changed.
+WP_CACHE_KEY = "wp_cache"
+WP_CACHE_VERSION_KEY = "wp_cache_version"
+# This never expires, so that versions are never reused, even when another node becomes the primary
+WP_CACHE_COUNTER_KEY = "wp_cache_counter"
+
+last_stored = {
+    "records": None,
+}
+# The version and the rows of the last snapshot this process decoded
+decoded_cache = {
+    "snapshot": (None, None),
+}
+decode_lock = threading.Lock()
+
+
+def store_wp_queue(wp_queue, expiry):
+    '''Stores the sorted WP queue horde-wide
+    When the queue has not changed since the last snapshot, we only extend its expiry
+    '''
+    if horde_r_binary is None:
+        return
+    records = pack_wp_queue(wp_queue)
+    try:
+        pipe = horde_r_binary.pipeline()
+        if records == last_stored["records"]:
+            pipe.expire(WP_CACHE_KEY, timedelta(seconds=expiry))
+            pipe.expire(WP_CACHE_VERSION_KEY, timedelta(seconds=expiry))
+            # If the snapshot has expired in the meantime, we store it again
+            if all(pipe.execute()):
+                return
+        version = horde_r_binary.incr(WP_CACHE_COUNTER_KEY)
+        pipe.setex(WP_CACHE_KEY, timedelta(seconds=expiry), pack_snapshot(version, len(wp_queue), records))
+        pipe.setex(WP_CACHE_VERSION_KEY, timedelta(seconds=expiry), version)
+        pipe.execute()
+    except Exception as err:
+        logger.error(f"Failed to store the WP cache: {err}")
+        return
+    last_stored["records"] = records
+
+
+def retrieve_wp_queue():
+    '''Returns the cached sorted WP queue as FakeWPRows, or None if it's not available
+    The rows are shared between all the threads of this process, so they should not be modified
+    '''
+    if horde_r is None:
+        return None
+    cached_version = horde_r.get(WP_CACHE_VERSION_KEY)
+    if cached_version is None:
+        return None
+    cached_version = int(cached_version)
+    decoded_version, decoded_rows = decoded_cache["snapshot"]
+    if decoded_version == cached_version:
+        return decoded_rows
+    with decode_lock:
+        # Another thread might have decoded this version while we were waiting
+        decoded_version, decoded_rows = decoded_cache["snapshot"]
+        if decoded_version == cached_version:
+            return decoded_rows
+        snapshot = horde_r_binary.get(WP_CACHE_KEY)
+        if snapshot is None:
+            return None
+        try:
+            version, rows = unpack_wp_queue(snapshot, FakeWPRow)
+        except (struct.error, ValueError) as err:
+            logger.error(f"Failed decoding the WP cache with error: {err}")
+            return None
+        decoded_cache["snapshot"] = (version, rows)
+    return rows
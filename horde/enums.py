@@ -8,3 +8,42 @@ class State(enum.Enum):
     FAULTED = 4
     PARTIAL = 5
 
+class Capabilities(enum.IntFlag):
+    '''The features a worker offers and a waiting prompt might require.
+    A worker can only pick up a waiting prompt when it offers all the capabilities it requires.
+    '''
+    NSFW = 1
+    TRUSTED = 2
+    UNSAFE_IP = 4
+    IMG2IMG = 8
+    PAINTING = 16
+    INPAINTING_MODEL = 32
+    # A model which is not the inpainting one
+    GENERATION_MODEL = 64
+    POST_PROCESSING = 128
+
+# The skipped reason we report for each capability a worker is missing, in order of importance
+CAPABILITY_SKIP_REASONS = [
+    (Capabilities.NSFW, 'nsfw'),
+    (Capabilities.TRUSTED, 'untrusted'),
+    (Capabilities.IMG2IMG, 'img2img'),
+    (Capabilities.PAINTING, 'painting'),
+    (Capabilities.INPAINTING_MODEL, 'models'),
+    (Capabilities.GENERATION_MODEL, 'models'),
+    (Capabilities.UNSAFE_IP, 'unsafe_ip'),
+    (Capabilities.POST_PROCESSING, 'post-processing'),
+]
+
+def get_missing_capabilities(requirements, capabilities):
+    '''Returns the Capabilities a waiting prompt requires, which a worker does not offer'''
+    return Capabilities(requirements & ~capabilities)
+
+def get_capability_skip_reason(requirements, capabilities):
+    '''Returns the skipped reason of the most important capability the worker is missing
+    Returns None when the worker offers every capability the waiting prompt requires
+    '''
+    missing_capabilities = get_missing_capabilities(requirements, capabilities)
+    for capability, skipped_reason in CAPABILITY_SKIP_REASONS:
+        if capability in missing_capabilities:
+            return skipped_reason
+    return None
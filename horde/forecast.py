@@ -0,0 +1,64 @@
+# This module is kept free of any horde imports, like horde/assignment.py
+
+# How much weight each new measurement has on the rolling average throughput
+FORECAST_ALPHA = 0.1
+# How far each new measurement moves the quantile estimates, as a fraction of their value
+QUANTILE_STEP = 0.05
+# Estimates built from fewer measurements than this are not used
+MIN_FORECAST_SAMPLES = 5
+# The quantiles of the throughput we track. p10 gives a pessimistic ETA
+# and a job slower than p05 is slower than 95% of the jobs of its model and size
+FORECAST_QUANTILES = {
+    "p05": 0.05,
+    "p10": 0.1,
+    "p50": 0.5,
+}
+
+
+def get_size_bucket(things):
+    '''Jobs are bucketed by the power of 2 of their size
+    So the largest job in each bucket is at most twice as large as the smallest one
+    '''
+    return max(int(things).bit_length() - 1, 0)
+
+
+def update_estimate(estimate, throughput):
+    '''Updates the rolling average and the quantile estimates with a new throughput measurement
+    Each update takes constant time and memory, no matter how much history we've seen
+    '''
+    if estimate is None:
+        estimate = {"count": 0, "ewma": throughput}
+        for name in FORECAST_QUANTILES:
+            estimate[name] = throughput
+    estimate["count"] += 1
+    estimate["ewma"] += FORECAST_ALPHA * (throughput - estimate["ewma"])
+    # Each quantile estimate settles where the measurements above it are as frequent as 1 - quantile
+    for name, quantile in FORECAST_QUANTILES.items():
+        if throughput > estimate[name]:
+            estimate[name] *= 1 + QUANTILE_STEP * quantile
+        else:
+            estimate[name] *= 1 - QUANTILE_STEP * (1 - quantile)
+    return estimate
+
+
+def update_forecast(forecasts, model, size_bucket, throughput):
+    '''Adds a throughput measurement to the estimates of its model size bucket, and of the whole model'''
+    model_forecasts = forecasts.setdefault(model, {})
+    for bucket in [str(size_bucket), "all"]:
+        model_forecasts[bucket] = update_estimate(model_forecasts.get(bucket), throughput)
+
+
+def get_forecast_throughput(forecasts, model, things, estimate = "p50"):
+    '''Returns the expected things per second for a job of this size on this model
+    When we haven't seen enough jobs of this size, we use the estimate for the whole model
+    Returns None when we do not know enough about this model
+    '''
+    model_forecasts = forecasts.get(model)
+    if not model_forecasts:
+        return None
+    for bucket in [str(get_size_bucket(things)), "all"]:
+        bucket_estimate = model_forecasts.get(bucket)
+        if bucket_estimate is not None and bucket_estimate["count"] >= MIN_FORECAST_SAMPLES:
+            # Estimates stored before a quantile was added to FORECAST_QUANTILES don't have it yet
+            return bucket_estimate.get(estimate)
+    return None
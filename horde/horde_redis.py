@@ -1,11 +1,13 @@
 
-from horde.redis_ctrl import get_horde_db, is_redis_up
+from horde.redis_ctrl import get_horde_db, get_horde_binary_db, is_redis_up
 from horde.logger import logger
 
 horde_r = None
+horde_r_binary = None
 logger.init("Horde Redis", status="Connecting")
 if is_redis_up():
     horde_r = get_horde_db()
+    horde_r_binary = get_horde_binary_db()
     logger.init_ok("Horde Redis", status="Connected")
 else:
     logger.init_err("Horde Redis", status="Failed")
@@ -0,0 +1,223 @@
+import json
+import time
+import threading
+from datetime import timedelta
+
+from horde.logger import logger
+from horde.horde_redis import horde_r
+
+# Every time a WP is added to the queue, we announce its models in this channel
+# so that workers waiting on an empty pop can retry immediately
+QUEUE_EVENTS_CHANNEL = "wp_queue_events"
+# Each waiting pop holds one of the WSGI threads, so we only allow this many to wait at the same time in each process.
+# Once they're all taken, other pops return their empty response immediately, like they do without waiting.
+# The WSGI server gets this many extra threads, so that waiting pops never starve the rest of the API.
+MAX_QUEUE_WAITERS = 15
+# Workers with identical capabilities share the result of the candidate query for a short while
+# New WPs reach the profiles which found candidates once their entries expire. WPs claimed in the meantime
+# are filtered out when the cached ids are loaded.
+PROFILE_CANDIDATES_KEY = "wp_profile_candidates"
+PROFILE_CANDIDATES_TTL = 1
+# The profiles for which nothing was eligible, per model they serve.
+# A new WP drops these entries for its models straight away, instead of waiting for them to expire.
+EMPTY_PROFILES_KEY = "wp_empty_profiles:{model}"
+# WPs without models can be generated by any worker, so they drop all of them
+ALL_EMPTY_PROFILES_KEY = "wp_empty_profiles"
+# The workers which a queued WP specifically allows or excludes, and the users with queued WPs
+# These are rebuilt by the primary every 30 seconds, so that pops don't need to query them to know if they can use the profile cache.
+# In between, new WPs and tricked workers add their ids straight away. Ids which are no longer needed
+# only stay until the next rebuild, during which those workers just don't use the profile cache.
+# Each id is scored by when it was last seen, so that a rebuild never drops the ids added while it was querying.
+PERSONAL_WORKERS_KEY = "wp_personal_worker_times"
+QUEUED_USERS_KEY = "wp_queued_user_times"
+PERSONAL_IDS_READY_KEY = "wp_personal_ids_ready"
+PERSONAL_IDS_EXPIRY = 90
+
+
+def announce_waiting_prompt(model_names):
+    '''Wakes up the workers waiting for new jobs on these models
+    The profiles which found nothing eligible for these models query their candidates again on their next pop
+    '''
+    if horde_r is None:
+        return
+    if len(model_names) > 0:
+        empty_profiles_keys = [EMPTY_PROFILES_KEY.format(model=model_name) for model_name in model_names]
+    else:
+        empty_profiles_keys = [ALL_EMPTY_PROFILES_KEY]
+    try:
+        pipe = horde_r.pipeline()
+        for key in empty_profiles_keys:
+            pipe.smembers(key)
+        pipe.delete(*empty_profiles_keys)
+        *empty_profiles, _ = pipe.execute()
+        empty_profiles = set().union(*empty_profiles)
+        # The workers we wake up should not find the empty entries from before this WP
+        pipe = horde_r.pipeline()
+        if len(empty_profiles) > 0:
+            pipe.hdel(PROFILE_CANDIDATES_KEY, *empty_profiles)
+        pipe.publish(QUEUE_EVENTS_CHANNEL, json.dumps(model_names))
+        pipe.execute()
+    except Exception as err:
+        logger.error(f"Failed to announce the queued models: {err}")
+
+
+def store_personal_ids(worker_ids, user_ids, queried_at):
+    '''Stores which workers and users need their own candidates instead of the shared profile cache
+    queried_at is the time from before we queried these ids. Only the ids added since then are kept along with them
+    '''
+    if horde_r is None:
+        return
+    try:
+        pipe = horde_r.pipeline()
+        for key, ids in [(PERSONAL_WORKERS_KEY, worker_ids), (QUEUED_USERS_KEY, user_ids)]:
+            if len(ids) > 0:
+                pipe.zadd(key, {str(personal_id): queried_at for personal_id in ids})
+            pipe.zremrangebyscore(key, "-inf", f"({queried_at}")
+            pipe.expire(key, timedelta(seconds=PERSONAL_IDS_EXPIRY))
+        pipe.setex(PERSONAL_IDS_READY_KEY, timedelta(seconds=PERSONAL_IDS_EXPIRY), 1)
+        pipe.execute()
+    except Exception as err:
+        logger.error(f"Failed to store the personal ids: {err}")
+
+
+def add_personal_ids(worker_ids, user_ids):
+    '''Adds the workers and users which need their own candidates from now on, until the next rebuild'''
+    if horde_r is None:
+        return
+    now = time.time()
+    try:
+        pipe = horde_r.pipeline()
+        for key, ids in [(PERSONAL_WORKERS_KEY, worker_ids), (QUEUED_USERS_KEY, user_ids)]:
+            if len(ids) > 0:
+                pipe.zadd(key, {str(personal_id): now for personal_id in ids})
+                pipe.expire(key, timedelta(seconds=PERSONAL_IDS_EXPIRY))
+        pipe.execute()
+    except Exception as err:
+        logger.error(f"Failed to add the personal ids: {err}")
+
+
+def can_share_profile_candidates(worker_id, priority_user_ids):
+    '''Returns True if this worker can use the candidates cached for its profile
+    Workers which a queued WP specifically allows or excludes cannot,
+    and neither can workers prioritizing users who have queued WPs, as their ordering is personal.
+    Returns False when we cannot tell
+    '''
+    if horde_r is None:
+        return False
+    try:
+        pipe = horde_r.pipeline()
+        pipe.exists(PERSONAL_IDS_READY_KEY)
+        pipe.zscore(PERSONAL_WORKERS_KEY, str(worker_id))
+        for user_id in priority_user_ids:
+            pipe.zscore(QUEUED_USERS_KEY, str(user_id))
+        ready, *personal = pipe.execute()
+    except Exception as err:
+        logger.error(f"Failed to read the personal ids: {err}")
+        return False
+    return bool(ready) and all(score is None for score in personal)
+
+
+def get_cached_profile_candidates(profile_key):
+    '''Returns the sorted WP ids cached for this worker profile
+    An empty list means that nothing was eligible for this profile.
+    Returns None when there's no fresh entry, in which case the caller should run the candidate query
+    '''
+    if horde_r is None:
+        return None
+    try:
+        cached = horde_r.hget(PROFILE_CANDIDATES_KEY, profile_key)
+    except Exception as err:
+        logger.error(f"Failed to read the profile candidates cache: {err}")
+        return None
+    if cached is None:
+        return None
+    cached = json.loads(cached)
+    if time.time() - cached["time"] > PROFILE_CANDIDATES_TTL:
+        return None
+    return cached["ids"]
+
+
+def cache_profile_candidates(profile_key, wp_ids, models_list):
+    '''Stores the sorted WP ids the candidate query returned for this worker profile
+    models_list are the models this profile serves
+    '''
+    if horde_r is None:
+        return
+    try:
+        pipe = horde_r.pipeline()
+        pipe.hset(PROFILE_CANDIDATES_KEY, profile_key, json.dumps({"time": time.time(), "ids": [str(wp_id) for wp_id in wp_ids]}))
+        # Profiles which stop popping would otherwise stay in the hash until the next invalidation
+        pipe.expire(PROFILE_CANDIDATES_KEY, PROFILE_CANDIDATES_TTL * 10)
+        if len(wp_ids) == 0:
+            for key in [EMPTY_PROFILES_KEY.format(model=model_name) for model_name in models_list] + [ALL_EMPTY_PROFILES_KEY]:
+                pipe.sadd(key, profile_key)
+                pipe.expire(key, PROFILE_CANDIDATES_TTL * 10)
+        pipe.execute()
+    except Exception as err:
+        logger.error(f"Failed to store the profile candidates cache: {err}")
+
+
+class QueueEventListener:
+    '''Listens to the queue events for this process and wakes up the workers waiting for them'''
+    def __init__(self):
+        self.waiters = []
+        self.lock = threading.Lock()
+        self.waiter_slots = threading.BoundedSemaphore(MAX_QUEUE_WAITERS)
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, args=())
+            self.thread.daemon = True
+            self.thread.start()
+        logger.init_ok("Queue Event Listener", status="Started")
+
+    def run(self):
+        while True:
+            try:
+                pubsub = horde_r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(QUEUE_EVENTS_CHANNEL)
+                for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    self.notify(set(json.loads(message["data"])))
+            except Exception as e:
+                logger.error(f"Exception caught in the queue event listener. Reconnecting! {e}")
+                time.sleep(1)
+
+    def notify(self, model_names):
+        with self.lock:
+            for waiter_models, event in self.waiters:
+                # WPs without models can be picked up by any worker
+                if len(model_names) == 0 or len(waiter_models & model_names) > 0:
+                    event.set()
+
+    def wait(self, models_list, timeout):
+        '''Blocks until a WP for one of these models is queued, or the timeout passes
+        Returns True if a matching WP was queued
+        Returns False immediately when too many requests are already waiting
+        '''
+        if horde_r is None:
+            return False
+        if not self.waiter_slots.acquire(blocking=False):
+            return False
+        try:
+            self.start()
+            waiter = (set(models_list), threading.Event())
+            with self.lock:
+                self.waiters.append(waiter)
+            try:
+                return waiter[1].wait(timeout)
+            finally:
+                with self.lock:
+                    self.waiters.remove(waiter)
+        finally:
+            self.waiter_slots.release()
+
+queue_event_listener = QueueEventListener()
+
+
+def wait_for_queued_models(models_list, timeout):
+    return queue_event_listener.wait(models_list, timeout)
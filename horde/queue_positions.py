@@ -0,0 +1,64 @@
+import json
+from datetime import timedelta
+
+from horde.logger import logger
+from horde.horde_redis import horde_r
+from horde.vars import thing_divisor
+
+# The position service keeps the queue position of each waiting prompt in redis,
+# along with the running totals of the work queued up to and including it.
+# The primary recalculates it along with the WP queue cache, so that each status check
+# only needs a single lookup, no matter how long the queue is.
+QUEUE_POSITIONS_KEY = "wp_queue_positions"
+# This field is always stored along with the positions, so that we can tell an empty queue from missing positions
+QUEUE_LENGTH_FIELD = "queue_length"
+
+
+def get_queue_positions(wp_queue):
+    '''Returns the position, the things ahead and the jobs ahead of each WP in the sorted queue
+    The things and jobs ahead also include the ones of the WP itself
+    '''
+    positions = {}
+    things_ahead_in_queue = 0
+    n_ahead_in_queue = 0
+    for position, wp in enumerate(wp_queue):
+        things_ahead_in_queue += round(wp.things * wp.n / thing_divisor, 2)
+        n_ahead_in_queue += wp.n
+        positions[str(wp.id)] = (position, round(things_ahead_in_queue, 2), n_ahead_in_queue)
+    return positions
+
+
+def store_queue_positions(wp_queue, expiry):
+    '''Replaces the stored queue positions with the ones of this sorted queue'''
+    if horde_r is None:
+        return
+    positions = {wp_id: json.dumps(position) for wp_id, position in get_queue_positions(wp_queue).items()}
+    positions[QUEUE_LENGTH_FIELD] = len(wp_queue)
+    try:
+        # The pipeline runs as a transaction, so nobody can read the positions half-replaced
+        pipe = horde_r.pipeline()
+        pipe.delete(QUEUE_POSITIONS_KEY)
+        pipe.hset(QUEUE_POSITIONS_KEY, mapping=positions)
+        pipe.expire(QUEUE_POSITIONS_KEY, timedelta(seconds=expiry))
+        pipe.execute()
+    except Exception as err:
+        logger.error(f"Failed to store the WP queue positions: {err}")
+
+
+def retrieve_queue_position(wp_id):
+    '''Returns the position, the things ahead and the jobs ahead of this WP
+    Returns (-1,0,0) when the WP is not in the queue
+    Returns None when the positions are not available, in which case the caller should calculate them itself
+    '''
+    if horde_r is None:
+        return None
+    try:
+        queue_length, position = horde_r.hmget(QUEUE_POSITIONS_KEY, [QUEUE_LENGTH_FIELD, str(wp_id)])
+    except Exception as err:
+        logger.error(f"Failed to read the WP queue positions: {err}")
+        return None
+    if queue_length is None:
+        return None
+    if position is None:
+        return (-1,0,0)
+    return tuple(json.loads(position))
@@ -32,6 +32,14 @@ def get_horde_db():
         decode_responses=True)
     return(rdb)
 
+def get_horde_binary_db():
+    '''The same DB as get_horde_db(), for the keys which store binary values'''
+    rdb = redis.Redis(
+        host=redis_hostname,
+        port=redis_port,
+        db = horde_db)
+    return(rdb)
+
 def get_ipaddr_db():
     rdb = redis.Redis(
         host=redis_hostname,
@@ -0,0 +1,150 @@
+import json
+import time
+from datetime import datetime
+
+from horde.logger import logger
+from horde.horde_redis import horde_r
+
+# The worker capability index keeps what each active worker can serve in redis,
+# so that we can quickly tell if a WP can be generated by anyone, without loading all the workers from the DB.
+# Each node keeps its own copy in memory, which it refreshes from redis every few seconds
+# and updates directly from the check-ins it receives.
+WORKER_INDEX_KEY = "worker_capabilities"
+WORKER_INDEX_READY_KEY = "worker_capabilities_ready"
+# Same as get_active_workers()
+ACTIVE_WORKER_SECONDS = 300
+# How often each node reloads its local copy from redis
+LOCAL_REFRESH_SECONDS = 5
+# How often a worker with unchanged capabilities refreshes its entry in redis
+ENTRY_REFRESH_SECONDS = 30
+
+local_index = {
+    "time": 0,
+    # worker_id: capabilities
+    "workers": {},
+    # serialized capabilities without the worker specifics: capabilities
+    "profiles": {},
+}
+
+
+def is_worker_index_ready():
+    '''The index is only used once the primary has rebuilt it from the DB at least once'''
+    if horde_r is None:
+        return False
+    return horde_r.get(WORKER_INDEX_READY_KEY) is not None
+
+
+def get_profile_key(capabilities):
+    return json.dumps({k: v for k, v in capabilities.items() if k != "seen"}, sort_keys=True)
+
+
+def rebuild_local_profiles():
+    '''Many workers share the same capabilities, so we only need to check each unique profile'''
+    oldest_seen = time.time() - ACTIVE_WORKER_SECONDS
+    profiles = {}
+    for capabilities in local_index["workers"].values():
+        if capabilities["seen"] < oldest_seen:
+            continue
+        profiles[get_profile_key(capabilities)] = capabilities
+    local_index["profiles"] = profiles
+
+
+def refresh_local_index():
+    if time.time() - local_index["time"] < LOCAL_REFRESH_SECONDS:
+        return
+    try:
+        all_capabilities = horde_r.hgetall(WORKER_INDEX_KEY)
+    except Exception as err:
+        logger.error(f"Failed to read the worker capability index: {err}")
+        return
+    local_index["workers"] = {worker_id: json.loads(capabilities) for worker_id, capabilities in all_capabilities.items()}
+    rebuild_local_profiles()
+    local_index["time"] = time.time()
+
+
+def update_worker_capabilities(worker):
+    '''Stores the capabilities this worker has after its latest check-in'''
+    if horde_r is None:
+        return
+    capabilities = worker.get_capabilities()
+    capabilities["seen"] = time.time()
+    worker_id = str(worker.id)
+    known_capabilities = local_index["workers"].get(worker_id)
+    if (
+        known_capabilities is not None
+        and get_profile_key(known_capabilities) == get_profile_key(capabilities)
+        and time.time() - known_capabilities["seen"] < ENTRY_REFRESH_SECONDS
+    ):
+        return
+    try:
+        horde_r.hset(WORKER_INDEX_KEY, worker_id, json.dumps(capabilities))
+    except Exception as err:
+        logger.error(f"Failed to update the worker capability index for worker {worker_id}: {err}")
+        return
+    local_index["workers"][worker_id] = capabilities
+    local_index["profiles"][get_profile_key(capabilities)] = capabilities
+
+
+def worker_matches_tags(capabilities, tags):
+    '''Cheap version of the candidate query filters, using the WP matchmaking tags
+    capabilities is the dict returned by Worker.get_capabilities()
+    '''
+    if tags.get("pixels", 0) > capabilities.get("max_pixels", 0):
+        return False
+    if tags["requirements"] & ~capabilities["capability_mask"]:
+        return False
+    if tags["min_bridge_version"] > capabilities["bridge_version"]:
+        return False
+    if tags.get("r2") and capabilities["bridge_version"] < 8:
+        return False
+    if capabilities["maintenance"] and tags["user_id"] != capabilities["user_id"]:
+        return False
+    return True
+
+
+def has_capable_worker(tags, limited_worker_ids = None):
+    '''Returns True if any active worker can serve a WP with these matchmaking tags
+    If limited_worker_ids is provided, only those workers are considered.
+    When the index is not available, we cannot know, so we assume there is one.
+    '''
+    if not is_worker_index_ready():
+        return True
+    refresh_local_index()
+    if limited_worker_ids:
+        oldest_seen = time.time() - ACTIVE_WORKER_SECONDS
+        candidates = []
+        for worker_id in limited_worker_ids:
+            capabilities = local_index["workers"].get(str(worker_id))
+            if capabilities is not None and capabilities["seen"] >= oldest_seen:
+                candidates.append(capabilities)
+    else:
+        candidates = local_index["profiles"].values()
+    wp_models = set(tags.get("models", []))
+    for capabilities in candidates:
+        if len(wp_models) > 0 and wp_models.isdisjoint(capabilities["models"]):
+            continue
+        if worker_matches_tags(capabilities, tags):
+            return True
+    return False
+
+
+def rebuild_worker_index(active_workers, interval):
+    '''Replaces the redis index with the capabilities of the currently active workers'''
+    if horde_r is None:
+        return
+    all_capabilities = {}
+    for worker in active_workers:
+        capabilities = worker.get_capabilities()
+        capabilities["seen"] = time.time() - (datetime.utcnow() - worker.last_check_in).total_seconds()
+        all_capabilities[str(worker.id)] = json.dumps(capabilities)
+    try:
+        pipe = horde_r.pipeline()
+        pipe.delete(WORKER_INDEX_KEY)
+        if len(all_capabilities) > 0:
+            pipe.hset(WORKER_INDEX_KEY, mapping=all_capabilities)
+        pipe.setex(WORKER_INDEX_READY_KEY, interval * 3, 1)
+        pipe.execute()
+    except Exception as err:
+        logger.error(f"Failed to rebuild the worker capability index: {err}")
+        return
+    logger.debug(f"Worker capability index rebuilt with {len(all_capabilities)} workers.")
@@ -0,0 +1,41 @@
+import struct
+import uuid
+from calendar import timegm
+from datetime import datetime
+
+# This module is kept free of any horde imports, like horde/assignment.py
+# The WP queue cache is stored as a packed array of fixed-width records, behind a small header.
+WP_CACHE_FORMAT = 1
+# format, snapshot version, amount of records
+HEADER = struct.Struct("<BQI")
+# id, things, n, queue_priority, created
+RECORD = struct.Struct("<16sqiqI")
+
+
+def pack_wp_queue(wp_queue):
+    '''Returns the records of the WP queue, without the header'''
+    return b"".join([
+        RECORD.pack(
+            uuid.UUID(str(wp.id)).bytes,
+            wp.things,
+            wp.n,
+            wp.queue_priority,
+            timegm(wp.created.utctimetuple()),
+        )
+        for wp in wp_queue
+    ])
+
+
+def pack_snapshot(version, count, records):
+    return HEADER.pack(WP_CACHE_FORMAT, version, count) + records
+
+
+def unpack_wp_queue(snapshot, row_class):
+    '''Returns the version of the snapshot and its rows, built with row_class'''
+    wp_format, version, count = HEADER.unpack_from(snapshot)
+    if wp_format != WP_CACHE_FORMAT:
+        raise ValueError(f"Unknown WP cache format {wp_format}")
+    rows = []
+    for wp_id, things, n, queue_priority, created in RECORD.iter_unpack(snapshot[HEADER.size:HEADER.size + count * RECORD.size]):
+        rows.append(row_class(uuid.UUID(bytes=wp_id), things, n, queue_priority, datetime.utcfromtimestamp(created)))
+    return version, rows
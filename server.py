@@ -6,6 +6,7 @@ load_dotenv()
 
 from horde.argparser import args
 from horde.flask import HORDE
+from horde.matchmaking import MAX_QUEUE_WAITERS
 from horde.logger import logger
 
 if __name__ == "__main__":
@@ -22,6 +23,6 @@ if __name__ == "__main__":
     if args.insecure:
         allowed_host = "0.0.0.0"
         logger.init_warn("WSGI Mode", status="Insecure")
-    serve(HORDE, port=args.port, url_scheme=url_scheme, threads=45, connection_limit=1024, asyncore_use_poll=True)
+    serve(HORDE, port=args.port, url_scheme=url_scheme, threads=45 + MAX_QUEUE_WAITERS, connection_limit=1024, asyncore_use_poll=True)
     # HORDE.run(debug=True,host="0.0.0.0",port="5001")
     logger.init("WSGI Server", status="Stopped")
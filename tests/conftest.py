@@ -0,0 +1,22 @@
+import importlib.util
+import os
+import sys
+import types
+from unittest import mock
+
+HORDE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "horde")
+
+
+def load_horde_module(name, stubs = None):
+    '''Loads a single module of the horde package from its file
+    Importing it through the package would run horde/__init__.py, which needs the whole server environment,
+    so the horde modules it imports have to be provided in stubs, as a dict of module name to module
+    '''
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HORDE_DIR, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    stubs = dict(stubs or {})
+    if len(stubs) > 0:
+        stubs.setdefault("horde", types.ModuleType("horde"))
+    with mock.patch.dict(sys.modules, stubs):
+        spec.loader.exec_module(module)
+    return module
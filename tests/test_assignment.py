@@ -0,0 +1,121 @@
+import pytest
+
+from conftest import load_horde_module
+
+assignment = load_horde_module("assignment")
+
+
+def test_capacity_share():
+    capacities = [512 * 512, 768 * 768, 1024 * 1024, 1024 * 1024]
+    assert assignment.get_capacity_share(capacities, 512 * 512) == 1
+    assert assignment.get_capacity_share(capacities, 1024 * 1024) == 0.5
+    assert assignment.get_capacity_share(capacities, 2048 * 2048) == 0
+    assert assignment.get_capacity_share([], 1024 * 1024) == 1
+
+
+def get_shift(**kwargs):
+    shift_kwargs = {
+        "job_pixels": 1024 * 1024,
+        "job_things": 50,
+        "job_ttl": 150,
+        "worker_max_pixels": 1024 * 1024,
+        "worker_speed": None,
+        "capacity_share": 0.5,
+        "average_speed": 1,
+    }
+    shift_kwargs.update(kwargs)
+    return assignment.get_assignment_shift(**shift_kwargs)
+
+
+def test_assignment_shift_prefers_jobs_only_few_workers_can_take():
+    assert get_shift() == 5
+    assert get_shift(capacity_share=1) == 0
+    assert get_shift(job_pixels=512 * 512, worker_max_pixels=1024 * 1024) == 1.25
+
+
+def test_assignment_shift_sends_large_jobs_to_fast_workers():
+    assert get_shift(worker_speed=1) == 5
+    assert get_shift(worker_speed=1.5) == 10
+    assert get_shift(worker_speed=2) == assignment.MAX_POSITION_SHIFT
+    # Slower than average workers are not pushed away from large jobs, unless they would time out
+    assert get_shift(worker_speed=0.5, job_things=30, capacity_share=1) == 0
+
+
+def test_assignment_shift_pushes_back_jobs_likely_to_time_out():
+    assert get_shift(worker_speed=0.5, job_things=100) == -assignment.MAX_POSITION_SHIFT
+    assert get_shift(worker_speed=1, job_things=75) == 5
+
+
+def test_order_by_shift_keeps_the_queue_order_without_shifts():
+    assert assignment.order_by_shift(list(range(20)), [0] * 20) == list(range(20))
+    assert assignment.order_by_shift([], []) == []
+
+
+def test_order_by_shift_moves_candidates():
+    shifts = [0] * 20
+    shifts[5] = 3
+    shifts[6] = -2
+    order = assignment.order_by_shift(list(range(20)), shifts)
+    assert order[:10] == [0, 1, 2, 5, 3, 4, 7, 6, 8, 9]
+
+
+def test_order_by_shift_clamps_the_shifts():
+    shifts = [0] * 40
+    shifts[25] = 100
+    shifts[0] = -100
+    order = assignment.order_by_shift(list(range(40)), shifts)
+    # Ties keep the queue order, so a candidate moved forwards goes behind the one it lands on
+    # and a candidate moved backwards goes ahead of it
+    assert order.index(25) == 16
+    assert order.index(0) == 9
+    assert sorted(order) == list(range(40))
+
+
+def test_priority_band_truncates_like_the_db():
+    assert assignment.get_priority_band(0) == 0
+    assert assignment.get_priority_band(499) == 0
+    assert assignment.get_priority_band(500) == 1
+    assert assignment.get_priority_band(-499) == 0
+    assert assignment.get_priority_band(-500) == -1
+
+
+def test_queue_order_key():
+    # queue_priority, things, n, created
+    wps = {
+        "old_large": (600, 1000, 1, 1),
+        "new_small": (700, 10, 1, 2),
+        "new_large": (800, 1000, 1, 3),
+        "low_small": (100, 10, 1, 4),
+    }
+    def ordered(queue_order):
+        return sorted(wps, key=lambda name: assignment.get_queue_order_key(queue_order, *wps[name]))
+    assert ordered("priority") == ["new_large", "new_small", "old_large", "low_small"]
+    assert ordered("sjf") == ["new_small", "old_large", "new_large", "low_small"]
+
+
+def test_ewma_converges():
+    value = 1
+    for _ in range(100):
+        value = assignment.update_ewma(value, 0)
+    assert value == pytest.approx(0, abs=1e-4)
+    assert assignment.update_ewma(1, 0) == pytest.approx(1 - assignment.RELIABILITY_ALPHA)
+    assert assignment.update_ewma(0.5, 1, alpha=0.5) == 0.75
+
+
+@pytest.mark.parametrize("completion_rate, ttl_usage, score", [
+    (1, 0.2, 1),
+    (0.9, 0.5, 0.9),
+    (1, 0.75, 0.5),
+    (0.5, 0.75, 0.25),
+    (1, 1.5, 0),
+])
+def test_reliability_score(completion_rate, ttl_usage, score):
+    assert assignment.get_reliability_score(completion_rate, ttl_usage) == pytest.approx(score)
+
+
+def test_reliability_shift():
+    threshold = assignment.RELIABILITY_THRESHOLD
+    assert assignment.get_reliability_shift(threshold, True) == 0
+    assert assignment.get_reliability_shift(0, False) == 0
+    assert assignment.get_reliability_shift(0, True) == -assignment.MAX_POSITION_SHIFT
+    assert assignment.get_reliability_shift(threshold / 2, True) == pytest.approx(-assignment.MAX_POSITION_SHIFT / 2)
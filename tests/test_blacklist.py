@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+from conftest import load_horde_module
+
+blacklist = load_horde_module("blacklist")
+
+
+def old_search(words, prompt):
+    '''How Worker.can_generate() matched the blacklist before the compiled matcher'''
+    return any(word.lower() in prompt.lower() for word in words)
+
+
+@pytest.mark.parametrize("words, prompt", [
+    ([], "a red fox"),
+    (["fox"], "a red fox"),
+    (["Fox"], "A RED FOX"),
+    (["dog"], "a red fox"),
+    (["he", "she", "his", "hers"], "ushers"),
+    (["abcd", "bc"], "xabcx"),
+    (["abcd", "cde"], "abcde"),
+    (["aab"], "aaab"),
+    (["red fox"], "a red  fox"),
+    (["ünï"], "Ünïcode"),
+])
+def test_matches_old_substring_semantics(words, prompt):
+    matcher = blacklist.BlacklistMatcher(words)
+    assert matcher.search(prompt.lower()) == old_search(words, prompt)
+
+
+def test_matches_old_substring_semantics_on_random_input():
+    rand = random.Random(1)
+    for _ in range(2000):
+        words = ["".join(rand.choice("abc") for _ in range(rand.randint(1, 4))) for _ in range(rand.randint(0, 5))]
+        prompt = "".join(rand.choice("abcABC ") for _ in range(rand.randint(0, 20)))
+        matcher = blacklist.BlacklistMatcher(words)
+        assert matcher.search(prompt.lower()) == old_search(words, prompt), (words, prompt)
+
+
+def test_empty_words_are_ignored():
+    # The substring check blocked every prompt when an empty word was blacklisted
+    assert not blacklist.BlacklistMatcher([""]).search("a red fox")
+    assert blacklist.BlacklistMatcher(["", "fox"]).search("a red fox")
+
+
+def test_worker_matcher_is_only_recompiled_when_the_words_change():
+    blacklist.worker_matchers.clear()
+    matcher = blacklist.get_worker_matcher("worker", ["fox"])
+    assert blacklist.get_worker_matcher("worker", ["fox"]) is matcher
+    new_matcher = blacklist.get_worker_matcher("worker", ["dog"])
+    assert new_matcher is not matcher
+    assert new_matcher.search("a dog")
+    assert not new_matcher.search("a fox")
+
+
+def test_digest_matcher():
+    blacklist.worker_matchers.clear()
+    assert blacklist.get_digest_matcher("worker", "digest") is None
+    matcher = blacklist.get_worker_matcher("worker", ["fox"], "digest")
+    assert blacklist.get_digest_matcher("worker", "digest") is matcher
+    assert blacklist.get_digest_matcher("worker", "other") is None
+    assert blacklist.get_digest_matcher("worker", None) is None
+    # The same words under a new configuration keep the compiled matcher
+    assert blacklist.get_worker_matcher("worker", ["fox"], "other") is matcher
+    assert blacklist.get_digest_matcher("worker", "other") is matcher
@@ -0,0 +1,56 @@
+import pytest
+
+from conftest import load_horde_module
+
+enums = load_horde_module("enums")
+Capabilities = enums.Capabilities
+
+# A trusted worker with a generation model, which accepts everything
+ALL_CAPABILITIES = Capabilities(sum(Capabilities))
+# What a txt2img WP from a safe IP requires
+TXT2IMG = Capabilities.GENERATION_MODEL
+INPAINTING = Capabilities.PAINTING | Capabilities.INPAINTING_MODEL
+
+
+# The skipped reason the sequential checks of can_generate() reported before the capability masks
+@pytest.mark.parametrize("requirements, capabilities, old_reason", [
+    (TXT2IMG | Capabilities.NSFW, ALL_CAPABILITIES & ~Capabilities.NSFW, 'nsfw'),
+    # trusted_workers, or an anon/VPN request on an untrusted worker
+    (TXT2IMG | Capabilities.TRUSTED, ALL_CAPABILITIES & ~Capabilities.TRUSTED, 'untrusted'),
+    # allow_img2img is off, or the bridge is too old for it
+    (TXT2IMG | Capabilities.IMG2IMG, ALL_CAPABILITIES & ~Capabilities.IMG2IMG, 'img2img'),
+    (INPAINTING | Capabilities.IMG2IMG, ALL_CAPABILITIES & ~Capabilities.PAINTING, 'painting'),
+    (INPAINTING | Capabilities.IMG2IMG, ALL_CAPABILITIES & ~Capabilities.INPAINTING_MODEL, 'models'),
+    # A worker which only has the inpainting model loaded
+    (TXT2IMG, ALL_CAPABILITIES & ~Capabilities.GENERATION_MODEL, 'models'),
+    (TXT2IMG | Capabilities.UNSAFE_IP, ALL_CAPABILITIES & ~Capabilities.UNSAFE_IP, 'unsafe_ip'),
+    (TXT2IMG | Capabilities.POST_PROCESSING, ALL_CAPABILITIES & ~Capabilities.POST_PROCESSING, 'post-processing'),
+    # When several capabilities are missing, the one checked first is reported
+    (TXT2IMG | Capabilities.NSFW | Capabilities.IMG2IMG, Capabilities.GENERATION_MODEL, 'nsfw'),
+    (INPAINTING | Capabilities.TRUSTED, Capabilities.GENERATION_MODEL, 'untrusted'),
+    (TXT2IMG | Capabilities.IMG2IMG | Capabilities.POST_PROCESSING, Capabilities.GENERATION_MODEL, 'img2img'),
+    (INPAINTING | Capabilities.UNSAFE_IP, Capabilities.INPAINTING_MODEL, 'painting'),
+    (TXT2IMG | Capabilities.UNSAFE_IP | Capabilities.POST_PROCESSING, Capabilities.GENERATION_MODEL, 'unsafe_ip'),
+    # Nothing missing
+    (TXT2IMG | Capabilities.NSFW | Capabilities.POST_PROCESSING, ALL_CAPABILITIES, None),
+    (Capabilities(0), Capabilities(0), None),
+])
+def test_skip_reason_matches_old_checks(requirements, capabilities, old_reason):
+    assert enums.get_capability_skip_reason(int(requirements), int(capabilities)) == old_reason
+
+
+def test_every_capability_has_a_skip_reason():
+    assert set(Capabilities) == set(capability for capability, _ in enums.CAPABILITY_SKIP_REASONS)
+
+
+def test_missing_capabilities():
+    missing = enums.get_missing_capabilities(int(Capabilities.NSFW | Capabilities.IMG2IMG), int(Capabilities.NSFW | Capabilities.TRUSTED))
+    assert missing == Capabilities.IMG2IMG
+
+
+def test_sql_filter_agrees_with_skip_reason():
+    '''The candidate query keeps the WPs for which requirement_mask & capability_mask == requirement_mask'''
+    for requirements in range(int(ALL_CAPABILITIES) + 1):
+        for capabilities in range(int(ALL_CAPABILITIES) + 1):
+            compatible = requirements & capabilities == requirements
+            assert compatible == (enums.get_capability_skip_reason(requirements, capabilities) is None)
@@ -0,0 +1,78 @@
+import random
+
+import pytest
+
+from conftest import load_horde_module
+
+forecast = load_horde_module("forecast")
+
+
+@pytest.mark.parametrize("things, bucket", [
+    (0, 0),
+    (1, 0),
+    (2, 1),
+    (3, 1),
+    (4, 2),
+    (1024 * 1024, 20),
+    (1024 * 1024 * 2 - 1, 20),
+    (1024.5, 10),
+])
+def test_size_bucket(things, bucket):
+    assert forecast.get_size_bucket(things) == bucket
+
+
+def test_ewma_converges():
+    estimate = None
+    for _ in range(200):
+        estimate = forecast.update_estimate(estimate, 10)
+    assert estimate["count"] == 200
+    for _ in range(200):
+        estimate = forecast.update_estimate(estimate, 20)
+    assert estimate["ewma"] == pytest.approx(20, rel=1e-3)
+
+
+def test_quantiles_track_the_distribution():
+    rand = random.Random(1)
+    estimate = None
+    for _ in range(2000):
+        estimate = forecast.update_estimate(estimate, rand.uniform(10, 20))
+    assert estimate["p05"] < estimate["p10"] < estimate["p50"]
+    # Each estimate keeps moving around its quantile, so we check where they settle on average
+    totals = {name: 0 for name in forecast.FORECAST_QUANTILES}
+    for _ in range(20000):
+        estimate = forecast.update_estimate(estimate, rand.uniform(10, 20))
+        for name in totals:
+            totals[name] += estimate[name] / 20000
+    assert totals["p05"] == pytest.approx(10.5, rel=0.03)
+    assert totals["p10"] == pytest.approx(11, rel=0.03)
+    assert totals["p50"] == pytest.approx(15, rel=0.03)
+
+
+def test_forecast_falls_back_to_the_whole_model():
+    forecasts = {}
+    for _ in range(forecast.MIN_FORECAST_SAMPLES):
+        forecast.update_forecast(forecasts, "model", forecast.get_size_bucket(100), 10)
+    forecast.update_forecast(forecasts, "model", forecast.get_size_bucket(1000), 20)
+    assert forecasts["model"]["all"]["count"] == forecast.MIN_FORECAST_SAMPLES + 1
+    assert forecast.get_forecast_throughput(forecasts, "model", 100) == forecasts["model"]["6"]["p50"]
+    # Not enough jobs of this size yet
+    assert forecast.get_forecast_throughput(forecasts, "model", 1000) == forecasts["model"]["all"]["p50"]
+    assert forecast.get_forecast_throughput(forecasts, "model", 1000, "ewma") == forecasts["model"]["all"]["ewma"]
+
+
+def test_forecast_needs_enough_samples():
+    forecasts = {}
+    for _ in range(forecast.MIN_FORECAST_SAMPLES - 1):
+        forecast.update_forecast(forecasts, "model", 0, 10)
+    assert forecast.get_forecast_throughput(forecasts, "model", 1) is None
+    assert forecast.get_forecast_throughput(forecasts, "unknown", 1) is None
+
+
+def test_forecast_missing_estimate():
+    forecasts = {}
+    for _ in range(forecast.MIN_FORECAST_SAMPLES):
+        forecast.update_forecast(forecasts, "model", 0, 10)
+    # As for the forecasts stored before p05 was tracked
+    del forecasts["model"]["0"]["p05"]
+    assert forecast.get_forecast_throughput(forecasts, "model", 1, "p05") is None
+    assert forecast.get_forecast_throughput(forecasts, "model", 1, "p10") == forecasts["model"]["0"]["p10"]
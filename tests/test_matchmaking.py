@@ -0,0 +1,172 @@
+import json
+import threading
+import types
+from unittest import mock
+
+import pytest
+
+from conftest import load_horde_module
+
+matchmaking = load_horde_module("matchmaking", {
+    "horde.logger": types.SimpleNamespace(logger=mock.Mock()),
+    "horde.horde_redis": types.SimpleNamespace(horde_r=None),
+})
+
+
+class FakeRedis:
+    '''Keeps the hashes, sets, sorted sets and strings the matchmaking uses in memory
+    Published messages go straight to the subscribers, like the queue event listener
+    '''
+    def __init__(self):
+        self.data = {}
+        self.subscribers = []
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.data.get(key, {}).pop(field, None)
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(members)
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def zscore(self, key, member):
+        return self.data.get(key, {}).get(member)
+
+    def zremrangebyscore(self, key, min_score, max_score):
+        # We only support the "-inf" to exclusive maximum range the personal ids use
+        max_score = float(max_score.lstrip("("))
+        scores = self.data.get(key, {})
+        for member in [m for m, score in scores.items() if score < max_score]:
+            del scores[member]
+
+    def setex(self, key, expiry, value):
+        self.data[key] = str(value)
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def expire(self, key, expiry):
+        return key in self.data
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def publish(self, channel, message):
+        for subscriber in self.subscribers:
+            subscriber(channel, message)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args) for name, args in self.commands]
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(matchmaking, "horde_r", redis)
+    return redis
+
+
+def test_new_wp_drops_the_empty_candidates_of_its_models(redis):
+    matchmaking.cache_profile_candidates("profile_ab", [], ["model_a", "model_b"])
+    matchmaking.cache_profile_candidates("profile_c", [], ["model_c"])
+    assert matchmaking.get_cached_profile_candidates("profile_ab") == []
+    matchmaking.announce_waiting_prompt(["model_b"])
+    assert matchmaking.get_cached_profile_candidates("profile_ab") is None
+    assert matchmaking.get_cached_profile_candidates("profile_c") == []
+
+
+def test_new_wp_keeps_the_found_candidates(redis):
+    matchmaking.cache_profile_candidates("profile_a", ["wp_id"], ["model_a"])
+    matchmaking.announce_waiting_prompt(["model_a"])
+    assert matchmaking.get_cached_profile_candidates("profile_a") == ["wp_id"]
+
+
+def test_new_wp_without_models_drops_all_empty_candidates(redis):
+    matchmaking.cache_profile_candidates("profile_a", [], ["model_a"])
+    matchmaking.cache_profile_candidates("profile_b", [], ["model_b"])
+    matchmaking.announce_waiting_prompt([])
+    assert matchmaking.get_cached_profile_candidates("profile_a") is None
+    assert matchmaking.get_cached_profile_candidates("profile_b") is None
+
+
+def test_wake_then_pop(redis, monkeypatch):
+    listener = matchmaking.QueueEventListener()
+    # The fake redis delivers the queue events itself, instead of the listener thread
+    monkeypatch.setattr(listener, "start", lambda: None)
+    redis.subscribers.append(lambda channel, message: listener.notify(set(json.loads(message))))
+    # A pop from this profile found nothing just before the WP was queued
+    matchmaking.cache_profile_candidates("profile_a", [], ["model_a"])
+    woken = []
+    waiter = threading.Thread(target=lambda: woken.append(listener.wait(["model_a"], 5)))
+    waiter.start()
+    while len(listener.waiters) == 0:
+        waiter.join(0.01)
+    matchmaking.announce_waiting_prompt(["model_a"])
+    waiter.join()
+    assert woken == [True]
+    # So the pop after the wake queries the candidates again
+    assert matchmaking.get_cached_profile_candidates("profile_a") is None
+
+
+def test_waiters_only_wake_up_for_their_models(redis, monkeypatch):
+    listener = matchmaking.QueueEventListener()
+    monkeypatch.setattr(listener, "start", lambda: None)
+    redis.subscribers.append(lambda channel, message: listener.notify(set(json.loads(message))))
+    woken = []
+    waiter = threading.Thread(target=lambda: woken.append(listener.wait(["model_a"], 0.5)))
+    waiter.start()
+    while len(listener.waiters) == 0:
+        waiter.join(0.01)
+    matchmaking.announce_waiting_prompt(["model_b"])
+    waiter.join()
+    assert woken == [False]
+
+
+def test_waiters_are_capped(redis, monkeypatch):
+    listener = matchmaking.QueueEventListener()
+    monkeypatch.setattr(listener, "start", lambda: None)
+    for _ in range(matchmaking.MAX_QUEUE_WAITERS):
+        listener.waiter_slots.acquire()
+    # Once every slot is taken, pops return straight away
+    assert listener.wait(["model_a"], 5) is False
+
+
+def test_personal_ids_rebuild_keeps_the_ids_added_while_querying(redis, monkeypatch):
+    monkeypatch.setattr(matchmaking.time, "time", lambda: 100)
+    matchmaking.add_personal_ids(["stale_worker"], ["stale_user"])
+    monkeypatch.setattr(matchmaking.time, "time", lambda: 205)
+    matchmaking.add_personal_ids(["new_worker"], ["new_user"])
+    matchmaking.store_personal_ids(["queried_worker"], [], queried_at=200)
+    assert matchmaking.can_share_profile_candidates("stale_worker", ["stale_user"])
+    assert not matchmaking.can_share_profile_candidates("new_worker", [])
+    assert not matchmaking.can_share_profile_candidates("other_worker", ["new_user"])
+    assert not matchmaking.can_share_profile_candidates("queried_worker", [])
+
+
+def test_personal_ids_need_a_rebuild_before_sharing(redis):
+    matchmaking.add_personal_ids(["worker"], ["user"])
+    assert not matchmaking.can_share_profile_candidates("other_worker", ["other_user"])
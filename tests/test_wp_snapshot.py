@@ -0,0 +1,59 @@
+import struct
+import uuid
+from datetime import datetime
+
+import pytest
+
+from conftest import load_horde_module
+
+wp_snapshot = load_horde_module("wp_snapshot")
+
+
+class Row:
+    def __init__(self, id, things, n, queue_priority, created):
+        self.id = id
+        self.things = things
+        self.n = n
+        self.queue_priority = queue_priority
+        self.created = created
+
+    def as_tuple(self):
+        return (self.id, self.things, self.n, self.queue_priority, self.created)
+
+
+WP_QUEUE = [
+    Row(uuid.uuid4(), 1024 * 1024 * 50, 4, 1500, datetime(2023, 1, 1, 12, 30, 15)),
+    Row(uuid.uuid4(), 512 * 512 * 30, 1, 0, datetime(2023, 1, 1, 12, 31, 0)),
+    # Users with negative kudos get a negative priority
+    Row(uuid.uuid4(), 80, 20, -250000, datetime(2023, 6, 30, 23, 59, 59)),
+]
+
+
+def test_round_trip():
+    records = wp_snapshot.pack_wp_queue(WP_QUEUE)
+    assert len(records) == len(WP_QUEUE) * wp_snapshot.RECORD.size
+    version, rows = wp_snapshot.unpack_wp_queue(wp_snapshot.pack_snapshot(42, len(WP_QUEUE), records), Row)
+    assert version == 42
+    assert [row.as_tuple() for row in rows] == [wp.as_tuple() for wp in WP_QUEUE]
+
+
+def test_round_trip_string_ids():
+    # The DB rows might hold their ids as strings
+    wp = Row(str(WP_QUEUE[0].id), *WP_QUEUE[0].as_tuple()[1:])
+    _, rows = wp_snapshot.unpack_wp_queue(wp_snapshot.pack_snapshot(1, 1, wp_snapshot.pack_wp_queue([wp])), Row)
+    assert rows[0].as_tuple() == WP_QUEUE[0].as_tuple()
+
+
+def test_empty_queue():
+    assert wp_snapshot.unpack_wp_queue(wp_snapshot.pack_snapshot(3, 0, wp_snapshot.pack_wp_queue([])), Row) == (3, [])
+
+
+def test_unknown_format():
+    snapshot = wp_snapshot.HEADER.pack(wp_snapshot.WP_CACHE_FORMAT + 1, 1, len(WP_QUEUE)) + wp_snapshot.pack_wp_queue(WP_QUEUE)
+    with pytest.raises(ValueError):
+        wp_snapshot.unpack_wp_queue(snapshot, Row)
+
+
+def test_truncated_snapshot():
+    with pytest.raises(struct.error):
+        wp_snapshot.unpack_wp_queue(b"\x01", Row)
@@ -0,0 +1,194 @@
+'''Simulates a horde queue under each queue order and assignment policy and reports the throughput and waits each achieves
+This does not need a running horde or DB. It only loads horde/assignment.py
+
+Usage: python tools/benchmark_assignment.py [--hours 2] [--seed 1] [--load 0.9]
+'''
+import argparse
+import heapq
+import importlib.util
+import os
+import random
+import statistics
+
+spec = importlib.util.spec_from_file_location("assignment", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "horde", "assignment.py"))
+assignment = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(assignment)
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument('--hours', action='store', default=2, type=float, help="How many hours of traffic to simulate")
+arg_parser.add_argument('--seed', action='store', default=1, type=int, help="The random seed, so that all policies get the same traffic")
+arg_parser.add_argument('--load', action='store', default=0.9, type=float, help="The offered load, as a fraction of the total horde speed")
+args = arg_parser.parse_args()
+
+# (amount, max_pixels, things per second)
+WORKER_FLEET = [
+    (30, 512 * 512, 250000),
+    (15, 768 * 768, 400000),
+    (8, 1024 * 1024, 600000),
+    # Workers with a lot of VRAM but a slow GPU
+    (8, 1024 * 1024, 100000),
+    (6, 2048 * 2048, 1200000),
+]
+# (weight, width, height)
+JOB_SIZES = [
+    (64, 512, 512),
+    (20, 768, 768),
+    (12, 1024, 1024),
+    (3, 1536, 1536),
+    (1, 2048, 2048),
+]
+# (weight, steps)
+JOB_STEPS = [
+    (70, 30),
+    (30, 50),
+]
+# (weight, n)
+JOB_AMOUNTS = [
+    (60, 1),
+    (20, 4),
+    (15, 8),
+    (5, 20),
+]
+# How many candidates the worker receives from the queue on each pop
+POP_WINDOW = 100
+# How long an idle worker waits before popping again
+POP_INTERVAL = 1
+
+
+def get_job_ttl(pixels):
+    # Mirrors WaitingPromptExtended.set_job_ttl()
+    if pixels > 2048 * 2048:
+        return 800
+    if pixels > 1024 * 1024:
+        return 400
+    if pixels > 728 * 728:
+        return 260
+    if pixels >= 512 * 512:
+        return 150
+    return 120
+
+
+def generate_traffic(duration, rand):
+    workers = []
+    for amount, max_pixels, speed in WORKER_FLEET:
+        for _ in range(amount):
+            # Not all workers of the same class are equally fast
+            workers.append({"max_pixels": max_pixels, "speed": speed * rand.uniform(0.5, 1.5)})
+    total_speed = sum([w["speed"] for w in workers])
+    weighted_average = lambda choices: sum([c[0] * c[-1] for c in choices]) / sum([c[0] for c in choices])
+    average_work = (
+        sum([s[0] * s[1] * s[2] for s in JOB_SIZES]) / sum([s[0] for s in JOB_SIZES])
+        * weighted_average(JOB_STEPS)
+        * weighted_average(JOB_AMOUNTS)
+    )
+    arrival_rate = total_speed * args.load / average_work
+    requests = []
+    now = 0
+    while now < duration:
+        now += rand.expovariate(arrival_rate)
+        _, width, height = rand.choices(JOB_SIZES, weights=[s[0] for s in JOB_SIZES])[0]
+        _, steps = rand.choices(JOB_STEPS, weights=[s[0] for s in JOB_STEPS])[0]
+        _, n = rand.choices(JOB_AMOUNTS, weights=[a[0] for a in JOB_AMOUNTS])[0]
+        pixels = width * height
+        requests.append({
+            "id": len(requests),
+            "created": now,
+            # Everyone has the same kudos, so only the aging sets the priority
+            "queue_priority": -int(now * 5),
+            "pixels": pixels,
+            "things": pixels * steps,
+            "ttl": get_job_ttl(pixels),
+            "n": n,
+        })
+    return workers, requests
+
+
+def simulate(queue_order, policy, workers, requests, duration):
+    capacities = sorted([w["max_pixels"] for w in workers])
+    average_speed = statistics.mean([w["speed"] for w in workers])
+    # Each simulation consumes its own copy of the traffic
+    requests = [dict(request, outstanding=request["n"]) for request in requests]
+    queue = []
+    arrival_index = 0
+    events = [(0, worker_id) for worker_id in range(len(workers))]
+    heapq.heapify(events)
+    generated = []
+    finished = []
+    timeouts = 0
+    inversions = []
+    sort_key = lambda r: assignment.get_queue_order_key(queue_order, r["queue_priority"], r["things"], r["n"], r["created"])
+    while events:
+        now, worker_id = heapq.heappop(events)
+        if now > duration:
+            break
+        while arrival_index < len(requests) and requests[arrival_index]["created"] <= now:
+            queue.append(requests[arrival_index])
+            arrival_index += 1
+        worker = workers[worker_id]
+        candidates = sorted([request for request in queue if request["pixels"] <= worker["max_pixels"]], key=sort_key)[:POP_WINDOW]
+        if len(candidates) == 0:
+            heapq.heappush(events, (now + POP_INTERVAL, worker_id))
+            continue
+        if policy == "fit":
+            shifts = [
+                assignment.get_assignment_shift(
+                    job_pixels = request["pixels"],
+                    job_things = request["things"],
+                    job_ttl = request["ttl"],
+                    worker_max_pixels = worker["max_pixels"],
+                    worker_speed = worker["speed"],
+                    capacity_share = assignment.get_capacity_share(capacities, worker["max_pixels"]),
+                    average_speed = average_speed,
+                )
+                for request in candidates
+            ]
+            candidates = assignment.order_by_shift(candidates, shifts)
+        request = candidates[0]
+        inversions.append(sum([1 for c in candidates if c["created"] < request["created"]]))
+        request["n"] -= 1
+        if request["n"] == 0:
+            queue.remove(request)
+        generation_time = request["things"] / worker["speed"]
+        if generation_time > request["ttl"]:
+            # The job is aborted as stale and goes back to the queue
+            timeouts += 1
+            request["n"] += 1
+            if request["n"] == 1:
+                queue.append(request)
+            heapq.heappush(events, (now + request["ttl"], worker_id))
+            continue
+        generated.append((request["things"], now + generation_time))
+        request["end"] = max(request.get("end", 0), now + generation_time)
+        request["outstanding"] -= 1
+        if request["outstanding"] == 0:
+            finished.append(request)
+        heapq.heappush(events, (now + generation_time, worker_id))
+    finished = [request for request in finished if request["end"] <= duration]
+    waits = sorted([request["end"] - request["created"] for request in finished])
+    large_waits = sorted([request["end"] - request["created"] for request in finished if request["pixels"] > 1024 * 1024])
+    return {
+        "order": queue_order,
+        "policy": policy,
+        "requests": len(finished),
+        "mps": sum([things for things, end in generated if end <= duration]) / 1000000 / duration,
+        "timeouts": timeouts,
+        "wait_mean": statistics.mean(waits) if waits else 0,
+        "wait_p50": waits[len(waits) // 2] if waits else 0,
+        "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0,
+        "large_p95": large_waits[int(len(large_waits) * 0.95)] if large_waits else 0,
+        "max_inversion": max(inversions) if inversions else 0,
+    }
+
+
+if __name__ == "__main__":
+    duration = args.hours * 3600
+    workers, requests = generate_traffic(duration, random.Random(args.seed))
+    print(f"{len(workers)} workers, {len(requests)} requests over {args.hours} hours")
+    print(f"{'order':<10}{'policy':<10}{'requests':>9}{'MPS/s':>10}{'timeouts':>10}{'wait avg':>10}{'wait p50':>10}{'wait p95':>10}{'large p95':>11}{'max inv':>9}")
+    for queue_order in assignment.QUEUE_ORDERS:
+        for policy in assignment.ASSIGNMENT_POLICIES:
+            result = simulate(queue_order, policy, workers, requests, duration)
+            print(
+                f"{result['order']:<10}{result['policy']:<10}{result['requests']:>9}{result['mps']:>10.1f}{result['timeouts']:>10}"
+                f"{result['wait_mean']:>10.0f}{result['wait_p50']:>10.0f}{result['wait_p95']:>10.0f}{result['large_p95']:>11.0f}{result['max_inversion']:>9}"
+            )